@@ -3,8 +3,9 @@ import os
 import base64
 import uuid
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import boto3
+from serializer import RowEncoder, dumps
 # v3
 
 def upload_pdf_to_s3(pdf_base64: str, chat_id: str) -> str:
@@ -21,6 +22,138 @@ def upload_pdf_to_s3(pdf_base64: str, chat_id: str) -> str:
     s3.put_object(Bucket='files', Key=key, Body=pdf_data, ContentType='application/pdf')
     return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
 
+def bump_chat_version(cur, chat_id):
+    cur.execute("UPDATE chats SET version = version + 1, change_xid = txid_current() WHERE id = %s", (chat_id,))
+
+def bump_recipients_version(cur, chat_id):
+    '''Участники или ведущие педагоги изменились — push-worker перечитает получателей чата'''
+    cur.execute("UPDATE chats SET recipients_version = recipients_version + 1 WHERE id = %s", (chat_id,))
+
+# Столько живут надгробия членства; токен since старше этого срока — клиент перечитывает список целиком
+MEMBERSHIP_TOMBSTONE_RETENTION_DAYS = 30
+
+def decode_since_token(token):
+    '''Токен delta-синхронизации: "<xmin снимка>.<unix time>"'''
+    try:
+        xmin, ts = token.split('.', 1)
+        return int(xmin), int(ts)
+    except Exception:
+        raise ValueError(f"Invalid since token: {token}")
+
+def record_removed_members(cur, chat_id, user_ids):
+    '''Надгробия для пользователей, удалённых из чата, — delta-опрос списка вернёт чат в removed'''
+    if not user_ids:
+        return
+    cur.execute("""
+        INSERT INTO chat_membership_tombstones (chat_id, user_id)
+        SELECT %s, uid FROM unnest(%s::text[]) AS uid
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET removed_xid = txid_current(), removed_at = NOW()
+    """, (chat_id, list(user_ids)))
+    cur.execute(
+        "DELETE FROM chat_membership_tombstones WHERE removed_at < NOW() - %s * INTERVAL '1 day'",
+        (MEMBERSHIP_TOMBSTONE_RETENTION_DAYS,)
+    )
+
+# Пересчёт счётчиков непрочитанного по отметкам прочтения — при смене участников чата.
+# Видимость топиков — по topic_hidden_roles, как у backend/messages при увеличении счётчиков.
+UNREAD_REBUILD = """
+    INSERT INTO unread_counters (user_id, chat_id, topic_key, unread, unread_mentions)
+    SELECT cp.user_id, cp.chat_id, COALESCE(m.topic_id, ''), COUNT(*),
+           COUNT(*) FILTER (WHERE EXISTS (
+               SELECT 1 FROM message_mentions mm
+               WHERE mm.message_id = m.id AND (mm.user_id = cp.user_id OR mm.role = u.role)
+           ))
+    FROM chat_participants cp
+    LEFT JOIN users u ON u.id = cp.user_id
+    JOIN messages m ON m.chat_id = cp.chat_id AND m.sender_id != cp.user_id
+    LEFT JOIN read_watermarks w
+        ON w.user_id = cp.user_id AND w.chat_id = cp.chat_id AND w.topic_key = COALESCE(m.topic_id, '')
+    WHERE cp.chat_id = ANY(%s) AND (%s::text[] IS NULL OR cp.user_id = ANY(%s))
+      AND (m.created_at, m.id) > (COALESCE(w.last_read_at, cp.joined_at, '-infinity'::timestamp), COALESCE(w.last_read_id, ''))
+      AND NOT EXISTS (SELECT 1 FROM topic_hidden_roles h WHERE h.kind = m.topic_kind AND h.role = u.role)
+    GROUP BY cp.user_id, cp.chat_id, COALESCE(m.topic_id, '')
+"""
+
+def rebuild_unread_counters(cur, chat_ids, user_ids=None):
+    '''Пересобирает счётчики непрочитанного в чатах: всем участникам или только user_ids
+    (ушедшим участникам — удаляет)'''
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        cur.execute("DELETE FROM unread_counters WHERE chat_id = ANY(%s) AND user_id = ANY(%s)", (chat_ids, user_ids))
+    else:
+        cur.execute("DELETE FROM unread_counters WHERE chat_id = ANY(%s)", (chat_ids,))
+    cur.execute(UNREAD_REBUILD, (chat_ids, user_ids, user_ids))
+
+MAX_BULK_GROUPS = 200
+
+def provision_chats(cur, chats):
+    '''Создаёт чаты со всем содержимым — участниками, ведущими педагогами, топиками,
+    заключениями и техспециалистами с заглушёнными топиками в группах.
+
+    Каждая таблица заполняется одним многострочным запросом на все чаты сразу.
+    chats — тела запроса POST /chats, conclusionPdf — уже загруженный URL.
+    Возвращает id чатов в порядке chats.
+    '''
+    chat_ids = [c['id'] for c in chats]
+    execute_values(cur, """
+        INSERT INTO chats (id, name, type, avatar, schedule, conclusion_link, conclusion_pdf, is_pinned, lead_admin)
+        VALUES %s
+        ON CONFLICT (id) DO NOTHING
+    """, [
+        (c['id'], c['name'], c['type'], c.get('avatar'), c.get('schedule'), c.get('conclusionLink'),
+         c.get('conclusionPdf'), c.get('isPinned', False), c.get('leadAdmin'))
+        for c in chats
+    ], page_size=len(chats))
+
+    conclusions = [(c['id'], c.get('conclusionLink'), c.get('conclusionPdf'))
+                   for c in chats if c.get('conclusionLink') or c.get('conclusionPdf')]
+    if conclusions:
+        execute_values(cur, "INSERT INTO conclusions (chat_id, conclusion_link, conclusion_pdf) VALUES %s",
+                       conclusions, page_size=len(conclusions))
+
+    participants = list(dict.fromkeys((c['id'], uid) for c in chats for uid in c['participants']))
+    if participants:
+        execute_values(cur, "INSERT INTO chat_participants (chat_id, user_id) VALUES %s ON CONFLICT DO NOTHING",
+                       participants, page_size=len(participants))
+
+    lead_teachers = list(dict.fromkeys((c['id'], uid) for c in chats for uid in c.get('leadTeachers') or []))
+    if lead_teachers:
+        execute_values(cur, "INSERT INTO chat_lead_teachers (chat_id, user_id) VALUES %s ON CONFLICT DO NOTHING",
+                       lead_teachers, page_size=len(lead_teachers))
+
+    # Вид топика выводится из id функцией topic_kind() в БД — одно определение для всех функций
+    topics = [(t['id'], c['id'], t['name'], t['icon'], t['id'])
+              for c in chats if c['type'] == 'group' for t in c.get('topics') or []]
+    if topics:
+        execute_values(cur, "INSERT INTO topics (id, chat_id, name, icon, kind) VALUES %s ON CONFLICT DO NOTHING",
+                       topics, template="(%s, %s, %s, %s, topic_kind(%s))", page_size=len(topics))
+        # Техспециалисты состоят во всех группах с топиками, но уведомления топиков у них заглушены
+        cur.execute("""
+            INSERT INTO chat_participants (chat_id, user_id)
+            SELECT g.chat_id, u.id
+            FROM unnest(%s::text[]) AS g(chat_id)
+            CROSS JOIN users u
+            WHERE u.role = 'tech_specialist'
+            ON CONFLICT DO NOTHING
+        """, (list(dict.fromkeys(t[1] for t in topics)),))
+        cur.execute("""
+            INSERT INTO topic_mutes (topic_id, user_id)
+            SELECT t.topic_id, u.id
+            FROM unnest(%s::text[]) AS t(topic_id)
+            CROSS JOIN users u
+            WHERE u.role = 'tech_specialist'
+            ON CONFLICT DO NOTHING
+        """, ([t[0] for t in topics],))
+
+    rebuild_unread_counters(cur, chat_ids)
+    cur.execute(
+        "UPDATE chats SET version = version + 1, recipients_version = recipients_version + 1, change_xid = txid_current() WHERE id = ANY(%s)",
+        (chat_ids,)
+    )
+    return chat_ids
+
 def handler(event: dict, context) -> dict:
     '''API для управления чатами и группами'''
     method = event.get('httpMethod', 'GET')
@@ -31,7 +164,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, PATCH, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, If-None-Match'
             },
             'body': ''
         }
@@ -44,16 +177,66 @@ def handler(event: dict, context) -> dict:
 
         if method == 'GET':
             headers = event.get('headers', {}) or {}
+            params = event.get('queryStringParameters', {}) or {}
             user_id = headers.get('x-user-id') or headers.get('X-User-Id')
 
+            try:
+                since = decode_since_token(params['since']) if params.get('since') else None
+            except ValueError as e:
+                cur.close()
+                conn.close()
+                return {'statusCode': 400, 'headers': cors, 'body': json.dumps({'error': str(e)})}
+
             if not user_id:
                 return {'statusCode': 400, 'headers': cors, 'body': json.dumps({'error': 'X-User-Id header is required'})}
 
-            cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
+            # Токен для delta-синхронизации берём до чтения, как в backend/messages
+            cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) as xmin, EXTRACT(EPOCH FROM NOW())::bigint as ts")
+            snapshot = cur.fetchone()
+            next_token = f"{snapshot['xmin']}.{snapshot['ts']}"
+
+            cur.execute("SELECT role, list_version FROM users WHERE id = %s", (user_id,))
             role_row = cur.fetchone()
             user_role = role_row['role'] if role_row else ''
 
+            # ETag списка: версии всех чатов пользователя + его собственная версия прочтений.
+            # Считается по индексу участников, без тяжёлого запроса ниже.
             cur.execute("""
+                SELECT md5(COALESCE(string_agg(c.id || ':' || c.version, ',' ORDER BY c.id), '')) as chats_hash
+                FROM chat_participants cp
+                JOIN chats c ON c.id = cp.chat_id
+                WHERE cp.user_id = %s
+            """, (user_id,))
+            chats_hash = cur.fetchone()['chats_hash']
+            list_version = role_row['list_version'] if role_row else 0
+            etag = f'W/"{chats_hash}:{user_role}:{list_version}"'
+            if (headers.get('if-none-match') or headers.get('If-None-Match')) == etag:
+                cur.close()
+                conn.close()
+                return {'statusCode': 304, 'headers': {**cors, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'}, 'body': ''}
+
+            etag_headers = {**cors, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'}
+
+            since_xmin = None
+            removed_ids = []
+            if since:
+                since_xmin, since_ts = since
+                if snapshot['ts'] - since_ts > MEMBERSHIP_TOMBSTONE_RETENTION_DAYS * 86400:
+                    cur.close()
+                    conn.close()
+                    return {
+                        'statusCode': 200,
+                        'headers': etag_headers,
+                        'body': json.dumps({'chats': [], 'topics': {}, 'removed': [], 'reset': True, 'sinceToken': next_token})
+                    }
+                cur.execute(
+                    "SELECT chat_id FROM chat_membership_tombstones WHERE user_id = %s AND removed_xid >= %s",
+                    (user_id, since_xmin)
+                )
+                removed_ids = [r['chat_id'] for r in cur.fetchall()]
+
+            rows_cur = conn.cursor()
+            rows_cur.execute("""
                 WITH my_chats AS (
                     SELECT DISTINCT chat_id FROM chat_participants WHERE user_id = %s
                 ),
@@ -65,30 +248,15 @@ def handler(event: dict, context) -> dict:
                            TO_CHAR(c.last_msg_at, 'HH24:MI') as timestamp,
                            COALESCE(unread.count, 0) as unread,
                            ARRAY_AGG(DISTINCT cp.user_id ORDER BY cp.user_id) as participants,
-                           c.last_msg_at
+                           c.last_msg_at, c.change_xid
                     FROM chats c
                     JOIN chat_participants cp ON cp.chat_id = c.id
                     JOIN my_chats mc ON mc.chat_id = c.id
-                    LEFT JOIN LATERAL (
-                        SELECT COUNT(*) as count
-                        FROM messages msg
-                        LEFT JOIN message_status ms ON ms.message_id = msg.id AND ms.user_id = %s
-                        WHERE msg.chat_id = c.id
-                        AND (ms.status IS NULL OR ms.status != 'read')
-                        AND msg.sender_id != %s
-                        AND (
-                            msg.topic_id IS NULL
-                            OR NOT (
-                                (%s = 'teacher' AND msg.topic_id LIKE '%%' || '-admin-contact')
-                                OR (%s = 'student' AND msg.topic_id NOT LIKE '%%' || '-important'
-                                    AND msg.topic_id NOT LIKE '%%' || '-zoom'
-                                    AND msg.topic_id NOT LIKE '%%' || '-homework'
-                                    AND msg.topic_id NOT LIKE '%%' || '-reports'
-                                    AND msg.topic_id NOT LIKE '%%' || '-cancellation')
-                            )
-                        )
-                    ) unread ON true
-                    GROUP BY c.id, c.name, c.type, c.avatar, c.schedule, c.conclusion_link, c.conclusion_pdf, c.is_pinned, c.is_archived, c.lead_admin, c.last_msg_text, c.last_msg_at, unread.count
+                    -- Счётчики ведёт backend/messages, здесь только их сумма по тредам чата
+                    LEFT JOIN (
+                        SELECT chat_id, SUM(unread) as count FROM unread_counters WHERE user_id = %s GROUP BY chat_id
+                    ) unread ON unread.chat_id = c.id
+                    GROUP BY c.id, c.name, c.type, c.avatar, c.schedule, c.conclusion_link, c.conclusion_pdf, c.is_pinned, c.is_archived, c.lead_admin, c.last_msg_text, c.last_msg_at, c.change_xid, unread.count
                 ),
                 deduped AS (
                     SELECT DISTINCT ON (
@@ -97,13 +265,21 @@ def handler(event: dict, context) -> dict:
                     FROM chat_data
                     ORDER BY CASE WHEN type = 'private' THEN participants::text ELSE id END, last_msg_at DESC NULLS LAST
                 )
-                SELECT id, name, type, avatar, schedule, conclusion_link, conclusion_pdf, is_pinned, is_archived, lead_admin, last_message, timestamp, unread, participants
+                SELECT id, name, type, avatar, schedule, conclusion_link, conclusion_pdf, is_pinned, is_archived, lead_admin, last_message, timestamp, unread, participants, last_msg_at
                 FROM deduped
+                -- Delta: только чаты, изменённые начиная с since_xmin, или где менялись счётчики пользователя.
+                -- Фильтр после дедупликации, чтобы личные чаты выбирались так же, как в полном списке
+                WHERE %s::bigint IS NULL OR change_xid >= %s OR id IN (
+                    SELECT chat_id FROM unread_counters WHERE user_id = %s AND change_xid >= %s
+                )
                 ORDER BY is_pinned DESC, last_msg_at DESC NULLS LAST
-            """, (user_id, user_id, user_id, user_role, user_role))
+            """, (user_id, user_id, since_xmin, since_xmin, user_id, since_xmin))
 
-            chats = cur.fetchall()
-            chat_ids = [c['id'] for c in chats]
+            chats = rows_cur.fetchall()
+            encoder = RowEncoder(rows_cur.description)
+            rows_cur.close()
+            id_idx, type_idx = encoder.index('id'), encoder.index('type')
+            chat_ids = [c[id_idx] for c in chats]
 
             lead_teachers_dict = {}
             if chat_ids:
@@ -136,67 +312,25 @@ def handler(event: dict, context) -> dict:
                         'diagnosisDate': row['diagnosis_date']
                     })
 
-            for chat in chats:
-                chat['lead_teachers'] = lead_teachers_dict.get(chat['id'], [])
-                chat['conclusions'] = conclusions_dict.get(chat['id'], [])
-
-            group_ids = [c['id'] for c in chats if c['type'] == 'group']
+            group_ids = [c[id_idx] for c in chats if c[type_idx] == 'group']
             topics_dict = {}
 
-            user_name = None
             if group_ids:
-                cur.execute("SELECT name FROM users WHERE id = %s", (user_id,))
-                user_row = cur.fetchone()
-                if user_row:
-                    user_name = user_row['name']
-
-                mention_pattern = '%@[' + user_name + '%' if user_name else None
-                admin_mention_pattern = '%@[админ%' if user_role == 'admin' else None
-
-                if mention_pattern and admin_mention_pattern:
-                    cur.execute("""
-                        SELECT t.id, t.chat_id, t.name, t.icon,
-                               COALESCE(COUNT(DISTINCT m.id) FILTER (
-                                   WHERE (ms.status IS NULL OR ms.status != 'read') AND m.sender_id != %s
-                               ), 0) as unread,
-                               COALESCE(COUNT(DISTINCT m.id) FILTER (
-                                   WHERE (ms.status IS NULL OR ms.status != 'read') AND m.sender_id != %s
-                                   AND (m.text LIKE %s OR m.text LIKE %s)
-                               ), 0) as unread_mentions
-                        FROM topics t
-                        LEFT JOIN messages m ON m.topic_id = t.id
-                        LEFT JOIN message_status ms ON ms.message_id = m.id AND ms.user_id = %s
-                        WHERE t.chat_id = ANY(%s)
-                        GROUP BY t.id, t.chat_id, t.name, t.icon
-                        ORDER BY t.created_at
-                    """, (user_id, user_id, mention_pattern, admin_mention_pattern, user_id, group_ids))
-                else:
-                    cur.execute("""
-                        SELECT t.id, t.chat_id, t.name, t.icon,
-                               COALESCE(COUNT(DISTINCT m.id) FILTER (
-                                   WHERE (ms.status IS NULL OR ms.status != 'read') AND m.sender_id != %s
-                               ), 0) as unread,
-                               COALESCE(COUNT(DISTINCT m.id) FILTER (
-                                   WHERE (ms.status IS NULL OR ms.status != 'read') AND m.sender_id != %s
-                                   AND m.text LIKE %s
-                               ), 0) as unread_mentions
-                        FROM topics t
-                        LEFT JOIN messages m ON m.topic_id = t.id
-                        LEFT JOIN message_status ms ON ms.message_id = m.id AND ms.user_id = %s
-                        WHERE t.chat_id = ANY(%s)
-                        GROUP BY t.id, t.chat_id, t.name, t.icon
-                        ORDER BY t.created_at
-                    """, (user_id, user_id, mention_pattern or '%%%NOMATCH%%%', user_id, group_ids))
-
-                STUDENT_ALLOWED_SUFFIXES = ('-important', '-zoom', '-homework', '-reports', '-cancellation')
+                cur.execute("""
+                    SELECT t.id, t.chat_id, t.name, t.icon, t.kind,
+                           COALESCE(uc.unread, 0) as unread,
+                           COALESCE(uc.unread_mentions, 0) as unread_mentions,
+                           -- Сводку топика ведёт backend/messages
+                           COALESCE(t.last_msg_text, '') as last_message,
+                           t.last_msg_sender, t.last_msg_at, t.message_count
+                    FROM topics t
+                    LEFT JOIN unread_counters uc ON uc.user_id = %s AND uc.chat_id = t.chat_id AND uc.topic_key = t.id
+                    WHERE t.chat_id = ANY(%s)
+                      AND NOT EXISTS (SELECT 1 FROM topic_hidden_roles h WHERE h.kind = t.kind AND h.role = %s)
+                    ORDER BY t.created_at
+                """, (user_id, group_ids, user_role))
 
                 for topic in cur.fetchall():
-                    tid = topic['id']
-                    if user_role == 'teacher' and tid.endswith('-admin-contact'):
-                        continue
-                    if user_role == 'student' and not any(tid.endswith(s) for s in STUDENT_ALLOWED_SUFFIXES):
-                        continue
-
                     cid = topic['chat_id']
                     if cid not in topics_dict:
                         topics_dict[cid] = []
@@ -204,17 +338,30 @@ def handler(event: dict, context) -> dict:
                         'id': topic['id'],
                         'name': topic['name'],
                         'icon': topic['icon'],
+                        'kind': topic['kind'],
                         'unread': topic['unread'],
-                        'unread_mentions': topic['unread_mentions']
+                        'unread_mentions': topic['unread_mentions'],
+                        'last_message': topic['last_message'],
+                        'last_sender': topic['last_msg_sender'],
+                        'last_msg_at': topic['last_msg_at'],
+                        'message_count': topic['message_count']
                     })
 
             cur.close()
             conn.close()
 
+            chats_json = encoder.encode_rows(chats, extra=lambda chat: (
+                ('lead_teachers', lead_teachers_dict.get(chat[id_idx], [])),
+                ('conclusions', conclusions_dict.get(chat[id_idx], [])),
+            ))
+
+            body = {'chats': chats_json, 'topics': topics_dict, 'sinceToken': next_token}
+            if since:
+                body['removed'] = removed_ids
             return {
                 'statusCode': 200,
-                'headers': cors,
-                'body': json.dumps({'chats': [dict(c) for c in chats], 'topics': topics_dict}, default=str)
+                'headers': etag_headers,
+                'body': dumps(body)
             }
 
         elif method == 'POST':
@@ -240,6 +387,7 @@ def handler(event: dict, context) -> dict:
                     RETURNING id, TO_CHAR(created_at, 'YYYY-MM-DD') as created_date, TO_CHAR(diagnosis_date, 'YYYY-MM-DD') as diagnosis_date
                 """, (chat_id, data.get('conclusionLink'), pdf_url, diagnosis_date))
                 row = cur.fetchone()
+                bump_chat_version(cur, chat_id)
 
                 conn.commit()
                 cur.close()
@@ -279,6 +427,7 @@ def handler(event: dict, context) -> dict:
                 if c_updates:
                     c_values.extend([conclusion_id, chat_id])
                     cur.execute(f"UPDATE conclusions SET {', '.join(c_updates)} WHERE id = %s AND chat_id = %s", c_values)
+                    bump_chat_version(cur, chat_id)
 
                 conn.commit()
 
@@ -306,12 +455,42 @@ def handler(event: dict, context) -> dict:
                     return {'statusCode': 400, 'headers': cors, 'body': json.dumps({'error': 'conclusionId and chatId required'})}
 
                 cur.execute("DELETE FROM conclusions WHERE id = %s AND chat_id = %s", (conclusion_id, chat_id))
+                bump_chat_version(cur, chat_id)
                 conn.commit()
                 cur.close()
                 conn.close()
 
                 return {'statusCode': 200, 'headers': cors, 'body': json.dumps({'deleted': True})}
 
+            elif action == 'create_groups':
+                # Массовое создание групп к началу учебного года: одна транзакция,
+                # по одному многострочному INSERT на таблицу для всех групп сразу
+                groups = data.get('groups')
+                if not isinstance(groups, list) or not groups:
+                    cur.close()
+                    conn.close()
+                    return {'statusCode': 400, 'headers': cors, 'body': json.dumps({'error': 'groups required'})}
+                if len(groups) > MAX_BULK_GROUPS:
+                    cur.close()
+                    conn.close()
+                    return {'statusCode': 400, 'headers': cors, 'body': json.dumps({'error': f'At most {MAX_BULK_GROUPS} groups per request'})}
+                invalid = [i for i, g in enumerate(groups)
+                           if not isinstance(g, dict) or not g.get('id') or not g.get('name') or not isinstance(g.get('participants'), list)]
+                if invalid:
+                    cur.close()
+                    conn.close()
+                    return {'statusCode': 400, 'headers': cors, 'body': json.dumps({
+                        'error': 'Each group needs id, name and participants', 'invalid': invalid
+                    })}
+
+                chat_ids = provision_chats(cur, [{**g, 'type': 'group', 'conclusionPdf': None} for g in groups])
+                conn.commit()
+                cur.close()
+                conn.close()
+
+                print(f"POST /chats: created {len(chat_ids)} groups in bulk")
+                return {'statusCode': 201, 'headers': cors, 'body': json.dumps({'chatIds': chat_ids})}
+
             print(f"POST /chats: creating {data.get('type')} chat '{data.get('name')}' id={data.get('id')} participants={len(data.get('participants', []))}")
 
             required_fields = ['id', 'name', 'type', 'participants']
@@ -342,81 +521,7 @@ def handler(event: dict, context) -> dict:
             if data.get('conclusionPdfBase64'):
                 conclusion_pdf_url = upload_pdf_to_s3(data['conclusionPdfBase64'], data['id'])
 
-            cur.execute("""
-                INSERT INTO chats (id, name, type, avatar, schedule, conclusion_link, conclusion_pdf, is_pinned, lead_admin)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (id) DO NOTHING
-                RETURNING id
-            """, (
-                data['id'],
-                data['name'],
-                data['type'],
-                data.get('avatar'),
-                data.get('schedule'),
-                data.get('conclusionLink'),
-                conclusion_pdf_url,
-                data.get('isPinned', False),
-                data.get('leadAdmin')
-            ))
-
-            result = cur.fetchone()
-            chat_id = result['id'] if result else data['id']
-
-            if data.get('conclusionLink') or conclusion_pdf_url:
-                cur.execute("""
-                    INSERT INTO conclusions (chat_id, conclusion_link, conclusion_pdf)
-                    VALUES (%s, %s, %s)
-                """, (chat_id, data.get('conclusionLink'), conclusion_pdf_url))
-
-            for uid in data['participants']:
-                cur.execute("""
-                    INSERT INTO chat_participants (chat_id, user_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT DO NOTHING
-                """, (chat_id, uid))
-
-            for uid in data['participants']:
-                cur.execute("""
-                    INSERT INTO message_status (message_id, user_id, status, updated_at)
-                    SELECT m.id, %s, 'read', NOW()
-                    FROM messages m
-                    WHERE m.chat_id = %s AND m.sender_id != %s
-                    ON CONFLICT (message_id, user_id) DO NOTHING
-                """, (uid, chat_id, uid))
-
-            lead_teachers = data.get('leadTeachers', [])
-            for uid in lead_teachers:
-                cur.execute("""
-                    INSERT INTO chat_lead_teachers (chat_id, user_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT DO NOTHING
-                """, (chat_id, uid))
-
-            if data['type'] == 'group' and 'topics' in data:
-                for topic in data['topics']:
-                    cur.execute("""
-                        INSERT INTO topics (id, chat_id, name, icon)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT DO NOTHING
-                    """, (topic['id'], chat_id, topic['name'], topic['icon']))
-
-                cur.execute("""
-                    SELECT id FROM users WHERE role = 'tech_specialist'
-                """)
-                tech_specialists = [r['id'] for r in cur.fetchall()]
-                for ts_id in tech_specialists:
-                    cur.execute("""
-                        INSERT INTO chat_participants (chat_id, user_id)
-                        VALUES (%s, %s)
-                        ON CONFLICT DO NOTHING
-                    """, (chat_id, ts_id))
-                    for topic in data['topics']:
-                        cur.execute("""
-                            INSERT INTO topic_mutes (topic_id, user_id)
-                            VALUES (%s, %s)
-                            ON CONFLICT DO NOTHING
-                        """, (topic['id'], ts_id))
-
+            chat_id = provision_chats(cur, [{**data, 'conclusionPdf': conclusion_pdf_url}])[0]
             conn.commit()
             cur.close()
             conn.close()
@@ -480,33 +585,41 @@ def handler(event: dict, context) -> dict:
                 cur.execute(query, values)
                 cur.fetchone()
 
+            # Составы применяются разницей: одна вставка новых и одно удаление ушедших
             if 'leadTeachers' in data:
-                cur.execute("SELECT user_id FROM chat_lead_teachers WHERE chat_id = %s", (chat_id,))
-                existing = {r['user_id'] for r in cur.fetchall()}
-                new_set = set(data['leadTeachers'])
-
-                for uid in new_set - existing:
-                    cur.execute("INSERT INTO chat_lead_teachers (chat_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (chat_id, uid))
-                for uid in existing - new_set:
-                    cur.execute("DELETE FROM chat_lead_teachers WHERE chat_id = %s AND user_id = %s", (chat_id, uid))
+                new_list = list(set(data['leadTeachers']))
+                cur.execute("""
+                    INSERT INTO chat_lead_teachers (chat_id, user_id)
+                    SELECT %s, uid FROM unnest(%s::text[]) AS uid
+                    ON CONFLICT DO NOTHING
+                """, (chat_id, new_list))
+                cur.execute("DELETE FROM chat_lead_teachers WHERE chat_id = %s AND NOT (user_id = ANY(%s))", (chat_id, new_list))
 
             if 'participants' in data:
-                cur.execute("SELECT user_id FROM chat_participants WHERE chat_id = %s", (chat_id,))
-                existing = {r['user_id'] for r in cur.fetchall()}
-                new_set = set(data['participants'])
-
-                for uid in new_set - existing:
-                    cur.execute("INSERT INTO chat_participants (chat_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (chat_id, uid))
-                    cur.execute("""
-                        INSERT INTO message_status (message_id, user_id, status, updated_at)
-                        SELECT m.id, %s, 'read', NOW()
-                        FROM messages m
-                        WHERE m.chat_id = %s AND m.sender_id != %s
-                        ON CONFLICT (message_id, user_id) DO NOTHING
-                    """, (uid, chat_id, uid))
-                for uid in existing - new_set:
-                    cur.execute("DELETE FROM chat_participants WHERE chat_id = %s AND user_id = %s", (chat_id, uid))
-
+                new_list = list(set(data['participants']))
+                # Прочитанным для нового участника считается всё до joined_at — отметки не нужны
+                cur.execute("""
+                    INSERT INTO chat_participants (chat_id, user_id)
+                    SELECT %s, uid FROM unnest(%s::text[]) AS uid
+                    ON CONFLICT DO NOTHING
+                    RETURNING user_id
+                """, (chat_id, new_list))
+                added = [r['user_id'] for r in cur.fetchall()]
+                if added:
+                    cur.execute("DELETE FROM chat_membership_tombstones WHERE chat_id = %s AND user_id = ANY(%s)", (chat_id, added))
+                cur.execute(
+                    "DELETE FROM chat_participants WHERE chat_id = %s AND NOT (user_id = ANY(%s)) RETURNING user_id",
+                    (chat_id, new_list)
+                )
+                removed = [r['user_id'] for r in cur.fetchall()]
+                if removed:
+                    cur.execute("DELETE FROM read_watermarks WHERE chat_id = %s AND user_id = ANY(%s)", (chat_id, removed))
+                    record_removed_members(cur, chat_id, removed)
+                rebuild_unread_counters(cur, [chat_id], added + removed)
+
+            if 'leadTeachers' in data or 'participants' in data:
+                bump_recipients_version(cur, chat_id)
+            bump_chat_version(cur, chat_id)
             conn.commit()
             cur.close()
             conn.close()
@@ -529,13 +642,16 @@ def handler(event: dict, context) -> dict:
                 return {'statusCode': 400, 'headers': cors, 'body': json.dumps({'error': 'chatId or chatIds required'})}
 
             for cid in chat_ids:
-                cur.execute("DELETE FROM message_status WHERE message_id IN (SELECT id FROM messages WHERE chat_id = %s)", (cid,))
+                cur.execute("DELETE FROM read_watermarks WHERE chat_id = %s", (cid,))
+                cur.execute("DELETE FROM unread_counters WHERE chat_id = %s", (cid,))
                 cur.execute("DELETE FROM attachments WHERE message_id IN (SELECT id FROM messages WHERE chat_id = %s)", (cid,))
                 cur.execute("DELETE FROM reactions WHERE message_id IN (SELECT id FROM messages WHERE chat_id = %s)", (cid,))
+                cur.execute("DELETE FROM message_mentions WHERE chat_id = %s", (cid,))
                 cur.execute("DELETE FROM messages WHERE chat_id = %s", (cid,))
                 cur.execute("DELETE FROM topics WHERE chat_id = %s", (cid,))
                 cur.execute("DELETE FROM chat_lead_teachers WHERE chat_id = %s", (cid,))
-                cur.execute("DELETE FROM chat_participants WHERE chat_id = %s", (cid,))
+                cur.execute("DELETE FROM chat_participants WHERE chat_id = %s RETURNING user_id", (cid,))
+                record_removed_members(cur, cid, [r['user_id'] for r in cur.fetchall()])
                 cur.execute("DELETE FROM chats WHERE id = %s", (cid,))
 
             conn.commit()
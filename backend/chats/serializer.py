@@ -0,0 +1,170 @@
+'''Быстрая сериализация строк БД в JSON.
+
+Строки берутся из обычного (кортежного) курсора psycopg2: для каждого столбца
+заранее выбирается кодировщик, ключи JSON кодируются один раз, а весь ответ
+собирается в один буфер и склеивается одним join.
+
+Одинаковые копии лежат в backend/messages, backend/chats и backend/users —
+функции деплоятся независимо друг от друга.
+'''
+import json
+from datetime import datetime, date
+from json.encoder import encode_basestring_ascii as encode_string
+
+VALUE = 'value'
+STRING = 'string'
+TIMESTAMP = 'timestamp'
+RAW = 'raw'
+LIST = 'list'
+
+# OID типов PostgreSQL из cursor.description: для них кодировщик выбирается сразу
+TYPE_KINDS = {
+    25: STRING,       # text
+    1043: STRING,     # varchar
+    1042: STRING,     # bpchar
+    19: STRING,       # name
+    1114: TIMESTAMP,  # timestamp
+    1184: TIMESTAMP,  # timestamptz
+}
+
+
+class RawJSON(str):
+    '''Уже закодированный JSON-фрагмент, вставляется в ответ как есть'''
+
+
+def encode_value(v):
+    if v is None:
+        return 'null'
+    t = type(v)
+    if t is str or t is RawJSON:
+        return v if t is RawJSON else encode_string(v)
+    if t is bool:
+        return 'true' if v else 'false'
+    if t is int:
+        return str(v)
+    if t is float:
+        return json.dumps(v)
+    if t is datetime:
+        return encode_timestamp(v)
+    if t is list or t is tuple:
+        return '[' + ','.join([encode_value(x) for x in v]) + ']'
+    if t is date:
+        return '"' + v.isoformat() + '"'
+    return json.dumps(v, default=str)
+
+
+def encode_timestamp(v):
+    # В БД время хранится в UTC без часового пояса — помечаем его суффиксом Z
+    if v is None:
+        return 'null'
+    if type(v) is not datetime:
+        return encode_value(v)
+    if v.tzinfo is None:
+        return '"' + v.isoformat() + 'Z"'
+    return '"' + v.isoformat() + '"'
+
+
+def encode_raw(v):
+    # Столбец уже содержит JSON-текст (например, jsonb::text)
+    return 'null' if v is None else v
+
+
+def encode_list(v):
+    return '[]' if v is None else encode_value(v)
+
+
+ENCODERS = {
+    VALUE: encode_value,
+    STRING: encode_string,
+    TIMESTAMP: encode_timestamp,
+    RAW: encode_raw,
+    LIST: encode_list,
+}
+
+
+class RowEncoder:
+    '''Кодирует кортежи строк курсора в JSON-объекты.
+
+    description — cursor.description (или список имён столбцов),
+    kinds — {столбец: VALUE | STRING | TIMESTAMP | RAW | LIST}; если не задано,
+            вид берётся по OID типа столбца, иначе VALUE,
+    names — переименование ключей в ответе,
+    skip — столбцы, которые не попадают в ответ.
+    '''
+
+    def __init__(self, description, kinds=None, names=None, skip=()):
+        kinds = kinds or {}
+        names = names or {}
+        self.columns = [col if isinstance(col, str) else col[0] for col in description]
+        self.fields = []
+        for i, col in enumerate(description):
+            name = self.columns[i]
+            if name in skip:
+                continue
+            type_code = None if isinstance(col, str) else col[1]
+            kind = kinds.get(name) or TYPE_KINDS.get(type_code, VALUE)
+            prefix = (',' if self.fields else '{') + encode_string(names.get(name, name)) + ':'
+            # null и пустые списки кодируются без вызова кодировщика
+            null = '[]' if kind == LIST else 'null'
+            self.fields.append((i, prefix, ENCODERS[kind], prefix + null))
+
+    def index(self, column):
+        return self.columns.index(column)
+
+    def encode(self, row, out, extra=None):
+        append = out.append
+        for i, prefix, enc, null in self.fields:
+            v = row[i]
+            if v is None:
+                append(null)
+            else:
+                append(prefix)
+                append(enc(v))
+        if extra:
+            for key, value in extra:
+                out.append(',' + encode_string(key) + ':')
+                out.append(encode_value(value))
+        out.append('}')
+
+    def encode_row(self, row, extra=None):
+        out = []
+        self.encode(row, out, extra)
+        return RawJSON(''.join(out))
+
+    def encode_rows(self, rows, extra=None):
+        '''extra(row) -> [(ключ, значение)] — дополнительные поля объекта'''
+        out = ['[']
+        for n, row in enumerate(rows):
+            if n:
+                out.append(',')
+            self.encode(row, out, extra(row) if extra else None)
+        out.append(']')
+        return RawJSON(''.join(out))
+
+
+def dumps(payload):
+    '''json.dumps, который вставляет RawJSON-фрагменты без повторного разбора'''
+    out = []
+    _encode(payload, out)
+    return ''.join(out)
+
+
+def _encode(v, out):
+    t = type(v)
+    if t is dict:
+        out.append('{')
+        first = True
+        for key, item in v.items():
+            out.append(('' if first else ',') + encode_string(str(key)) + ':')
+            _encode(item, out)
+            first = False
+        out.append('}')
+    elif t is list or t is tuple:
+        out.append('[')
+        for n, item in enumerate(v):
+            if n:
+                out.append(',')
+            _encode(item, out)
+        out.append(']')
+    else:
+        out.append(encode_value(v))
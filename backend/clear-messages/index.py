@@ -32,6 +32,10 @@ def handler(event: dict, context) -> dict:
             return {'statusCode': 400, 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}, 'body': json.dumps({'error': 'userId and keepId required'})}
         cur.execute("DELETE FROM push_subscriptions WHERE user_id = %s AND id != %s", (user_id, keep_id))
         deleted = cur.rowcount
+        cur.execute(
+            "UPDATE chats SET recipients_version = recipients_version + 1 WHERE id IN (SELECT chat_id FROM chat_participants WHERE user_id = %s)",
+            (user_id,)
+        )
         conn.commit()
         cur.close()
         conn.close()
@@ -47,10 +51,22 @@ def handler(event: dict, context) -> dict:
 
         placeholders = ','.join(['%s'] * len(keep_ids))
         cur.execute(
-            "DELETE FROM chat_participants WHERE chat_id = %%s AND user_id NOT IN (%s)" % placeholders,
+            "DELETE FROM chat_participants WHERE chat_id = %%s AND user_id NOT IN (%s) RETURNING user_id" % placeholders,
             [chat_id] + keep_ids
         )
-        deleted = cur.rowcount
+        removed = [r[0] for r in cur.fetchall()]
+        deleted = len(removed)
+        if removed:
+            # Надгробия членства — delta-опрос списка чатов уберёт чат у удалённых
+            cur.execute("""
+                INSERT INTO chat_membership_tombstones (chat_id, user_id)
+                SELECT %s, uid FROM unnest(%s::text[]) AS uid
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET removed_xid = txid_current(), removed_at = NOW()
+            """, (chat_id, removed))
+        cur.execute(
+            "UPDATE chats SET recipients_version = recipients_version + 1, version = version + 1, change_xid = txid_current() WHERE id = %s",
+            (chat_id,)
+        )
         conn.commit()
         cur.close()
         conn.close()
@@ -60,10 +76,22 @@ def handler(event: dict, context) -> dict:
             'body': json.dumps({'success': True, 'deleted': deleted})
         }
 
+    cur.execute("""
+        INSERT INTO message_tombstones (message_id, chat_id, topic_id)
+        SELECT id, chat_id, topic_id FROM messages
+        ON CONFLICT (message_id) DO NOTHING
+    """)
     cur.execute("DELETE FROM reactions")
     cur.execute("DELETE FROM attachments")
-    cur.execute("DELETE FROM message_status")
+    cur.execute("DELETE FROM message_mentions")
+    cur.execute("DELETE FROM read_watermarks")
+    cur.execute("DELETE FROM unread_counters")
     cur.execute("DELETE FROM messages")
+    cur.execute("UPDATE chats SET version = version + 1, change_xid = txid_current(), last_msg_text = NULL, last_msg_at = NULL, last_msg_topic_id = NULL")
+    cur.execute("""
+        UPDATE topics SET version = version + 1, message_count = 0,
+            last_msg_id = NULL, last_msg_text = NULL, last_msg_sender = NULL, last_msg_at = NULL
+    """)
     conn.commit()
 
     cur.execute("SELECT COUNT(*) FROM messages")
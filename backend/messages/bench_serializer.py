@@ -0,0 +1,103 @@
+'''Микробенчмарк сериализации ленты сообщений: старый путь против serializer.py.
+
+Запуск: python bench_serializer.py [кол-во сообщений]
+
+Старый путь — RealDictRow -> dict -> serialize_message -> json.dumps(default=str),
+вложения и реакции приходят из драйвера уже разобранными в Python-объекты.
+Новый путь — кортежи строк, jsonb::text вставляется в ответ как есть.
+Время разбора jsonb внутри psycopg2 (которого в новом пути нет) здесь не учитывается,
+так что реальный выигрыш на GET немного больше измеренного.
+'''
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+from serializer import RowEncoder, dumps, RAW
+
+COLUMNS = [
+    'id', 'text', 'sender_id', 'sender_name', 'created_at',
+    'reply_to_id', 'reply_to_sender', 'reply_to_text',
+    'forwarded_from_id', 'forwarded_from_sender', 'forwarded_from_text',
+    'forwarded_from_date', 'forwarded_from_chat_name',
+    'attachments', 'reactions',
+]
+# (name, type_code) как в cursor.description: text = 25, timestamp = 1114
+DESCRIPTION = [(name, 1114 if name == 'created_at' else 25) for name in COLUMNS]
+
+
+def legacy_serialize_message(m):
+    d = dict(m)
+    if d.get('created_at'):
+        ts = str(d['created_at'])
+        if not ts.endswith('Z') and '+' not in ts:
+            ts = ts + 'Z'
+        d['created_at'] = ts
+    if d.get('attachments'):
+        cleaned = []
+        for att in d['attachments']:
+            if att and isinstance(att, dict):
+                url = att.get('fileUrl') or ''
+                if url.startswith('data:'):
+                    att = dict(att)
+                    att['fileUrl'] = None
+                cleaned.append(att)
+        d['attachments'] = cleaned if cleaned else None
+    return d
+
+
+def make_thread(n):
+    start = datetime(2025, 9, 1, 8, 0, 0)
+    legacy_rows, tuple_rows = [], []
+    for i in range(n):
+        attachments = None
+        if i % 7 == 0:
+            attachments = [{'type': 'image', 'fileUrl': f'https://cdn.poehali.dev/projects/x/bucket/chat-files/{i}.jpg',
+                            'fileName': f'photo-{i}.jpg', 'fileSize': '245 KB'}]
+        reactions = None
+        if i % 5 == 0:
+            reactions = [{'emoji': '👍', 'count': 2, 'users': ['Анна Петрова', 'Олег Смирнов'], 'userIds': ['parent-1', 'parent-2']}]
+        values = [
+            f'msg-{i}', f'Домашнее задание на {i % 30 + 1} число: упражнения 3-7, повторить правило',
+            'teacher-3', 'Мария Ивановна', start + timedelta(seconds=37 * i, microseconds=i),
+            None, None, None, None, None, None, None, None,
+        ]
+        legacy_rows.append(dict(zip(COLUMNS, values + [attachments, reactions])))
+        tuple_rows.append(tuple(values + [
+            json.dumps(attachments) if attachments else None,
+            json.dumps(reactions) if reactions else None,
+        ]))
+    return legacy_rows, tuple_rows
+
+
+def run_legacy(rows):
+    return json.dumps({'messages': [legacy_serialize_message(m) for m in rows]}, default=str)
+
+
+def run_serializer(rows):
+    encoder = RowEncoder(DESCRIPTION, {'attachments': RAW, 'reactions': RAW})
+    return dumps({'messages': encoder.encode_rows(rows)})
+
+
+def measure(fn, rows, repeat=5):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(rows)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return len(rows) / best
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    legacy_rows, tuple_rows = make_thread(n)
+
+    assert len(json.loads(run_serializer(tuple_rows))['messages']) == n
+
+    before = measure(run_legacy, legacy_rows)
+    after = measure(run_serializer, tuple_rows)
+    print(f"messages: {n}")
+    print(f"legacy serialize_message + json.dumps: {before:,.0f} rows/sec")
+    print(f"serializer.RowEncoder:                 {after:,.0f} rows/sec")
+    print(f"speedup: x{after / before:.2f}")
@@ -0,0 +1,92 @@
+'''Проверка видимости вложений в view=media по ролям (нужна база со всеми миграциями).
+
+Запуск: DATABASE_URL=... python check_media_access.py
+
+Создаёт группу с топиками important, admin-contact и payment, по одному вложению
+в каждом, и ученика-участника. Запрос файлов всего чата от имени ученика должен
+вернуть только вложение из important; запрос без участия в чате — ничего.
+Тестовые строки удаляются в конце.
+'''
+import json
+import os
+import uuid
+
+import psycopg2
+
+import index
+
+
+def seed(cur, prefix):
+    chat_id = f"{prefix}-group"
+    student_id = f"{prefix}-student"
+    outsider_id = f"{prefix}-outsider"
+    cur.execute("INSERT INTO chats (id, name, type) VALUES (%s, 'media check', 'group')", (chat_id,))
+    for user_id, phone in ((student_id, f"{prefix}-1"), (outsider_id, f"{prefix}-2")):
+        cur.execute(
+            "INSERT INTO users (id, name, phone, password, role) VALUES (%s, %s, %s, '-', 'student')",
+            (user_id, user_id, phone)
+        )
+    cur.execute("INSERT INTO chat_participants (chat_id, user_id) VALUES (%s, %s)", (chat_id, student_id))
+    for suffix in ('important', 'admin-contact', 'payment'):
+        topic_id = f"{chat_id}-{suffix}"
+        message_id = f"{prefix}-{suffix}"
+        cur.execute(
+            "INSERT INTO topics (id, chat_id, name, icon, kind) VALUES (%s, %s, %s, 'File', topic_kind(%s))",
+            (topic_id, chat_id, suffix, topic_id)
+        )
+        cur.execute("""
+            INSERT INTO messages (id, chat_id, topic_id, topic_kind, sender_id, sender_name, text)
+            VALUES (%s, %s, %s, topic_kind(%s), 'admin', 'Администратор', %s)
+        """, (message_id, chat_id, topic_id, topic_id, suffix))
+        cur.execute("""
+            INSERT INTO attachments (id, message_id, type, file_url, file_name, chat_id, topic_id)
+            VALUES (%s, %s, 'file', %s, %s, %s, %s)
+        """, (f"{message_id}-0", message_id, f"https://example.invalid/{suffix}.pdf", f"{suffix}.pdf", chat_id, topic_id))
+    return chat_id, student_id, outsider_id
+
+
+def cleanup(cur, prefix):
+    like = prefix + '-%'
+    cur.execute("DELETE FROM attachments WHERE message_id LIKE %s", (like,))
+    cur.execute("DELETE FROM messages WHERE id LIKE %s", (like,))
+    cur.execute("DELETE FROM topics WHERE chat_id LIKE %s", (like,))
+    cur.execute("DELETE FROM chat_participants WHERE chat_id LIKE %s", (like,))
+    cur.execute("DELETE FROM chats WHERE id LIKE %s", (like,))
+    cur.execute("DELETE FROM users WHERE id LIKE %s", (like,))
+
+
+def media_topics(chat_id, user_id):
+    response = index.handler({
+        'httpMethod': 'GET',
+        'headers': {'X-User-Id': user_id},
+        'queryStringParameters': {'chatId': chat_id, 'view': 'media'},
+    }, None)
+    assert response['statusCode'] == 200, response
+    return sorted(item['topic_id'] for item in json.loads(response['body'])['items'])
+
+
+def check_media_access():
+    prefix = f"media-check-{uuid.uuid4().hex[:8]}"
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    try:
+        chat_id, student_id, outsider_id = seed(cur, prefix)
+        conn.commit()
+
+        student_topics = media_topics(chat_id, student_id)
+        print(f"student sees: {student_topics}")
+        assert student_topics == [f"{chat_id}-important"], 'student sees attachments of hidden topics'
+
+        outsider_topics = media_topics(chat_id, outsider_id)
+        print(f"non-participant sees: {outsider_topics}")
+        assert outsider_topics == [], 'media of a chat is visible to non-participants'
+    finally:
+        conn.rollback()
+        cleanup(cur, prefix)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    check_media_access()
@@ -1,17 +1,39 @@
 import json
 import os
+import re
 import sys
+import time
 import base64
+import hashlib
+import csv
+import io
 import uuid
 import boto3
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.extras import RealDictCursor, execute_values
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from serializer import RowEncoder, dumps, TIMESTAMP, RAW
 
 def log(msg):
     print(msg, file=sys.stderr, flush=True)
 
+S3_UPLOAD_WORKERS = 4
+
+_s3 = None
+
+def get_s3():
+    '''Один клиент S3 на экземпляр функции: клиенты boto3 потокобезопасны и держат пул соединений'''
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client(
+            's3',
+            endpoint_url='https://bucket.poehali.dev',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+        )
+    return _s3
+
 def upload_base64_to_s3(data_url):
     try:
         header, b64data = data_url.split(',', 1)
@@ -24,20 +46,623 @@ def upload_base64_to_s3(data_url):
         ext = ext_map.get(mime, 'bin')
         file_bytes = base64.b64decode(b64data)
         key = f"chat-files/{uuid.uuid4()}.{ext}"
-        s3 = boto3.client(
-            's3',
-            endpoint_url='https://bucket.poehali.dev',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-        )
-        s3.put_object(Bucket='files', Key=key, Body=file_bytes, ContentType=mime)
+        get_s3().put_object(Bucket='files', Key=key, Body=file_bytes, ContentType=mime)
         return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{key}"
     except Exception as e:
         log(f"[S3] Upload error: {e}")
         return None
 
+def upload_attachments(attachments):
+    '''URL вложений по порядку: data:-URL загружаются в S3 параллельно, остальные остаются как есть.
+
+    Время загрузки — примерно как у самого долгого файла, а не сумма всех.
+    Если загрузка не удалась, остаётся исходный URL.
+    '''
+    file_urls = [att.get('fileUrl') for att in attachments]
+    pending = [i for i, url in enumerate(file_urls) if url and url.startswith('data:')]
+    if not pending:
+        return file_urls
+    get_s3()  # клиент создаётся до запуска потоков
+    with ThreadPoolExecutor(max_workers=min(S3_UPLOAD_WORKERS, len(pending))) as pool:
+        for i, cdn_url in zip(pending, pool.map(upload_base64_to_s3, [file_urls[i] for i in pending])):
+            if cdn_url:
+                file_urls[i] = cdn_url
+    return file_urls
+
+# Окно сводки push треда; воркер слушает очередь и просыпается точно к концу окна
+PUSH_COALESCE_SECONDS = 20
+MAX_BROADCAST_GROUPS = 500
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+TOMBSTONE_RETENTION_DAYS = 30
+
+def encode_cursor(created_at, message_id):
+    '''Курсор страницы: позиция сообщения (created_at, id) в base64'''
+    raw = f"{created_at.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split('|', 1)
+        datetime.fromisoformat(created_at)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return created_at, message_id
+
+def decode_since_token(token):
+    '''Токен delta-синхронизации: "<xmin снимка>.<unix time>"'''
+    try:
+        xmin, ts = token.split('.', 1)
+        return int(xmin), int(ts)
+    except Exception:
+        raise ValueError(f"Invalid since token: {token}")
+
+MESSAGES_SELECT = """
+    SELECT m.id, m.text, m.sender_id, m.sender_name, m.created_at,
+           m.reply_to_id, m.reply_to_sender, m.reply_to_text,
+           m.forwarded_from_id, m.forwarded_from_sender, m.forwarded_from_text,
+           m.forwarded_from_date::text, m.forwarded_from_chat_name,
+           att.attachments::text as attachments,
+           m.reactions_summary::text as reactions
+    FROM (
+        SELECT * FROM messages m
+        WHERE {where}
+        ORDER BY m.created_at {order}, m.id {order}
+        LIMIT %s
+    ) m
+    LEFT JOIN LATERAL (
+        SELECT jsonb_agg(DISTINCT jsonb_build_object(
+            'type', a.type,
+            'fileUrl', CASE WHEN a.file_url LIKE 'data:%%' THEN NULL ELSE a.file_url END,
+            'fileName', a.file_name, 'fileSize', a.file_size
+        )) as attachments
+        FROM attachments a WHERE a.message_id = m.id
+    ) att ON true
+    ORDER BY m.created_at ASC, m.id ASC
+"""
+
+# Вложения и реакции приходят из БД готовым JSON-текстом и вставляются в ответ без разбора
+MESSAGE_COLUMN_KINDS = {'created_at': TIMESTAMP, 'attachments': RAW, 'reactions': RAW}
+
+# Пересчёт сводки реакций сообщения (emoji -> count, имена и id пользователей).
+# Вызывается при каждом изменении реакций, чтобы GET читал готовый столбец.
+# Сводка строится SQL-функцией build_reactions_summary() (V0058) — её же вызывает backend/users
+REACTIONS_SUMMARY_UPDATE = """
+    UPDATE messages SET reactions_summary = build_reactions_summary(id), change_xid = txid_current()
+    WHERE id = %s
+"""
+
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_ROLES = ('admin', 'tech_specialist')
+
+# Выгрузка истории идёт по индексу (chat_id|topic_id, created_at) без сортировки
+# в памяти, поэтому серверный курсор отдаёт строки по мере чтения
+EXPORT_SELECT = """
+    SELECT m.id, m.chat_id, m.topic_id, m.created_at, m.sender_id, m.sender_name, m.text,
+           m.reply_to_id, m.reply_to_sender, m.reply_to_text,
+           m.forwarded_from_id, m.forwarded_from_sender, m.forwarded_from_text,
+           m.forwarded_from_date::text, m.forwarded_from_chat_name,
+           att.attachments::text as attachments,
+           m.reactions_summary::text as reactions
+    FROM messages m
+    LEFT JOIN LATERAL (
+        SELECT jsonb_agg(jsonb_build_object(
+            'type', a.type,
+            'fileUrl', CASE WHEN a.file_url LIKE 'data:%%' THEN NULL ELSE a.file_url END,
+            'fileName', a.file_name, 'fileSize', a.file_size
+        ) ORDER BY a.id) as attachments
+        FROM attachments a WHERE a.message_id = m.id
+    ) att ON true
+    WHERE {where}
+    ORDER BY m.created_at ASC, m.id ASC
+    LIMIT %s
+"""
+
+def iter_export_rows(conn, where_clause, query_params, limit):
+    '''Строки выгрузки из именованного (серверного) курсора пачками по EXPORT_BATCH_SIZE.
+
+    Первым значением отдаёт cursor.description, затем сами строки —
+    в памяти одновременно не больше одной пачки.
+    '''
+    export_cur = conn.cursor(name=f"messages_export_{uuid.uuid4().hex}")
+    export_cur.itersize = EXPORT_BATCH_SIZE
+    try:
+        export_cur.execute(EXPORT_SELECT.format(where=where_clause), query_params + [limit])
+        batch = export_cur.fetchmany(EXPORT_BATCH_SIZE)
+        yield export_cur.description
+        while batch:
+            yield from batch
+            batch = export_cur.fetchmany(EXPORT_BATCH_SIZE)
+    finally:
+        export_cur.close()
+
+def export_messages(conn, where_clause, query_params, fmt):
+    '''Часть выгрузки (до EXPORT_CHUNK_ROWS сообщений) в NDJSON или CSV.
+
+    Возвращает (тело, курсор продолжения или None, число сообщений).
+    '''
+    rows = iter_export_rows(conn, where_clause, query_params, EXPORT_CHUNK_ROWS + 1)
+    description = next(rows)
+    encoder = RowEncoder(description, MESSAGE_COLUMN_KINDS)
+    id_idx, created_idx = encoder.index('id'), encoder.index('created_at')
+
+    out = io.StringIO()
+    writer = csv.writer(out) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(encoder.columns)
+    count, last, resume = 0, None, None
+    for row in rows:
+        if count == EXPORT_CHUNK_ROWS:
+            resume = encode_cursor(last[created_idx], last[id_idx])
+            break
+        if writer:
+            writer.writerow(['' if v is None else (v.isoformat() + 'Z' if isinstance(v, datetime) else v) for v in row])
+        else:
+            out.write(encoder.encode_row(row))
+            out.write('\n')
+        count += 1
+        last = row
+    rows.close()
+    return out.getvalue(), resume, count
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 50
+MIN_SEARCH_QUERY = 2
+
+def encode_search_cursor(rank, created_at, message_id):
+    '''Курсор поиска: позиция последнего результата (rank, created_at, id) в base64'''
+    raw = f"{rank!r}|{created_at.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_search_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        rank, created_at, message_id = raw.split('|', 2)
+        datetime.fromisoformat(created_at)
+        return float(rank), created_at, message_id
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+def topic_access_clause(role):
+    '''Условие видимости сообщения для роли — по topic_hidden_roles, как в списке топиков чатов'''
+    return "NOT EXISTS (SELECT 1 FROM topic_hidden_roles h WHERE h.kind = m.topic_kind AND h.role = %s)", [role]
+
+# Вид топика для записи: из topics, а для топика без строки — по id через topic_kind(),
+# чтобы сообщение в топике никогда не получило NULL (NULL — только чат без топика, видно всем)
+TOPIC_KIND_SQL = "COALESCE((SELECT kind FROM topics WHERE id = %s), topic_kind(%s))"
+
+def payment_send_forbidden(cur, sender_id, topic_ids):
+    '''Педагогам нельзя писать в топики вида payment'''
+    cur.execute(f"""
+        SELECT 1 FROM users
+        WHERE id = %s AND role = 'teacher'
+          AND EXISTS (SELECT 1 FROM unnest(%s::text[]) AS t(topic_id)
+                      WHERE {TOPIC_KIND_SQL % ('t.topic_id', 't.topic_id')} = 'payment')
+    """, (sender_id, list(topic_ids)))
+    return cur.fetchone() is not None
+
+# Поиск идёт по GIN-индексу idx_messages_search только в чатах пользователя;
+# сниппеты (ts_headline) строятся лишь для строк текущей страницы.
+# Текст экранируется до ts_headline, чтобы в сниппете был только разметочный <mark>.
+SEARCH_SELECT = """
+    WITH q AS (SELECT websearch_to_tsquery('russian', %s) AS query),
+    hits AS (
+        SELECT m.id, m.chat_id, m.topic_id, m.sender_id, m.sender_name, m.created_at, m.text,
+               ts_rank_cd(m.search_tsv, q.query) AS rank
+        FROM messages m CROSS JOIN q
+        WHERE m.search_tsv @@ q.query
+          AND m.chat_id IN (SELECT chat_id FROM chat_participants WHERE user_id = %s)
+          AND {where}
+    )
+    SELECT h.id, h.chat_id, h.topic_id, c.name as chat_name, t.name as topic_name,
+           h.sender_id, h.sender_name, h.created_at,
+           ts_headline('russian',
+                       replace(replace(replace(h.text, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                       q.query, 'StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=10, MaxFragments=2') as snippet,
+           h.rank
+    FROM (
+        SELECT * FROM hits
+        WHERE {cursor}
+        ORDER BY rank DESC, created_at DESC, id DESC
+        LIMIT %s
+    ) h
+    CROSS JOIN q
+    JOIN chats c ON c.id = h.chat_id
+    LEFT JOIN topics t ON t.id = h.topic_id
+    ORDER BY h.rank DESC, h.created_at DESC, h.id DESC
+"""
+
+DEFAULT_MEDIA_PAGE_SIZE = 50
+MEDIA_TYPES = ('image', 'file')
+
+# Файлы и фото треда, новые сверху: keyset-проход по idx_attachments_chat_created /
+# idx_attachments_topic_created, строка вложения читается только для страницы.
+# Вложения скрытых для роли топиков отсекаются до LIMIT — через m.topic_kind
+MEDIA_SELECT = """
+    SELECT a.id, a.message_id, a.type,
+           CASE WHEN a.file_url LIKE 'data:%%' THEN NULL ELSE a.file_url END as file_url,
+           a.file_name, a.file_size, a.created_at, a.topic_id,
+           m.sender_id, m.sender_name
+    FROM (
+        SELECT a.id FROM attachments a
+        JOIN messages m ON m.id = a.message_id
+        WHERE {where}
+        ORDER BY a.created_at DESC, a.id DESC
+        LIMIT %s
+    ) page
+    JOIN attachments a ON a.id = page.id
+    JOIN messages m ON m.id = a.message_id
+    ORDER BY a.created_at DESC, a.id DESC
+"""
+
+def bump_thread_version(cur, chat_id, topic_id):
+    '''Увеличивает версии чата и топика — по ним GET отвечает 304 Not Modified'''
+    cur.execute("UPDATE chats SET version = version + 1, change_xid = txid_current() WHERE id = %s", (chat_id,))
+    if topic_id:
+        cur.execute("UPDATE topics SET version = version + 1 WHERE id = %s", (topic_id,))
+
+def topic_summary_set(message_id_sql):
+    '''SET-часть сводки топика. Сообщение становится последним, если оно не старше текущего
+    последнего; правка последнего сообщения (тот же id) обновляет превью'''
+    is_last = f"(last_msg_at IS NULL OR (last_msg_at, last_msg_id) <= (%(at)s, {message_id_sql}))"
+    return f"""
+            last_msg_text = CASE WHEN {is_last} THEN %(preview)s ELSE last_msg_text END,
+            last_msg_sender = CASE WHEN {is_last} THEN %(sender)s ELSE last_msg_sender END,
+            last_msg_id = CASE WHEN {is_last} THEN {message_id_sql} ELSE last_msg_id END,
+            last_msg_at = CASE WHEN {is_last} THEN %(at)s ELSE last_msg_at END"""
+
+def update_topic_summary(cur, topic_id, message_id, preview, sender_name, created_at, inserted):
+    '''Сводка топика при вставке или правке: число сообщений и последнее сообщение'''
+    cur.execute(f"""
+        UPDATE topics SET
+            message_count = message_count + %(added)s,{topic_summary_set('%(id)s')}
+        WHERE id = %(topic_id)s
+    """, {'added': 1 if inserted else 0, 'preview': preview, 'sender': sender_name,
+          'id': message_id, 'at': created_at, 'topic_id': topic_id})
+
+def remove_from_topic_summary(cur, topic_id, message_id):
+    '''Сводка топика после удаления сообщения; последнее ищется заново по индексу
+    (topic_id, created_at), только если удалили именно его'''
+    cur.execute(
+        "UPDATE topics SET message_count = GREATEST(message_count - 1, 0) WHERE id = %s RETURNING last_msg_id",
+        (topic_id,)
+    )
+    row = cur.fetchone()
+    if not row or row['last_msg_id'] != message_id:
+        return
+    cur.execute("""
+        UPDATE topics t SET (last_msg_id, last_msg_text, last_msg_sender, last_msg_at) = (
+            SELECT m.id,
+                   COALESCE(NULLIF(m.text, ''), CASE WHEN EXISTS (
+                       SELECT 1 FROM attachments a WHERE a.message_id = m.id
+                   ) THEN '[Изображение]' ELSE '' END),
+                   m.sender_name, m.created_at
+            FROM messages m
+            WHERE m.topic_id = t.id
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT 1
+        )
+        WHERE t.id = %s
+    """, (topic_id,))
+
+MESSAGE_FIELDS = (
+    'id', 'chat_id', 'topic_id', 'sender_id', 'sender_name', 'text', 'created_at',
+    'reply_to_id', 'reply_to_sender', 'reply_to_text',
+    'forwarded_from_id', 'forwarded_from_sender', 'forwarded_from_text',
+    'forwarded_from_date', 'forwarded_from_chat_name', 'content_hash',
+)
+
+def message_content_hash(m, attachments):
+    '''sha256 всего содержимого сообщения, кроме времени отправки: повтор того же запроса даёт тот же хэш.
+    Вложения хэшируются в том виде, в каком пришли (data:-URL до загрузки в S3).'''
+    content = [m.get(field) for field in MESSAGE_FIELDS if field not in ('id', 'created_at', 'content_hash')]
+    content.append([[att.get('type'), att.get('fileUrl'), att.get('fileName'), att.get('fileSize')] for att in attachments])
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False, default=str).encode()).hexdigest()
+
+MENTION_RE = re.compile(r'@\[([^\]]+)\]')
+MENTION_ROLE_SUFFIX_RE = re.compile(r' \([^()]*\)$')
+
+def parse_mentions(text):
+    '''Упоминания @[Имя], @[Имя (роль)] и @[админ] — все админы.
+
+    Возвращает метки как пары (метка целиком, метка без суффикса « (роль)») и роли:
+    скобки в конце могут быть и частью имени, например «Иванова (Петрова)».
+    '''
+    labels, roles = {}, set()
+    for label in MENTION_RE.findall(text or ''):
+        if label.startswith('админ'):
+            roles.add('admin')
+        else:
+            label = label.strip()
+            labels[label] = MENTION_ROLE_SUFFIX_RE.sub('', label).strip()
+    return list(labels.items()), roles
+
+def write_mentions(cur, message_id, chat_id, topic_id, text, replace=False):
+    '''Записывает упоминания сообщения в message_mentions; имена ищутся среди участников чата:
+    сначала по метке целиком, и только если такого имени нет — по метке без суффикса роли.
+
+    replace=True — правка: прежние упоминания удаляются и возвращаются как (user_ids, roles)
+    для пересчёта счётчиков упоминаний.
+    '''
+    previous = ([], [])
+    if replace:
+        cur.execute("DELETE FROM message_mentions WHERE message_id = %s RETURNING user_id, role", (message_id,))
+        rows = cur.fetchall()
+        previous = ([r['user_id'] for r in rows if r['user_id']], [r['role'] for r in rows if r['role']])
+    labels, roles = parse_mentions(text)
+    if labels:
+        cur.execute("""
+            WITH members AS (
+                SELECT u.id, u.name FROM chat_participants cp
+                JOIN users u ON u.id = cp.user_id
+                WHERE cp.chat_id = %s
+            )
+            INSERT INTO message_mentions (message_id, chat_id, topic_id, user_id)
+            SELECT %s, %s, %s, members.id
+            FROM unnest(%s::text[], %s::text[]) AS l(label, stripped)
+            JOIN members ON members.name = l.label
+                OR (members.name = l.stripped AND NOT EXISTS (SELECT 1 FROM members full_match WHERE full_match.name = l.label))
+            ON CONFLICT DO NOTHING
+        """, (chat_id, message_id, chat_id, topic_id,
+              [label for label, _ in labels], [stripped for _, stripped in labels]))
+    for role in roles:
+        cur.execute("""
+            INSERT INTO message_mentions (message_id, chat_id, topic_id, role)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
+        """, (message_id, chat_id, topic_id, role))
+    return previous
+
+# Строки счётчиков блокируются в порядке user_id — параллельные вставки в один чат не дают дедлоков
+UNREAD_INCREMENT = """
+    INSERT INTO unread_counters (user_id, chat_id, topic_key, unread, unread_mentions)
+    SELECT cp.user_id, cp.chat_id, %(topic_key)s, 1,
+           (EXISTS (
+               SELECT 1 FROM message_mentions mm
+               WHERE mm.message_id = %(message_id)s AND (mm.user_id = cp.user_id OR mm.role = u.role)
+           ))::int
+    FROM chat_participants cp
+    LEFT JOIN users u ON u.id = cp.user_id
+    WHERE cp.chat_id = %(chat_id)s AND cp.user_id != %(sender_id)s
+      AND NOT EXISTS (SELECT 1 FROM topic_hidden_roles h WHERE h.kind = %(topic_kind)s AND h.role = u.role)
+    ORDER BY cp.user_id
+    ON CONFLICT (user_id, chat_id, topic_key) DO UPDATE
+    SET unread = unread_counters.unread + 1,
+        unread_mentions = unread_counters.unread_mentions + EXCLUDED.unread_mentions,
+        change_xid = txid_current()
+"""
+
+# Удаляемое сообщение вычитается у тех, для кого оно лежит выше отметки прочтения
+UNREAD_DECREMENT = """
+    UPDATE unread_counters uc
+    SET unread = GREATEST(uc.unread - 1, 0),
+        unread_mentions = GREATEST(uc.unread_mentions - (EXISTS (
+            SELECT 1 FROM message_mentions mm
+            JOIN users u ON u.id = uc.user_id
+            WHERE mm.message_id = %(message_id)s AND (mm.user_id = uc.user_id OR mm.role = u.role)
+        ))::int, 0),
+        change_xid = txid_current()
+    FROM chat_participants cp
+    LEFT JOIN read_watermarks w
+        ON w.user_id = cp.user_id AND w.chat_id = cp.chat_id AND w.topic_key = %(topic_key)s
+    WHERE uc.chat_id = %(chat_id)s AND uc.topic_key = %(topic_key)s
+      AND cp.chat_id = uc.chat_id AND cp.user_id = uc.user_id
+      AND uc.user_id != %(sender_id)s
+      AND (%(created_at)s::timestamp, %(message_id)s::text)
+          > (COALESCE(w.last_read_at, cp.joined_at, '-infinity'::timestamp), COALESCE(w.last_read_id, ''))
+"""
+
+# Пересчёт счётчика треда от отметки прочтения. Вызывается под блокировкой строки счётчика
+# (SELECT ... FOR UPDATE отдельным запросом): снимок берётся после неё, поэтому сообщение,
+# чья транзакция уже увеличила счётчик, здесь видно и не теряется
+UNREAD_RECOUNT = """
+    WITH fresh AS (
+        SELECT COUNT(*) as unread,
+               COUNT(*) FILTER (WHERE EXISTS (
+                   SELECT 1 FROM message_mentions mm
+                   WHERE mm.message_id = m.id AND (mm.user_id = %(user_id)s OR mm.role = u.role)
+               )) as unread_mentions
+        FROM read_watermarks w
+        JOIN messages m ON m.chat_id = w.chat_id AND COALESCE(m.topic_id, '') = w.topic_key
+        LEFT JOIN users u ON u.id = w.user_id
+        WHERE w.user_id = %(user_id)s AND w.chat_id = %(chat_id)s AND w.topic_key = %(topic_key)s
+          AND m.sender_id != %(user_id)s
+          AND (m.created_at, m.id) > (w.last_read_at, w.last_read_id)
+    )
+    UPDATE unread_counters uc
+    SET unread = fresh.unread, unread_mentions = fresh.unread_mentions, change_xid = txid_current()
+    FROM fresh
+    WHERE uc.user_id = %(user_id)s AND uc.chat_id = %(chat_id)s AND uc.topic_key = %(topic_key)s
+      AND (uc.unread, uc.unread_mentions) IS DISTINCT FROM (fresh.unread, fresh.unread_mentions)
+"""
+
+# Правка сообщения добавила или убрала упоминание: поправка unread_mentions у тех, для кого
+# сообщение ещё не прочитано. Прежние упоминания — из write_mentions(replace=True), новые уже записаны
+UNREAD_MENTIONS_DELTA = """
+    UPDATE unread_counters uc
+    SET unread_mentions = GREATEST(uc.unread_mentions + d.delta, 0), change_xid = txid_current()
+    FROM (
+        SELECT cp.user_id,
+               (EXISTS (
+                   SELECT 1 FROM message_mentions mm
+                   WHERE mm.message_id = %(message_id)s AND (mm.user_id = cp.user_id OR mm.role = u.role)
+               ))::int
+               - (cp.user_id = ANY(%(old_user_ids)s::text[]) OR COALESCE(u.role = ANY(%(old_roles)s::text[]), false))::int
+               AS delta
+        FROM chat_participants cp
+        LEFT JOIN users u ON u.id = cp.user_id
+        LEFT JOIN read_watermarks w
+            ON w.user_id = cp.user_id AND w.chat_id = cp.chat_id AND w.topic_key = %(topic_key)s
+        WHERE cp.chat_id = %(chat_id)s AND cp.user_id != %(sender_id)s
+          AND (%(created_at)s::timestamp, %(message_id)s::text)
+              > (COALESCE(w.last_read_at, cp.joined_at, '-infinity'::timestamp), COALESCE(w.last_read_id, ''))
+    ) d
+    WHERE uc.user_id = d.user_id AND uc.chat_id = %(chat_id)s AND uc.topic_key = %(topic_key)s AND d.delta != 0
+"""
+
+def count_unread(cur, message_id, chat_id, topic_id, topic_kind, sender_id):
+    '''+1 к непрочитанному у участников, которым виден тред; упоминания читаются из message_mentions'''
+    cur.execute(UNREAD_INCREMENT, {
+        'message_id': message_id, 'chat_id': chat_id, 'topic_key': topic_id or '',
+        'sender_id': sender_id, 'topic_kind': topic_kind,
+    })
+
+def insert_message(cur, m, attachments, file_urls):
+    '''Вставляет сообщение со всем, что пишется вместе с ним: кэш последнего сообщения чата,
+    версии треда, вложения и задание push_outbox (только для нового сообщения, не для правки).
+    Транзакцию и NOTIFY оставляет вызывающему.
+
+    m — {поле из MESSAGE_FIELDS: значение}, created_at=None — время сервера.
+    Возвращает None, если сообщение с этим id и этим content_hash уже сохранено, —
+    тогда ничего не пишется и push не ставится.
+    '''
+    message_id, chat_id, topic_id = m['id'], m['chat_id'], m['topic_id']
+    cur.execute("""
+        INSERT INTO messages (id, chat_id, topic_id, sender_id, sender_name, text, created_at,
+            reply_to_id, reply_to_sender, reply_to_text,
+            forwarded_from_id, forwarded_from_sender, forwarded_from_text,
+            forwarded_from_date, forwarded_from_chat_name, content_hash, topic_kind)
+        VALUES (%s, %s, %s, %s, %s, %s, COALESCE(%s::timestamp, NOW()), %s, %s, %s, %s, %s, %s, %s, %s, %s,
+            """ + TOPIC_KIND_SQL + """)
+        ON CONFLICT (id) DO UPDATE SET text = EXCLUDED.text, content_hash = EXCLUDED.content_hash,
+            change_xid = txid_current()
+        WHERE messages.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+        RETURNING id, created_at, topic_kind, (xmax = 0) AS inserted
+    """, tuple(m.get(field) for field in MESSAGE_FIELDS) + (topic_id, topic_id))
+    result = cur.fetchone()
+    if result is None:
+        return None
+    # Новое сообщение — только вставка упоминаний, правка текста — пересборка и поправка счётчиков упоминаний
+    old_user_ids, old_roles = write_mentions(cur, message_id, chat_id, topic_id, m.get('text'),
+                                             replace=not result['inserted'])
+    if result['inserted']:
+        count_unread(cur, message_id, chat_id, topic_id, result['topic_kind'], m['sender_id'])
+    else:
+        cur.execute(UNREAD_MENTIONS_DELTA, {
+            'message_id': message_id, 'chat_id': chat_id, 'topic_key': topic_id or '',
+            'sender_id': m['sender_id'], 'created_at': result['created_at'],
+            'old_user_ids': old_user_ids, 'old_roles': old_roles,
+        })
+
+    # Обновляем кэш последнего сообщения в таблице chats
+    cache_text = m.get('text') or ('[Изображение]' if attachments else '')
+    cur.execute("""
+        UPDATE chats SET last_msg_text = %s, last_msg_at = %s, last_msg_topic_id = %s
+        WHERE id = %s AND (last_msg_at IS NULL OR last_msg_at <= %s)
+    """, (cache_text, result['created_at'], topic_id, chat_id, result['created_at']))
+    if topic_id:
+        update_topic_summary(cur, topic_id, message_id, cache_text, m['sender_name'],
+                             result['created_at'], result['inserted'])
+    bump_thread_version(cur, chat_id, topic_id)
+
+    if attachments:
+        cur.execute("DELETE FROM attachments WHERE message_id = %s", (message_id,))
+    for i, (att, file_url) in enumerate(zip(attachments, file_urls)):
+        att_id = f"{message_id}-{i}"
+        cur.execute("""
+            INSERT INTO attachments (id, message_id, type, file_url, file_name, file_size, chat_id, topic_id, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (att_id, message_id, att.get('type'), file_url, att.get('fileName'), att.get('fileSize'),
+              chat_id, topic_id, result['created_at']))
+
+    # Правка текста уведомление не шлёт — иначе каждая опечатка будила бы получателей ещё раз
+    if not result['inserted']:
+        return result
+
+    # Уведомления доставляет backend/push-worker: задание коммитится вместе с сообщением.
+    # Если в тред недавно уже уходил push, задание ждёт конца окна и уйдёт одной сводкой.
+    cur.execute("""
+        INSERT INTO push_outbox (message_id, chat_id, topic_id, topic_kind, sender_id, sender_name, text, next_attempt_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, GREATEST(NOW(), (
+            SELECT last_push_at + make_interval(secs => %s) FROM push_coalesce
+            WHERE chat_id = %s AND topic_key = %s
+        )))
+    """, (message_id, chat_id, topic_id, result['topic_kind'], m['sender_id'], m['sender_name'], m.get('text'),
+          PUSH_COALESCE_SECONDS, chat_id, topic_id or ''))
+    return result
+
+SCHEDULED_SELECT = """
+    SELECT id, chat_id, topic_id, sender_id, sender_name, text, attachments::text AS attachments,
+           reply_to_id, reply_to_sender, reply_to_text, scheduled_at, created_at
+    FROM scheduled_messages
+"""
+SCHEDULED_COLUMN_KINDS = {'scheduled_at': TIMESTAMP, 'created_at': TIMESTAMP, 'attachments': RAW}
+MAX_SCHEDULE_AHEAD_DAYS = 365
+DISPATCH_BATCH_SIZE = 50
+DISPATCH_SECONDS = 20
+
+def dispatch_scheduled(conn, deadline):
+    '''Публикует наступившие отложенные сообщения пачками по DISPATCH_BATCH_SIZE.
+
+    Пачка забирается FOR UPDATE SKIP LOCKED и публикуется в той же транзакции, что и смена
+    статуса: параллельный диспетчер пропускает занятые строки, а при сбое откат возвращает
+    их в pending. Сообщение, которое не удалось вставить, помечается failed и не мешает остальным.
+    Возвращает счётчики и id отправленных/неудавшихся — вкладка по ним подтверждает своё сообщение.
+    '''
+    stats = {'sent': 0, 'failed': 0, 'batches': 0, 'sentIds': [], 'failedIds': []}
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    while time.time() < deadline:
+        cur.execute("""
+            SELECT * FROM scheduled_messages
+            WHERE status = 'pending' AND scheduled_at <= NOW()
+            ORDER BY scheduled_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (DISPATCH_BATCH_SIZE,))
+        batch = cur.fetchall()
+        if not batch:
+            conn.rollback()
+            break
+
+        sent, failed = [], []
+        for row in batch:
+            attachments = row['attachments'] or []
+            m = {field: row.get(field) for field in MESSAGE_FIELDS}
+            m['created_at'] = None
+            m['content_hash'] = message_content_hash(m, attachments)
+            cur.execute("SAVEPOINT scheduled_message")
+            try:
+                insert_message(cur, m, attachments, [att.get('fileUrl') for att in attachments])
+                cur.execute("RELEASE SAVEPOINT scheduled_message")
+                sent.append(row['id'])
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT scheduled_message")
+                log(f"[Scheduled] {row['id']} failed: {e}")
+                failed.append((row['id'], str(e)[:500]))
+
+        if sent:
+            cur.execute("UPDATE scheduled_messages SET status = 'sent', sent_at = NOW() WHERE id = ANY(%s)", (sent,))
+            cur.execute("NOTIFY push_outbox")
+        for scheduled_id, error in failed:
+            cur.execute("UPDATE scheduled_messages SET status = 'failed', last_error = %s WHERE id = %s",
+                        (error, scheduled_id))
+        conn.commit()
+
+        stats['sent'] += len(sent)
+        stats['failed'] += len(failed)
+        stats['batches'] += 1
+        stats['sentIds'] += sent
+        stats['failedIds'] += [scheduled_id for scheduled_id, _ in failed]
+        if len(batch) < DISPATCH_BATCH_SIZE:
+            break
+    cur.close()
+    log(f"[Scheduled] dispatched: sent={stats['sent']} failed={stats['failed']} batches={stats['batches']}")
+    return stats
+
 def handler(event: dict, context) -> dict:
-    '''API для работы с сообщениями и отправки push-уведомлений'''
+    '''API для работы с сообщениями; push-уведомления ставятся в очередь push_outbox'''
+    if 'httpMethod' not in event:
+        # Вызов триггером-таймером (раз в минуту, см. README): рассылка наступивших отложенных сообщений
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            stats = dispatch_scheduled(conn, time.time() + DISPATCH_SECONDS)
+        finally:
+            conn.close()
+        return {'statusCode': 200, 'body': json.dumps(stats)}
+
     method = event.get('httpMethod', 'GET')
 
     if method == 'OPTIONS':
@@ -46,7 +671,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, PATCH, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, If-None-Match'
             },
             'body': ''
         }
@@ -61,6 +686,93 @@ def handler(event: dict, context) -> dict:
             chat_id = params.get('chatId')
             topic_id = params.get('topicId')
 
+            search_query = params.get('q')
+            if search_query is not None:
+                # Полнотекстовый поиск по чатам пользователя, результаты по убыванию релевантности
+                headers = event.get('headers', {}) or {}
+                user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+                search_query = search_query.strip()
+                try:
+                    limit = min(max(int(params.get('limit') or DEFAULT_SEARCH_LIMIT), 1), MAX_SEARCH_LIMIT)
+                    cursor = decode_search_cursor(params['cursor']) if params.get('cursor') else None
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Invalid limit or cursor'})
+                    }
+                if not user_id or len(search_query) < MIN_SEARCH_QUERY:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'X-User-Id header and q of at least {MIN_SEARCH_QUERY} characters are required'})
+                    }
+
+                cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
+                role_row = cur.fetchone()
+                where_clause, where_params = topic_access_clause(role_row['role'] if role_row else '')
+                if chat_id:
+                    where_clause += " AND m.chat_id = %s"
+                    where_params.append(chat_id)
+                if topic_id:
+                    where_clause += " AND m.topic_id = %s"
+                    where_params.append(topic_id)
+                cursor_clause, cursor_params = "TRUE", []
+                if cursor:
+                    cursor_clause = "(rank, created_at, id) < (%s::real, %s::timestamp, %s)"
+                    cursor_params = list(cursor)
+
+                rows_cur = conn.cursor()
+                rows_cur.execute(
+                    SEARCH_SELECT.format(where=where_clause, cursor=cursor_clause),
+                    [search_query, user_id] + where_params + cursor_params + [limit + 1]
+                )
+                results = rows_cur.fetchall()
+                encoder = RowEncoder(rows_cur.description)
+                rows_cur.close()
+                cur.close()
+                conn.close()
+
+                next_cursor = None
+                if len(results) > limit:
+                    results = results[:limit]
+                    last = results[-1]
+                    next_cursor = encode_search_cursor(
+                        last[encoder.index('rank')], last[encoder.index('created_at')], last[encoder.index('id')]
+                    )
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'results': encoder.encode_rows(results), 'nextCursor': next_cursor})
+                }
+
+            if params.get('view') == 'scheduled':
+                # Неотправленные отложенные сообщения пользователя (по всем чатам или по одному)
+                headers = event.get('headers', {}) or {}
+                user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+                if not user_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'X-User-Id header is required'})
+                    }
+                where, where_params = "sender_id = %s AND status = 'pending'", [user_id]
+                if chat_id:
+                    where += " AND chat_id = %s"
+                    where_params.append(chat_id)
+                rows_cur = conn.cursor()
+                rows_cur.execute(SCHEDULED_SELECT + " WHERE " + where + " ORDER BY scheduled_at", where_params)
+                rows = rows_cur.fetchall()
+                encoder = RowEncoder(rows_cur.description, SCHEDULED_COLUMN_KINDS)
+                rows_cur.close()
+                cur.close()
+                conn.close()
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'scheduled': encoder.encode_rows(rows)})
+                }
+
             if not chat_id:
                 return {
                     'statusCode': 400,
@@ -68,76 +780,480 @@ def handler(event: dict, context) -> dict:
                     'body': json.dumps({'error': 'chatId is required'})
                 }
 
+            if params.get('view') == 'media':
+                # Файлы и фото чата или топика для боковой панели: только из чатов пользователя
+                # и только из топиков, видимых его роли
+                headers = event.get('headers', {}) or {}
+                user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+                if not user_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'X-User-Id header is required'})
+                    }
+                media_type = params.get('type')
+                try:
+                    limit = min(max(int(params.get('limit') or DEFAULT_MEDIA_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+                    before = decode_cursor(params['before']) if params.get('before') else None
+                    if media_type and media_type not in MEDIA_TYPES:
+                        raise ValueError(f"Invalid type: {media_type}")
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Invalid limit, cursor or type'})
+                    }
+
+                cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
+                role_row = cur.fetchone()
+                access_clause, access_params = topic_access_clause(role_row['role'] if role_row else '')
+
+                where_clause = "a.topic_id = %s" if topic_id else "a.chat_id = %s"
+                query_params = [topic_id if topic_id else chat_id]
+                where_clause += " AND a.chat_id IN (SELECT chat_id FROM chat_participants WHERE user_id = %s) AND " + access_clause
+                query_params += [user_id] + access_params
+                if media_type:
+                    where_clause += " AND a.type = %s"
+                    query_params.append(media_type)
+                if before:
+                    where_clause += " AND (a.created_at, a.id) < (%s::timestamp, %s)"
+                    query_params.extend(before)
+                query_params.append(limit + 1)
+
+                rows_cur = conn.cursor()
+                rows_cur.execute(MEDIA_SELECT.format(where=where_clause), query_params)
+                items = rows_cur.fetchall()
+                encoder = RowEncoder(rows_cur.description)
+                rows_cur.close()
+                cur.close()
+                conn.close()
+
+                next_cursor = None
+                if len(items) > limit:
+                    items = items[:limit]
+                    last = items[-1]
+                    next_cursor = encode_cursor(last[encoder.index('created_at')], last[encoder.index('id')])
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'items': encoder.encode_rows(items), 'nextCursor': next_cursor})
+                }
+
+            export_format = params.get('export')
+            if export_format:
+                # Выгрузка истории для админов: NDJSON или CSV частями по EXPORT_CHUNK_ROWS,
+                # следующая часть запрашивается с after из заголовка X-Export-Cursor
+                headers = event.get('headers', {}) or {}
+                user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+                if export_format not in ('ndjson', 'csv'):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'export must be ndjson or csv'})
+                    }
+                try:
+                    after = decode_cursor(params['after']) if params.get('after') else None
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Invalid cursor'})
+                    }
+                cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
+                role_row = cur.fetchone()
+                if not role_row or role_row['role'] not in EXPORT_ROLES:
+                    cur.close()
+                    conn.close()
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Export is available to admins only'})
+                    }
+
+                # Без topicId выгружается весь чат вместе с топиками
+                where_clause = "m.topic_id = %s" if topic_id else "m.chat_id = %s"
+                query_params = [topic_id if topic_id else chat_id]
+                if after:
+                    where_clause += " AND (m.created_at, m.id) > (%s::timestamp, %s)"
+                    query_params.extend(after)
+
+                body, resume, count = export_messages(conn, where_clause, query_params, export_format)
+                cur.close()
+                conn.close()
+                log(f"[Export] chat={chat_id} topic={topic_id} format={export_format} rows={count} more={bool(resume)}")
+
+                response_headers = {
+                    'Content-Type': 'text/csv; charset=utf-8' if export_format == 'csv' else 'application/x-ndjson',
+                    'Access-Control-Allow-Origin': '*',
+                    'Access-Control-Expose-Headers': 'X-Export-Cursor'
+                }
+                if resume:
+                    response_headers['X-Export-Cursor'] = resume
+                return {'statusCode': 200, 'headers': response_headers, 'body': body}
+
+            try:
+                limit = min(max(int(params.get('limit') or DEFAULT_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+                before = decode_cursor(params['before']) if params.get('before') else None
+                after = decode_cursor(params['after']) if params.get('after') else None
+                since = decode_since_token(params['since']) if params.get('since') else None
+            except ValueError:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid limit, cursor or since token'})
+                }
+
+            # Версия треда читается до данных: если запись успеет закоммититься
+            # между запросами, клиент получит лишний 200, но не пропустит изменение
+            if topic_id:
+                cur.execute("SELECT version FROM topics WHERE id = %s", (topic_id,))
+            else:
+                cur.execute("SELECT version FROM chats WHERE id = %s", (chat_id,))
+            version_row = cur.fetchone()
+            etag = f'W/"{topic_id or chat_id}:{version_row["version"]}"' if version_row else None
+            headers = event.get('headers', {}) or {}
+            if etag and (headers.get('if-none-match') or headers.get('If-None-Match')) == etag:
+                cur.close()
+                conn.close()
+                return {
+                    'statusCode': 304,
+                    'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'},
+                    'body': ''
+                }
+            response_headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'}
+            if etag:
+                response_headers['ETag'] = etag
+
             where_clause = "m.topic_id = %s" if topic_id else "m.chat_id = %s AND m.topic_id IS NULL"
-            filter_val = topic_id if topic_id else chat_id
+            query_params = [topic_id if topic_id else chat_id]
+
+            # Токен для delta-синхронизации берём до чтения: всё, что закоммичено
+            # транзакциями с xid < xmin, точно попадёт в этот ответ
+            cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) as xmin, EXTRACT(EPOCH FROM NOW())::bigint as ts")
+            snapshot = cur.fetchone()
+            next_token = f"{snapshot['xmin']}.{snapshot['ts']}"
+
+            if since:
+                since_xmin, since_ts = since
+                if snapshot['ts'] - since_ts > TOMBSTONE_RETENTION_DAYS * 86400:
+                    cur.close()
+                    conn.close()
+                    return {
+                        'statusCode': 200,
+                        'headers': response_headers,
+                        'body': json.dumps({'messages': [], 'deleted': [], 'reset': True, 'sinceToken': next_token})
+                    }
+
+                # Delta: только сообщения, изменённые транзакциями начиная с since_xmin.
+                # Для простаивающего топика это пустой проход по индексу (topic_id, change_xid).
+                rows_cur = conn.cursor()
+                rows_cur.execute(
+                    MESSAGES_SELECT.format(where=where_clause + " AND m.change_xid >= %s", order="ASC"),
+                    query_params + [since_xmin, MAX_PAGE_SIZE + 1]
+                )
+                messages = rows_cur.fetchall()
+                encoder = RowEncoder(rows_cur.description, MESSAGE_COLUMN_KINDS)
+                rows_cur.close()
+
+                tombstone_where = "topic_id = %s" if topic_id else "chat_id = %s AND topic_id IS NULL"
+                cur.execute(
+                    "SELECT message_id FROM message_tombstones WHERE " + tombstone_where + " AND deleted_xid >= %s",
+                    query_params + [since_xmin]
+                )
+                deleted_ids = [r['message_id'] for r in cur.fetchall()]
+
+                cur.close()
+                conn.close()
+
+                if len(messages) > MAX_PAGE_SIZE:
+                    # Слишком много изменений — клиенту проще перечитать последнюю страницу
+                    body = {'messages': [], 'deleted': [], 'reset': True, 'sinceToken': next_token}
+                else:
+                    body = {
+                        'messages': encoder.encode_rows(messages),
+                        'deleted': deleted_ids,
+                        'sinceToken': next_token
+                    }
+                return {
+                    'statusCode': 200,
+                    'headers': response_headers,
+                    'body': dumps(body)
+                }
+
+            # Keyset-пагинация по (created_at, id): идём по индексам
+            # idx_messages_topic_created / idx_messages_chat_created, без OFFSET.
+            # after — догружаем новые (по возрастанию), иначе — страница
+            # перед курсором before (или самая свежая) по убыванию.
+            if after:
+                where_clause += " AND (m.created_at, m.id) > (%s::timestamp, %s)"
+                query_params.extend(after)
+                order = "ASC"
+            else:
+                if before:
+                    where_clause += " AND (m.created_at, m.id) < (%s::timestamp, %s)"
+                    query_params.extend(before)
+                order = "DESC"
+            query_params.append(limit + 1)
+
+            rows_cur = conn.cursor()
+            rows_cur.execute(MESSAGES_SELECT.format(where=where_clause, order=order), query_params)
+
+            messages = rows_cur.fetchall()
+            encoder = RowEncoder(rows_cur.description, MESSAGE_COLUMN_KINDS)
+            rows_cur.close()
+            has_more = len(messages) > limit
+            if has_more:
+                # Лишняя строка — признак того, что за страницей есть ещё сообщения
+                messages = messages[:limit] if after else messages[1:]
 
-            cur.execute("""
-                SELECT m.id, m.text, m.sender_id, m.sender_name, m.created_at,
-                       m.reply_to_id, m.reply_to_sender, m.reply_to_text,
-                       m.forwarded_from_id, m.forwarded_from_sender, m.forwarded_from_text,
-                       m.forwarded_from_date, m.forwarded_from_chat_name,
-                       att.attachments,
-                       rct.reactions
-                FROM messages m
-                LEFT JOIN LATERAL (
-                    SELECT COALESCE(ARRAY_AGG(DISTINCT jsonb_build_object(
-                        'type', a.type, 'fileUrl', a.file_url,
-                        'fileName', a.file_name, 'fileSize', a.file_size
-                    )) FILTER (WHERE a.id IS NOT NULL), ARRAY[]::jsonb[]) as attachments
-                    FROM attachments a WHERE a.message_id = m.id
-                ) att ON true
-                LEFT JOIN LATERAL (
-                    SELECT ARRAY_AGG(jsonb_build_object(
-                        'emoji', rg.emoji, 'count', rg.cnt, 'users', rg.user_names
-                    )) as reactions
-                    FROM (
-                        SELECT r.emoji, COUNT(*) as cnt,
-                               ARRAY_AGG(u.name) as user_names
-                        FROM reactions r
-                        LEFT JOIN users u ON u.id = r.user_id
-                        WHERE r.message_id = m.id
-                        GROUP BY r.emoji
-                    ) rg
-                ) rct ON true
-                WHERE """ + where_clause + """
-                ORDER BY m.created_at ASC
-            """, (filter_val,))
-
-            messages = cur.fetchall()
-            
             cur.close()
             conn.close()
 
-            def serialize_message(m):
-                d = dict(m)
-                if d.get('created_at'):
-                    ts = str(d['created_at'])
-                    if not ts.endswith('Z') and '+' not in ts:
-                        ts = ts + 'Z'
-                    d['created_at'] = ts
-                if d.get('attachments'):
-                    cleaned = []
-                    for att in d['attachments']:
-                        if att and isinstance(att, dict):
-                            url = att.get('fileUrl') or ''
-                            if url.startswith('data:'):
-                                att = dict(att)
-                                att['fileUrl'] = None
-                            cleaned.append(att)
-                    d['attachments'] = cleaned if cleaned else None
-                return d
+            id_idx, created_idx = encoder.index('id'), encoder.index('created_at')
+            first, last = (messages[0], messages[-1]) if messages else (None, None)
 
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'messages': [serialize_message(m) for m in messages]
-                }, default=str)
+                'headers': response_headers,
+                'body': dumps({
+                    'messages': encoder.encode_rows(messages),
+                    'prevCursor': encode_cursor(first[created_idx], first[id_idx]) if first and (has_more or after) else None,
+                    'nextCursor': encode_cursor(last[created_idx], last[id_idx]) if last else (params.get('after') or None),
+                    'hasMore': has_more,
+                    'sinceToken': next_token
+                })
             }
 
         elif method == 'POST':
             # Отправить новое сообщение
             data = json.loads(event.get('body', '{}'))
+
+            if data.get('action') == 'schedule':
+                # Отложенное сообщение: файлы загружаются сейчас, отправит dispatch_scheduled
+                scheduled_id = data.get('id')
+                chat_id = data.get('chatId')
+                topic_id = data.get('topicId')
+                sender_id = data.get('senderId')
+                sender_name = data.get('senderName')
+                text = data.get('text')
+                attachments = data.get('attachments') or []
+
+                try:
+                    scheduled_at = datetime.fromisoformat(data['scheduledAt'].replace('Z', '+00:00'))
+                except (KeyError, AttributeError, ValueError):
+                    scheduled_at = None
+                if scheduled_at and scheduled_at.tzinfo:
+                    scheduled_at = scheduled_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+                if not scheduled_id or not chat_id or not sender_id or not sender_name or not (text or attachments) or not scheduled_at:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'id, chatId, senderId, senderName, scheduledAt and text or attachments are required'})
+                    }
+                if scheduled_at > datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(days=MAX_SCHEDULE_AHEAD_DAYS):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'scheduledAt must be within {MAX_SCHEDULE_AHEAD_DAYS} days'})
+                    }
+                if topic_id and payment_send_forbidden(cur, sender_id, [topic_id]):
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Педагогам недоступна отправка сообщений в раздел «Оплата»'})
+                    }
+
+                # Завершаем транзакцию проверок: соединение не должно простаивать в транзакции на время загрузок в S3
+                conn.rollback()
+                file_urls = upload_attachments(attachments)
+                stored_attachments = [
+                    {'type': att.get('type'), 'fileUrl': url, 'fileName': att.get('fileName'), 'fileSize': att.get('fileSize')}
+                    for att, url in zip(attachments, file_urls)
+                ]
+                # Повтор того же запроса обновляет ещё не отправленную строку, отправленную не трогает
+                cur.execute("""
+                    INSERT INTO scheduled_messages (id, chat_id, topic_id, sender_id, sender_name, text, attachments,
+                        reply_to_id, reply_to_sender, reply_to_text, scheduled_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (id) DO UPDATE SET text = EXCLUDED.text, attachments = EXCLUDED.attachments,
+                        scheduled_at = EXCLUDED.scheduled_at
+                    WHERE scheduled_messages.status = 'pending' AND scheduled_messages.sender_id = EXCLUDED.sender_id
+                    RETURNING id, scheduled_at
+                """, (scheduled_id, chat_id, topic_id, sender_id, sender_name, text,
+                      json.dumps(stored_attachments) if stored_attachments else None,
+                      data.get('replyToId'), data.get('replyToSender'), data.get('replyToText'), scheduled_at))
+                result = cur.fetchone()
+                conn.commit()
+                cur.close()
+                conn.close()
+
+                if not result:
+                    return {
+                        'statusCode': 409,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Scheduled message was already sent or cancelled'})
+                    }
+                return {
+                    'statusCode': 201,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'scheduled': {'id': result['id'], 'scheduledAt': result['scheduled_at']}})
+                }
+
+            if data.get('action') == 'cancel_scheduled':
+                headers = event.get('headers', {}) or {}
+                user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+                scheduled_id = data.get('id')
+                if not user_id or not scheduled_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'X-User-Id header and id are required'})
+                    }
+
+                # Если строку прямо сейчас публикует диспетчер, UPDATE дождётся его коммита
+                # и уже не найдёт её в pending
+                cur.execute("""
+                    UPDATE scheduled_messages SET status = 'cancelled'
+                    WHERE id = %s AND sender_id = %s AND status = 'pending'
+                    RETURNING id
+                """, (scheduled_id, user_id))
+                cancelled = cur.fetchone()
+                conn.commit()
+                cur.close()
+                conn.close()
+
+                if not cancelled:
+                    return {
+                        'statusCode': 409,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Scheduled message was already sent or cancelled'})
+                    }
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'ok': True})
+                }
+
+            if data.get('action') == 'dispatch_scheduled':
+                # Вызывается по таймеру и из открытых вкладок в момент отправки — параллельные
+                # вызовы безопасны, каждый забирает только свободные строки
+                stats = dispatch_scheduled(conn, time.time() + DISPATCH_SECONDS)
+                cur.close()
+                conn.close()
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps(stats)
+                }
+
+            if data.get('action') == 'broadcast':
+                # Рассылка одного текста в топик с суффиксом topicSuffix каждой из групп groupIds:
+                # одна транзакция, многострочные вставки и одно задание push на всю рассылку
+                broadcast_id = data.get('broadcastId')
+                group_ids = list(dict.fromkeys(data.get('groupIds') or []))
+                topic_suffix = data.get('topicSuffix')
+                sender_id = data.get('senderId')
+                sender_name = data.get('senderName')
+                text = data.get('text')
+
+                if not broadcast_id or not group_ids or not topic_suffix or not sender_id or not sender_name or not text:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'broadcastId, groupIds, topicSuffix, senderId, senderName and text are required'})
+                    }
+                if len(group_ids) > MAX_BROADCAST_GROUPS:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'At most {MAX_BROADCAST_GROUPS} groups per broadcast'})
+                    }
+                if payment_send_forbidden(cur, sender_id, [f"{gid}-{topic_suffix}" for gid in group_ids]):
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Педагогам недоступна отправка сообщений в раздел «Оплата»'})
+                    }
+
+                # id сообщений выводятся из broadcastId — повтор запроса ничего не задублирует
+                created_at = data.get('createdAt')
+                rows = [
+                    (f"{broadcast_id}-{gid}", gid, f"{gid}-{topic_suffix}", sender_id, sender_name, text, created_at,
+                     f"{gid}-{topic_suffix}", f"{gid}-{topic_suffix}")
+                    for gid in group_ids
+                ]
+                inserted = execute_values(cur, """
+                    INSERT INTO messages (id, chat_id, topic_id, sender_id, sender_name, text, created_at, topic_kind)
+                    VALUES %s
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING id, chat_id, topic_id, topic_kind, created_at
+                """, rows, template="(%s, %s, %s, %s, %s, %s, COALESCE(%s::timestamp, NOW()), " + TOPIC_KIND_SQL + ")",
+                    page_size=len(rows), fetch=True)
+
+                if inserted:
+                    chat_ids = [r['chat_id'] for r in inserted]
+                    topic_ids = [r['topic_id'] for r in inserted]
+                    sent_at = inserted[0]['created_at']
+                    # Кэш последнего сообщения и версии всех групп — одним UPDATE
+                    cur.execute("""
+                        UPDATE chats SET
+                            last_msg_text = CASE WHEN last_msg_at IS NULL OR last_msg_at <= %(at)s THEN %(text)s ELSE last_msg_text END,
+                            last_msg_topic_id = CASE WHEN last_msg_at IS NULL OR last_msg_at <= %(at)s THEN id || '-' || %(suffix)s ELSE last_msg_topic_id END,
+                            last_msg_at = GREATEST(last_msg_at, %(at)s),
+                            version = version + 1,
+                            change_xid = txid_current()
+                        WHERE id = ANY(%(ids)s)
+                    """, {'at': sent_at, 'text': text, 'suffix': topic_suffix, 'ids': chat_ids})
+                    # Версии и сводки топиков: у каждой группы своё сообщение рассылки
+                    cur.execute(f"""
+                        UPDATE topics t SET
+                            version = version + 1,
+                            message_count = message_count + 1,{topic_summary_set('b.message_id')}
+                        FROM unnest(%(topic_ids)s::text[], %(message_ids)s::text[]) AS b(topic_id, message_id)
+                        WHERE t.id = b.topic_id
+                    """, {
+                        'at': sent_at, 'preview': text, 'sender': sender_name,
+                        'topic_ids': topic_ids, 'message_ids': [r['id'] for r in inserted],
+                    })
+                    for r in inserted:
+                        write_mentions(cur, r['id'], r['chat_id'], r['topic_id'], text)
+                        count_unread(cur, r['id'], r['chat_id'], r['topic_id'], r['topic_kind'], sender_id)
+
+                    # Одно задание на всю рассылку: воркер уберёт повторы подписок между группами
+                    cur.execute("""
+                        INSERT INTO push_outbox (message_id, chat_id, topic_id, topic_kind, sender_id, sender_name, text, broadcast)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """, (broadcast_id, chat_ids[0], topic_ids[0], inserted[0]['topic_kind'], sender_id, sender_name, text,
+                          json.dumps([{'messageId': r['id'], 'chatId': r['chat_id'], 'topicId': r['topic_id']} for r in inserted])))
+                    cur.execute("NOTIFY push_outbox")
+
+                # Повтор уже сохранённой рассылки отвечает тем же, что и первый запрос:
+                # сообщения, вставленные раньше, дочитываем по их id
+                message_ids = [row[0] for row in rows]
+                stored = {r['id']: r for r in inserted}
+                if len(stored) < len(message_ids):
+                    cur.execute("SELECT id, chat_id, topic_id, created_at FROM messages WHERE id = ANY(%s)",
+                                ([mid for mid in message_ids if mid not in stored],))
+                    stored.update((r['id'], r) for r in cur.fetchall())
+
+                conn.commit()
+                cur.close()
+                conn.close()
+
+                log(f"[Broadcast] {broadcast_id}: {len(inserted)} of {len(group_ids)} groups inserted")
+                return {
+                    'statusCode': 201,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'messages': [
+                            {'id': r['id'], 'chatId': r['chat_id'], 'topicId': r['topic_id'], 'createdAt': str(r['created_at'])}
+                            for r in (stored[mid] for mid in message_ids if mid in stored)
+                        ],
+                        'replayed': not inserted
+                    })
+                }
+
             message_id = data.get('id')
             chat_id = data.get('chatId')
             topic_id = data.get('topicId')
@@ -162,219 +1278,51 @@ def handler(event: dict, context) -> dict:
                     'body': json.dumps({'error': 'Missing required fields'})
                 }
 
-            if topic_id and topic_id.endswith('-payment') and sender_id:
-                cur.execute("SELECT role FROM users WHERE id = %s", (sender_id,))
-                sender_row = cur.fetchone()
-                if sender_row and sender_row['role'] == 'teacher':
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Педагогам недоступна отправка сообщений в раздел «Оплата»'})
-                    }
-
-            if created_at:
-                cur.execute("""
-                    INSERT INTO messages (id, chat_id, topic_id, sender_id, sender_name, text, created_at,
-                        reply_to_id, reply_to_sender, reply_to_text,
-                        forwarded_from_id, forwarded_from_sender, forwarded_from_text,
-                        forwarded_from_date, forwarded_from_chat_name)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (id) DO UPDATE SET text = EXCLUDED.text
-                    RETURNING id, created_at
-                """, (message_id, chat_id, topic_id, sender_id, sender_name, text, created_at,
-                      reply_to_id, reply_to_sender, reply_to_text,
-                      forwarded_from_id, forwarded_from_sender, forwarded_from_text,
-                      forwarded_from_date, forwarded_from_chat_name))
-            else:
-                cur.execute("""
-                    INSERT INTO messages (id, chat_id, topic_id, sender_id, sender_name, text, created_at,
-                        reply_to_id, reply_to_sender, reply_to_text,
-                        forwarded_from_id, forwarded_from_sender, forwarded_from_text,
-                        forwarded_from_date, forwarded_from_chat_name)
-                    VALUES (%s, %s, %s, %s, %s, %s, NOW(), %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (id) DO UPDATE SET text = EXCLUDED.text
-                    RETURNING id, created_at
-                """, (message_id, chat_id, topic_id, sender_id, sender_name, text,
-                      reply_to_id, reply_to_sender, reply_to_text,
-                      forwarded_from_id, forwarded_from_sender, forwarded_from_text,
-                      forwarded_from_date, forwarded_from_chat_name))
-            
-            result = cur.fetchone()
-
-            # Обновляем кэш последнего сообщения в таблице chats
-            cache_text = text or ('[Изображение]' if attachments else '')
-            cur.execute("""
-                UPDATE chats SET last_msg_text = %s, last_msg_at = %s, last_msg_topic_id = %s
-                WHERE id = %s AND (last_msg_at IS NULL OR last_msg_at <= %s)
-            """, (cache_text, result['created_at'], topic_id, chat_id, result['created_at']))
-
-            if attachments:
-                cur.execute("DELETE FROM attachments WHERE message_id = %s", (message_id,))
-            for i, att in enumerate(attachments):
-                att_id = f"{message_id}-{i}"
-                file_url = att.get('fileUrl')
-                if file_url and file_url.startswith('data:'):
-                    cdn_url = upload_base64_to_s3(file_url)
-                    if cdn_url:
-                        file_url = cdn_url
-                cur.execute("""
-                    INSERT INTO attachments (id, message_id, type, file_url, file_name, file_size)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (att_id, message_id, att.get('type'), file_url, att.get('fileName'), att.get('fileSize')))
-
-            conn.commit()
-
-            user_subs = []
-            lead_teacher_ids = set()
-            chat_type = 'group'
-            try:
-                cur2 = conn.cursor(cursor_factory=RealDictCursor)
-                cur2.execute("SELECT type FROM chats WHERE id = %s", (chat_id,))
-                chat_row = cur2.fetchone()
-                if chat_row:
-                    chat_type = chat_row['type']
-
-                cur2.execute("""
-                    SELECT DISTINCT cp.user_id FROM chat_participants cp
-                    WHERE cp.chat_id = %s AND cp.user_id != %s
-                """, (chat_id, sender_id))
-                participant_ids = [r['user_id'] for r in cur2.fetchall()]
-
-                cur2.execute(
-                    "SELECT user_id FROM chat_lead_teachers WHERE chat_id = %s",
-                    (chat_id,)
-                )
-                lead_teacher_ids = {r['user_id'] for r in cur2.fetchall()}
+            if topic_id and payment_send_forbidden(cur, sender_id, [topic_id]):
+                return {
+                    'statusCode': 403,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Педагогам недоступна отправка сообщений в раздел «Оплата»'})
+                }
 
-                if participant_ids:
-                    placeholders = ','.join(['%s'] * len(participant_ids))
-                    cur2.execute(
-                        "SELECT id, name, role FROM users WHERE id IN (%s)" % placeholders,
-                        participant_ids
-                    )
-                    users_map = {r['id']: r for r in cur2.fetchall()}
+            message = {
+                'id': message_id, 'chat_id': chat_id, 'topic_id': topic_id,
+                'sender_id': sender_id, 'sender_name': sender_name, 'text': text, 'created_at': created_at,
+                'reply_to_id': reply_to_id, 'reply_to_sender': reply_to_sender, 'reply_to_text': reply_to_text,
+                'forwarded_from_id': forwarded_from_id, 'forwarded_from_sender': forwarded_from_sender,
+                'forwarded_from_text': forwarded_from_text, 'forwarded_from_date': forwarded_from_date,
+                'forwarded_from_chat_name': forwarded_from_chat_name,
+            }
+            message['content_hash'] = message_content_hash(message, attachments)
 
-                    cur2.execute(
-                        "SELECT user_id, endpoint, p256dh, auth FROM push_subscriptions WHERE user_id IN (%s) AND endpoint LIKE 'https://%%%%'" % placeholders,
-                        participant_ids
-                    )
-                    user_subs = cur2.fetchall()
-
-                    for sub in user_subs:
-                        u = users_map.get(sub['user_id'])
-                        sub['user_name'] = u['name'] if u else None
-                        sub['user_role'] = u['role'] if u else None
-                cur2.close()
-            except Exception as e:
-                log(f"[Push] DB error: {e}")
-            finally:
-                if not conn.closed:
-                    conn.close()
+            # Клиент повторяет отправку с тем же id: если содержимое совпадает, сообщение
+            # уже сохранено — отвечаем сохранённым результатом без S3, вложений и push
+            cur.execute("SELECT id, created_at, content_hash FROM messages WHERE id = %s", (message_id,))
+            stored = cur.fetchone()
+            if stored is None or stored['content_hash'] != message['content_hash']:
+                # Загрузки в S3 — до вставки и вне транзакции проверок: соединение не простаивает
+                # в транзакции и не держит блокировку строки chats на время сетевых запросов
+                conn.rollback()
+                file_urls = upload_attachments(attachments)
+                result = insert_message(cur, message, attachments, file_urls)
+                if result is not None:
+                    cur.execute("NOTIFY push_outbox")
+                    conn.commit()
+                    stored = None
+                else:
+                    # Параллельный повтор успел вставить то же самое раньше нас
+                    conn.rollback()
+                    cur.execute("SELECT id, created_at FROM messages WHERE id = %s", (message_id,))
+                    stored = cur.fetchone()
+            if stored is not None:
+                result = stored
+                log(f"[Messages] {message_id}: repeated send, returning stored message")
 
-            log(f"[Push] Found {len(user_subs)} subs for chat {chat_id}, topic={topic_id}, chat_type={chat_type}, lead_teachers={lead_teacher_ids}")
-            if user_subs:
-                try:
-                    from pywebpush import webpush, WebPushException
-                    vapid_private = os.environ.get('VAPID_PRIVATE_KEY', '').strip()
-                    preview = (text or '')[:100] or 'Новое сообщение'
-                    msg_text = text or ''
-                    has_admin_mention = '@[админ' in msg_text
-
-                    STUDENT_ALLOWED_SUFFIXES = ('-important', '-zoom', '-homework', '-reports', '-cancellation')
-
-                    subs_to_send = []
-                    for sub in user_subs:
-                        personal_mention = False
-                        if sub['user_name'] and ('@[' + sub['user_name']) in msg_text:
-                            personal_mention = True
-                        if has_admin_mention and sub.get('user_role') == 'admin':
-                            personal_mention = True
-
-                        if sub.get('user_role') == 'teacher' and topic_id and topic_id.endswith('-admin-contact'):
-                            log(f"[Push] SKIP teacher {sub.get('user_name')} ({sub['user_id']}) — no access to -admin-contact")
-                            continue
-
-                        if sub.get('user_role') == 'student' and topic_id and not any(topic_id.endswith(s) for s in STUDENT_ALLOWED_SUFFIXES):
-                            log(f"[Push] SKIP student {sub.get('user_name')} ({sub['user_id']}) — topic {topic_id} not in allowed list")
-                            continue
-
-                        if sub.get('user_role') == 'teacher' and chat_type == 'group' and chat_id != 'teachers-group':
-                            if sub['user_id'] not in lead_teacher_ids:
-                                if not personal_mention:
-                                    log(f"[Push] SKIP non-lead teacher {sub.get('user_name')} ({sub['user_id']})")
-                                    continue
-
-                        if sub.get('user_role') == 'tech_specialist' and chat_type == 'group':
-                            if not personal_mention:
-                                log(f"[Push] SKIP tech_specialist {sub.get('user_name')} ({sub['user_id']}) — no mention in group")
-                                continue
-
-                        sub['_mention'] = personal_mention
-                        subs_to_send.append(sub)
-
-                    log(f"[Push] After filtering: {len(subs_to_send)} subs to send out of {len(user_subs)} total")
-                    for s in subs_to_send:
-                        log(f"[Push] WILL SEND to {s.get('user_name')} ({s['user_id']}) role={s.get('user_role')}")
-
-                    dead_endpoints = []
-
-                    def send_one_push(sub):
-                        personal_mention = sub['_mention']
-                        is_apple = 'apple' in sub['endpoint'].lower()
-                        log(f"[Push] Sending to {sub.get('user_name')} ({sub['user_id']}) apple={is_apple} endpoint={sub['endpoint'][:80]}")
-
-                        payload = json.dumps({
-                            'title': sender_name,
-                            'body': preview,
-                            'icon': 'https://cdn.poehali.dev/projects/4cb0cc95-18aa-46d6-b7e8-5e3a2e2fb412/files/favicon-1773208222088.jpg',
-                            'tag': 'msg-%s' % message_id,
-                            'data': {'chatId': chat_id, 'topicId': topic_id, 'hasMention': personal_mention}
-                        })
-                        try:
-                            webpush(
-                                subscription_info={
-                                    'endpoint': sub['endpoint'],
-                                    'keys': {'p256dh': sub['p256dh'], 'auth': sub['auth']}
-                                },
-                                data=payload,
-                                vapid_private_key=vapid_private,
-                                vapid_claims={'sub': 'mailto:push@lineya.school'},
-                                ttl=300
-                            )
-                            log(f"[Push] OK for {sub.get('user_name')}")
-                        except WebPushException as e:
-                            log(f"[Push] WebPushException for {sub.get('user_name')}: {e}")
-                            resp_body = getattr(e, 'response', None)
-                            if resp_body:
-                                status_code = getattr(resp_body, 'status_code', None)
-                                log(f"[Push] Response status: {status_code}, body: {getattr(resp_body, 'text', '')[:200]}")
-                                if status_code in (404, 410):
-                                    log(f"[Push] Dead subscription detected for {sub.get('user_name')}, marking for removal")
-                                    dead_endpoints.append(sub['endpoint'])
-                        except Exception as e:
-                            log(f"[Push] Error for {sub.get('user_name')}: {e}")
-
-                    if subs_to_send:
-                        with ThreadPoolExecutor(max_workers=min(len(subs_to_send), 10)) as executor:
-                            list(executor.map(send_one_push, subs_to_send))
-
-                    if dead_endpoints:
-                        try:
-                            cleanup_conn = psycopg2.connect(os.environ['DATABASE_URL'])
-                            cleanup_cur = cleanup_conn.cursor()
-                            for ep in dead_endpoints:
-                                cleanup_cur.execute("DELETE FROM push_subscriptions WHERE endpoint = %s", (ep,))
-                                log(f"[Push] Removed dead subscription: {ep[:80]}")
-                            cleanup_conn.commit()
-                            cleanup_cur.close()
-                            cleanup_conn.close()
-                        except Exception as e:
-                            log(f"[Push] Failed to cleanup dead subscriptions: {e}")
-                except Exception as e:
-                    log(f"[Push] Send error: {e}")
+            cur.close()
+            conn.close()
 
             return {
-                'statusCode': 201,
+                'statusCode': 201 if stored is None else 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
                     'message': {
@@ -401,6 +1349,11 @@ def handler(event: dict, context) -> dict:
                     'body': json.dumps({'error': 'X-User-Id header, messageId and emoji are required'})
                 }
 
+            # Блокируем строку сообщения: параллельные переключения реакций
+            # пересчитывают сводку строго по очереди
+            cur.execute("SELECT chat_id, topic_id FROM messages WHERE id = %s FOR UPDATE", (message_id,))
+            target = cur.fetchone()
+
             cur.execute(
                 "SELECT id FROM reactions WHERE message_id = %s AND user_id = %s AND emoji = %s",
                 (message_id, user_id, emoji)
@@ -415,6 +1368,10 @@ def handler(event: dict, context) -> dict:
                     (message_id, user_id, emoji)
                 )
 
+            cur.execute(REACTIONS_SUMMARY_UPDATE, (message_id,))
+            if target:
+                bump_thread_version(cur, target['chat_id'], target['topic_id'])
+
             conn.commit()
             cur.close()
             conn.close()
@@ -440,10 +1397,33 @@ def handler(event: dict, context) -> dict:
                     'body': json.dumps({'error': 'X-User-Id header and messageId are required'})
                 }
 
+            # Счётчики непрочитанного — до удаления упоминаний, по ним вычитаются и упоминания
+            cur.execute("SELECT chat_id, topic_id, sender_id, created_at FROM messages WHERE id = %s", (message_id,))
+            target = cur.fetchone()
+            if target:
+                cur.execute(UNREAD_DECREMENT, {
+                    'message_id': message_id, 'chat_id': target['chat_id'], 'topic_key': target['topic_id'] or '',
+                    'sender_id': target['sender_id'], 'created_at': target['created_at'],
+                })
+
             cur.execute("DELETE FROM reactions WHERE message_id = %s", (message_id,))
             cur.execute("DELETE FROM attachments WHERE message_id = %s", (message_id,))
-            cur.execute("DELETE FROM message_status WHERE message_id = %s", (message_id,))
-            cur.execute("DELETE FROM messages WHERE id = %s", (message_id,))
+            cur.execute("DELETE FROM message_mentions WHERE message_id = %s", (message_id,))
+            cur.execute("DELETE FROM messages WHERE id = %s RETURNING chat_id, topic_id", (message_id,))
+            deleted = cur.fetchone()
+            if deleted:
+                cur.execute("""
+                    INSERT INTO message_tombstones (message_id, chat_id, topic_id)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (message_id) DO UPDATE SET deleted_xid = txid_current(), deleted_at = NOW()
+                """, (message_id, deleted['chat_id'], deleted['topic_id']))
+                if deleted['topic_id']:
+                    remove_from_topic_summary(cur, deleted['topic_id'], message_id)
+                bump_thread_version(cur, deleted['chat_id'], deleted['topic_id'])
+            cur.execute(
+                "DELETE FROM message_tombstones WHERE deleted_at < NOW() - %s * INTERVAL '1 day'",
+                (TOMBSTONE_RETENTION_DAYS,)
+            )
             conn.commit()
             cur.close()
             conn.close()
@@ -470,24 +1450,39 @@ def handler(event: dict, context) -> dict:
                     'body': json.dumps({'error': 'X-User-Id header and chatId are required'})
                 }
 
-            if topic_id:
-                cur.execute("""
-                    INSERT INTO message_status (message_id, user_id, status, updated_at)
-                    SELECT m.id, %s, 'read', NOW()
-                    FROM messages m
-                    LEFT JOIN message_status ms ON ms.message_id = m.id AND ms.user_id = %s
-                    WHERE m.topic_id = %s AND m.sender_id != %s AND (ms.status IS NULL OR ms.status != 'read')
-                    ON CONFLICT (message_id, user_id) DO UPDATE SET status = 'read', updated_at = NOW()
-                """, (user_id, user_id, topic_id, user_id))
-            else:
-                cur.execute("""
-                    INSERT INTO message_status (message_id, user_id, status, updated_at)
-                    SELECT m.id, %s, 'read', NOW()
-                    FROM messages m
-                    LEFT JOIN message_status ms ON ms.message_id = m.id AND ms.user_id = %s
-                    WHERE m.chat_id = %s AND m.topic_id IS NULL AND m.sender_id != %s AND (ms.status IS NULL OR ms.status != 'read')
-                    ON CONFLICT (message_id, user_id) DO UPDATE SET status = 'read', updated_at = NOW()
-                """, (user_id, user_id, chat_id, user_id))
+            # Одна отметка на тред: прочитано всё до последнего сообщения треда включительно.
+            # Отметка только растёт — запоздавший запрос со старой вкладки её не откатит
+            topic_key = topic_id or ''
+            cur.execute("""
+                INSERT INTO read_watermarks (user_id, chat_id, topic_key, last_read_at, last_read_id, updated_at)
+                SELECT %s, %s, %s, m.created_at, m.id, NOW()
+                FROM messages m
+                WHERE m.chat_id = %s AND COALESCE(m.topic_id, '') = %s
+                ORDER BY m.created_at DESC, m.id DESC
+                LIMIT 1
+                ON CONFLICT (user_id, chat_id, topic_key) DO UPDATE
+                SET last_read_at = EXCLUDED.last_read_at, last_read_id = EXCLUDED.last_read_id, updated_at = NOW()
+                WHERE (read_watermarks.last_read_at, read_watermarks.last_read_id)
+                    < (EXCLUDED.last_read_at, EXCLUDED.last_read_id)
+            """, (user_id, chat_id, topic_key, chat_id, topic_key))
+            watermark_moved = cur.rowcount > 0
+
+            # Счётчик не обнуляется вслепую: сообщение, пришедшее после отметки, осталось бы
+            # непрочитанным с нулевым счётчиком. Блокируем строку и пересчитываем от отметки
+            counter_key = {'user_id': user_id, 'chat_id': chat_id, 'topic_key': topic_key}
+            cur.execute("""
+                SELECT 1 FROM unread_counters
+                WHERE user_id = %(user_id)s AND chat_id = %(chat_id)s AND topic_key = %(topic_key)s
+                FOR UPDATE
+            """, counter_key)
+            counters_changed = False
+            if cur.fetchone():
+                cur.execute(UNREAD_RECOUNT, counter_key)
+                counters_changed = cur.rowcount > 0
+
+            # Прочтение меняет только счётчики непрочитанного в списке чатов этого пользователя
+            if watermark_moved or counters_changed:
+                cur.execute("UPDATE users SET list_version = list_version + 1 WHERE id = %s", (user_id,))
 
             conn.commit()
             cur.close()
@@ -0,0 +1,132 @@
+'''Проверка доставки воркером в пределах одного вызова (нужна база со всеми миграциями и pywebpush).
+
+Запуск: DATABASE_URL=... python check_delivery.py
+
+Подписка получателя указывает на stand_in_push.py. Вызов handler запускается раньше,
+чем в очереди появляется задание: задание, поставленное после старта, должно уйти
+в том же вызове сразу по NOTIFY push_outbox, а не к следующему запуску по таймеру.
+Ещё два сообщения того же треда внутри окна сводки ставятся так же, как это делает
+backend/messages, и должны уйти одним push к концу окна. Тестовые строки удаляются в конце.
+'''
+import json
+import os
+import threading
+import time
+import uuid
+
+os.environ['PUSH_ENDPOINT_PREFIX'] = 'http://'
+
+import psycopg2
+
+import index
+import stand_in_push
+
+CHECK_DRAIN_SECONDS = 8
+# Заметно меньше POLL_SECONDS: уложиться можно только благодаря NOTIFY
+NOTIFY_DELIVERY_SECONDS = 2
+# Короткое окно вместо PUSH_COALESCE_SECONDS из backend/messages
+CHECK_COALESCE_SECONDS = 3
+
+
+def seed(cur, prefix, server):
+    chat_id = f"{prefix}-chat"
+    sender_id = f"{prefix}-sender"
+    recipient_id = f"{prefix}-recipient"
+    cur.execute("INSERT INTO chats (id, name, type) VALUES (%s, 'push check', 'group')", (chat_id,))
+    for user_id, phone in ((sender_id, f"{prefix}-1"), (recipient_id, f"{prefix}-2")):
+        cur.execute(
+            "INSERT INTO users (id, name, phone, password, role) VALUES (%s, %s, %s, '-', 'admin')",
+            (user_id, user_id, phone)
+        )
+        cur.execute("INSERT INTO chat_participants (chat_id, user_id) VALUES (%s, %s)", (chat_id, user_id))
+    path = f"/push/{prefix}"
+    sub = stand_in_push.make_subscription(server.base_url, path)
+    cur.execute(
+        "INSERT INTO push_subscriptions (user_id, endpoint, p256dh, auth, updated_at) VALUES (%s, %s, %s, %s, NOW())",
+        (recipient_id, sub['endpoint'], sub['p256dh'], sub['auth'])
+    )
+    return chat_id, sender_id, path
+
+
+def enqueue(cur, prefix, chat_id, sender_id, n):
+    '''Задание как в insert_message backend/messages: после недавнего push треда ждёт конца окна'''
+    cur.execute("""
+        INSERT INTO push_outbox (message_id, chat_id, topic_id, sender_id, sender_name, text, next_attempt_at)
+        VALUES (%s, %s, NULL, %s, 'Проверка', %s, GREATEST(NOW(), (
+            SELECT last_push_at + make_interval(secs => %s) FROM push_coalesce
+            WHERE chat_id = %s AND topic_key = ''
+        )))
+    """, (f"{prefix}-msg-{n}", chat_id, sender_id, f"сообщение {n}", CHECK_COALESCE_SECONDS, chat_id))
+    cur.execute("NOTIFY push_outbox")
+
+
+def cleanup(cur, prefix):
+    like = prefix + '-%'
+    cur.execute("DELETE FROM push_outbox WHERE chat_id LIKE %s", (like,))
+    cur.execute("DELETE FROM push_coalesce WHERE chat_id LIKE %s", (like,))
+    cur.execute("DELETE FROM push_subscriptions WHERE user_id LIKE %s", (like,))
+    cur.execute("DELETE FROM chat_participants WHERE chat_id LIKE %s", (like,))
+    cur.execute("DELETE FROM chats WHERE id LIKE %s", (like,))
+    cur.execute("DELETE FROM users WHERE id LIKE %s", (like,))
+
+
+def run_handler():
+    '''Вызов как по таймеру, в фоновом потоке; возвращает поток и место для результата'''
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(index.handler({}, None)))
+    thread.start()
+    return thread, result
+
+
+def wait_for_requests(server, path, count, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.requests[path] >= count:
+            return True
+        time.sleep(0.05)
+    return server.requests[path] >= count
+
+
+def check_delivery():
+    prefix = f"push-check-{uuid.uuid4().hex[:8]}"
+    server = stand_in_push.start()
+    os.environ.setdefault('VAPID_PRIVATE_KEY', stand_in_push.make_vapid_key())
+    index.DRAIN_SECONDS = CHECK_DRAIN_SECONDS
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    try:
+        chat_id, sender_id, path = seed(cur, prefix, server)
+        conn.commit()
+
+        thread, result = run_handler()
+        # Очередь уже прочитана пустой — задание ставится после старта вызова
+        time.sleep(1)
+        enqueue(cur, prefix, chat_id, sender_id, 1)
+        conn.commit()
+        delivered = wait_for_requests(server, path, 1, NOTIFY_DELIVERY_SECONDS)
+        print(f"late job delivered within {NOTIFY_DELIVERY_SECONDS}s: {delivered}")
+        assert delivered, 'job enqueued after the worker started waited for the next invocation'
+
+        # Два сообщения треда внутри окна — одна сводка к концу окна
+        for n in (2, 3):
+            enqueue(cur, prefix, chat_id, sender_id, n)
+            conn.commit()
+        digest_sent = wait_for_requests(server, path, 2, CHECK_COALESCE_SECONDS + 1)
+        thread.join()
+
+        stats = json.loads(result['body'])
+        print(f"digest sent by the end of the window: {digest_sent}, pushes: {server.requests[path]}, stats: {stats}")
+        assert digest_sent, 'coalesced jobs were not sent at the end of the window'
+        assert server.requests[path] == 2, 'messages inside the window were not merged into one push'
+        assert stats == {'jobs': 3, 'threads': 2, 'sent': 2, 'failed': 0}, stats
+    finally:
+        conn.rollback()
+        cleanup(cur, prefix)
+        conn.commit()
+        cur.close()
+        conn.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    check_delivery()
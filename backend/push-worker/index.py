@@ -0,0 +1,445 @@
+import json
+import os
+import sys
+import time
+import select
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+from psycopg2.extras import RealDictCursor
+from concurrent.futures import ThreadPoolExecutor
+
+BATCH_SIZE = 20
+SEND_WORKERS = 10
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 15
+LEASE_SECONDS = 120
+# Вызов по таймеру (раз в минуту) слушает очередь почти весь период до следующего запуска
+DRAIN_SECONDS = 50
+POLL_SECONDS = 5
+MIN_WAIT_SECONDS = 0.05
+
+PUSH_TIMEOUT_SECONDS = 10
+VAPID_TOKEN_SECONDS = 12 * 60 * 60
+VAPID_REFRESH_MARGIN_SECONDS = 60 * 60
+
+PUSH_ICON = 'https://cdn.poehali.dev/projects/4cb0cc95-18aa-46d6-b7e8-5e3a2e2fb412/files/favicon-1773208222088.jpg'
+VAPID_CLAIMS_SUB = 'mailto:push@lineya.school'
+
+# Локально подписки указывают на stand_in_push.py по http://
+ENDPOINT_PREFIX = os.environ.get('PUSH_ENDPOINT_PREFIX', 'https://')
+
+RECIPIENT_CACHE_SIZE = 256
+
+# Все push-подписки участников чата одним запросом: роль, признак ведущего педагога и
+# скрытые для роли виды топиков (topic_hidden_roles) вычисляются сразу,
+# фильтр по топику и упоминаниям — на каждое сообщение в eligible()
+RECIPIENTS_SELECT = """
+    SELECT cp.user_id, u.role as user_role,
+           (lt.user_id IS NOT NULL) as is_lead,
+           ARRAY(SELECT h.kind FROM topic_hidden_roles h WHERE h.role = u.role) as hidden_kinds,
+           ps.endpoint, ps.p256dh, ps.auth
+    FROM (SELECT DISTINCT user_id FROM chat_participants WHERE chat_id = %s) cp
+    JOIN push_subscriptions ps ON ps.user_id = cp.user_id AND ps.endpoint LIKE %s
+    LEFT JOIN users u ON u.id = cp.user_id
+    LEFT JOIN chat_lead_teachers lt ON lt.chat_id = %s AND lt.user_id = cp.user_id
+"""
+
+# chat_id -> (recipients_version, получатели); живёт, пока жив контейнер/процесс воркера
+_recipient_cache = OrderedDict()
+
+# origin push-сервиса -> keep-alive сессия; живёт между вызовами в одном контейнере
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# origin push-сервиса (aud) -> (exp, VAPID-заголовки)
+_vapid = None
+_vapid_headers = {}
+_vapid_lock = threading.Lock()
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+def endpoint_origin(endpoint):
+    parts = urlsplit(endpoint)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def get_session(endpoint):
+    '''Сессия с пулом соединений для origin подписки (fcm.googleapis.com, web.push.apple.com, ...).
+
+    Уведомления одному push-сервису идут по уже открытым TLS-соединениям,
+    пул рассчитан на SEND_WORKERS параллельных отправок.
+    '''
+    origin = endpoint_origin(endpoint)
+    with _sessions_lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            session.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=SEND_WORKERS))
+            _sessions[origin] = session
+    return session
+
+def claim_jobs(conn, limit):
+    '''Забирает готовые к отправке задания и продлевает их аренду на LEASE_SECONDS.
+
+    Если воркер упадёт посреди отправки, задание снова станет доступным после аренды.
+    Параллельные воркеры не мешают друг другу благодаря SKIP LOCKED.
+    '''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        UPDATE push_outbox SET attempts = attempts + 1,
+               next_attempt_at = NOW() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM push_outbox
+            WHERE next_attempt_at <= NOW()
+            ORDER BY next_attempt_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, (LEASE_SECONDS, limit))
+    jobs = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return jobs
+
+def get_chat_recipients(cur, chat_id):
+    '''Тип чата и подписки его участников; при неизменной recipients_version — из кэша'''
+    cur.execute("SELECT type, recipients_version FROM chats WHERE id = %s", (chat_id,))
+    chat_row = cur.fetchone()
+    if not chat_row:
+        return None, []
+
+    cached = _recipient_cache.get(chat_id)
+    if cached and cached[0] == chat_row['recipients_version']:
+        _recipient_cache.move_to_end(chat_id)
+        return chat_row['type'], cached[1]
+
+    cur.execute(RECIPIENTS_SELECT, (chat_id, ENDPOINT_PREFIX + '%', chat_id))
+    recipients = [dict(r) for r in cur.fetchall()]
+    _recipient_cache[chat_id] = (chat_row['recipients_version'], recipients)
+    _recipient_cache.move_to_end(chat_id)
+    while len(_recipient_cache) > RECIPIENT_CACHE_SIZE:
+        _recipient_cache.popitem(last=False)
+    return chat_row['type'], recipients
+
+def eligible(recipient, job, chat_type, mention):
+    '''Правила ролей и топиков: кому из участников положено уведомление'''
+    role, chat_id = recipient['user_role'], job['chat_id']
+    if job['topic_kind'] in recipient['hidden_kinds']:
+        return False
+    if role == 'teacher' and chat_type == 'group' and chat_id != 'teachers-group':
+        return recipient['is_lead'] or mention
+    if role == 'tech_specialist' and chat_type == 'group':
+        return mention
+    return True
+
+def get_mentions(cur, message_id):
+    '''Упомянутые пользователи и роли — разобраны при записи сообщения в message_mentions'''
+    cur.execute("SELECT user_id, role FROM message_mentions WHERE message_id = %s", (message_id,))
+    users, roles = set(), set()
+    for row in cur.fetchall():
+        if row['user_id']:
+            users.add(row['user_id'])
+        else:
+            roles.add(row['role'])
+    return users, roles
+
+def resolve_recipients(cur, job):
+    '''Подписки участников чата, которым положено уведомление о сообщении'''
+    chat_type, recipients = get_chat_recipients(cur, job['chat_id'])
+    mentioned_users, mentioned_roles = get_mentions(cur, job['message_id']) if recipients else (set(), set())
+
+    targets = []
+    for recipient in recipients:
+        if recipient['user_id'] == job['sender_id']:
+            continue
+        mention = recipient['user_id'] in mentioned_users or recipient['user_role'] in mentioned_roles
+        if eligible(recipient, job, chat_type, mention):
+            targets.append({**recipient, 'mention': mention})
+
+    log(f"[Push] message={job['message_id']} chat={job['chat_id']} topic={job['topic_id']}: {len(targets)} of {len(recipients)} subs")
+    return targets
+
+def load_retry_targets(cur, job):
+    '''Подписки для повторной отправки; удалённые с тех пор подписки пропускаются'''
+    digests = {t['endpoint']: t['digest'] for t in job['retry_targets']}
+    cur.execute(
+        "SELECT user_id, endpoint, p256dh, auth FROM push_subscriptions WHERE endpoint = ANY(%s)",
+        (list(digests),)
+    )
+    return [{**sub, 'digest': digests[sub['endpoint']]} for sub in cur.fetchall()]
+
+def coalesce_targets(cur, jobs):
+    '''Получатели сообщений одного треда: на каждую подписку — одна сводка по всем её сообщениям'''
+    per_endpoint = OrderedDict()
+    for job in jobs:
+        for target in resolve_recipients(cur, job):
+            entry = per_endpoint.setdefault(target['endpoint'], {'target': target, 'jobs': [], 'mention': False})
+            entry['jobs'].append(job)
+            entry['mention'] = entry['mention'] or target['mention']
+    return [{**e['target'], 'digest': make_digest(e['jobs'], e['mention'])} for e in per_endpoint.values()]
+
+def broadcast_targets(cur, job):
+    '''Получатели рассылки по нескольким группам: подписка получает одно уведомление —
+    о первой из групп, где она состоит'''
+    per_endpoint = OrderedDict()
+    for item in job['broadcast']:
+        part = {**job, 'message_id': item['messageId'], 'chat_id': item['chatId'], 'topic_id': item['topicId']}
+        for target in resolve_recipients(cur, part):
+            if target['endpoint'] not in per_endpoint:
+                per_endpoint[target['endpoint']] = {**target, 'digest': make_digest([part], target['mention'])}
+    log(f"[Push] broadcast={job['message_id']}: {len(per_endpoint)} subs across {len(job['broadcast'])} groups")
+    return list(per_endpoint.values())
+
+def make_digest(jobs, mention):
+    senders = list(dict.fromkeys(job['sender_name'] or '' for job in jobs))
+    return {
+        'chatId': jobs[-1]['chat_id'], 'topicId': jobs[-1]['topic_id'],
+        'count': len(jobs), 'senders': senders, 'preview': (jobs[-1]['text'] or '')[:100], 'mention': mention
+    }
+
+def get_vapid_headers(endpoint):
+    '''VAPID-заголовки для aud подписки: JWT подписывается один раз на push-сервис
+    и переиспользуется, пока до истечения больше VAPID_REFRESH_MARGIN_SECONDS'''
+    global _vapid
+    aud = endpoint_origin(endpoint)
+    now = int(time.time())
+    with _vapid_lock:
+        cached = _vapid_headers.get(aud)
+        if cached and cached[0] - VAPID_REFRESH_MARGIN_SECONDS > now:
+            return cached[1]
+        if _vapid is None:
+            from py_vapid import Vapid
+            _vapid = Vapid.from_string(private_key=os.environ.get('VAPID_PRIVATE_KEY', '').strip())
+        exp = now + VAPID_TOKEN_SECONDS
+        headers = _vapid.sign({'sub': VAPID_CLAIMS_SUB, 'aud': aud, 'exp': exp})
+        _vapid_headers[aud] = (exp, headers)
+        return headers
+
+def new_messages_phrase(count):
+    if count % 10 == 1 and count % 100 != 11:
+        return 'новое сообщение'
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return 'новых сообщения'
+    return 'новых сообщений'
+
+def build_payload(digest):
+    '''Уведомление по сводке: одно сообщение — как есть, несколько — «N новых сообщений».
+
+    tag общий для треда, поэтому устройство заменяет прежнее уведомление, а не копит их.
+    '''
+    count, senders = digest['count'], digest['senders']
+    preview = digest['preview'] or 'Новое сообщение'
+    if count == 1:
+        title, body = senders[0], preview
+    else:
+        title = ', '.join(senders[:2]) + (' и др.' if len(senders) > 2 else '')
+        body = f"{count} {new_messages_phrase(count)} от {title}: {preview}"
+    return json.dumps({
+        'title': title,
+        'body': body,
+        'icon': PUSH_ICON,
+        'tag': 'thread-%s-%s' % (digest['chatId'], digest['topicId'] or 'main'),
+        'data': {'chatId': digest['chatId'], 'topicId': digest['topicId'], 'hasMention': digest['mention'], 'count': count}
+    })
+
+def send_push(target, payload):
+    '''Отправка одного уведомления: 'ok', 'gone' (подписка мертва), 'retry' или 'failed' и текст ошибки'''
+    from pywebpush import webpush, WebPushException
+    try:
+        # Без vapid_claims pywebpush не подписывает JWT сам — только шифрует payload
+        webpush(
+            subscription_info={
+                'endpoint': target['endpoint'],
+                'keys': {'p256dh': target['p256dh'], 'auth': target['auth']}
+            },
+            data=payload,
+            headers=get_vapid_headers(target['endpoint']),
+            ttl=300,
+            timeout=PUSH_TIMEOUT_SECONDS,
+            requests_session=get_session(target['endpoint'])
+        )
+        return 'ok', None
+    except WebPushException as e:
+        status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+        if status_code in (404, 410):
+            return 'gone', f"{status_code}"
+        if status_code is None or status_code == 429 or status_code >= 500:
+            return 'retry', f"{status_code}: {e}"
+        return 'failed', f"{status_code}: {e}"
+    except Exception as e:
+        # Таймауты и обрывы соединения — повторяем позже
+        return 'retry', str(e)
+
+def process_jobs(conn, jobs):
+    '''Отправляет уведомления по заданиям одного треда и удаляет их либо откладывает повтор.
+
+    Первичные задания треда объединяются в одно уведомление на подписку;
+    рассылка и задание-повтор всегда приходят по одному, повтор несёт готовые сводки.
+    '''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    keeper = jobs[-1]
+    is_retry = keeper['retry_targets'] is not None
+    if is_retry:
+        targets = load_retry_targets(cur, keeper)
+    elif keeper['broadcast'] is not None:
+        targets = broadcast_targets(cur, keeper)
+    else:
+        targets = coalesce_targets(cur, jobs)
+
+    results = []
+    if targets:
+        with ThreadPoolExecutor(max_workers=min(len(targets), SEND_WORKERS)) as executor:
+            results = list(executor.map(lambda t: send_push(t, build_payload(t['digest'])), targets))
+
+    dead_endpoints, retry_targets, errors = [], [], []
+    for target, (status, error) in zip(targets, results):
+        if status == 'gone':
+            dead_endpoints.append(target['endpoint'])
+        elif status == 'retry':
+            retry_targets.append({'endpoint': target['endpoint'], 'digest': target['digest']})
+        if error:
+            errors.append(f"{target['endpoint'][:60]}: {error}")
+            log(f"[Push] {status} for {target['user_id']}: {error}")
+
+    if dead_endpoints:
+        cur.execute("DELETE FROM push_subscriptions WHERE endpoint = ANY(%s) RETURNING user_id", (dead_endpoints,))
+        dead_user_ids = list({r['user_id'] for r in cur.fetchall()})
+        cur.execute(
+            "UPDATE chats SET recipients_version = recipients_version + 1 WHERE id IN (SELECT chat_id FROM chat_participants WHERE user_id = ANY(%s))",
+            (dead_user_ids,)
+        )
+        log(f"[Push] Removed {len(dead_endpoints)} dead subscriptions")
+
+    if not is_retry and keeper['broadcast'] is None and targets:
+        # Следующие сообщения треда в пределах окна дождутся его конца и уйдут одной сводкой
+        cur.execute("""
+            INSERT INTO push_coalesce (chat_id, topic_key, last_push_at) VALUES (%s, %s, NOW())
+            ON CONFLICT (chat_id, topic_key) DO UPDATE SET last_push_at = EXCLUDED.last_push_at
+        """, (keeper['chat_id'], keeper['topic_id'] or ''))
+
+    done_ids = [job['id'] for job in jobs]
+    if retry_targets and keeper['attempts'] < MAX_ATTEMPTS:
+        delay = BACKOFF_BASE_SECONDS * 2 ** (keeper['attempts'] - 1)
+        cur.execute("""
+            UPDATE push_outbox SET retry_targets = %s, last_error = %s,
+                   next_attempt_at = NOW() + make_interval(secs => %s)
+            WHERE id = %s
+        """, (json.dumps(retry_targets), '\n'.join(errors)[:2000], delay, keeper['id']))
+        done_ids.remove(keeper['id'])
+        log(f"[Push] message={keeper['message_id']}: {len(retry_targets)} to retry in {delay}s (attempt {keeper['attempts']})")
+    elif retry_targets:
+        log(f"[Push] message={keeper['message_id']}: giving up on {len(retry_targets)} subs after {keeper['attempts']} attempts")
+    cur.execute("DELETE FROM push_outbox WHERE id = ANY(%s)", (done_ids,))
+    conn.commit()
+    cur.close()
+
+    sent = sum(1 for status, _ in results if status == 'ok')
+    return sent, len(results) - sent
+
+def group_by_thread(jobs):
+    '''Первичные задания — по треду (chat_id, topic_id) в порядке создания, рассылки и повторы — по одному'''
+    groups = OrderedDict()
+    for job in sorted(jobs, key=lambda j: j['id']):
+        single = job['retry_targets'] is not None or job['broadcast'] is not None
+        key = ('single', job['id']) if single else (job['chat_id'], job['topic_id'])
+        groups.setdefault(key, []).append(job)
+    return list(groups.values())
+
+def drain(conn, deadline):
+    '''Разбирает очередь, пока есть готовые задания и не истекло время'''
+    stats = {'jobs': 0, 'threads': 0, 'sent': 0, 'failed': 0}
+    while time.monotonic() < deadline:
+        jobs = claim_jobs(conn, BATCH_SIZE)
+        if not jobs:
+            break
+        for group in group_by_thread(jobs):
+            try:
+                sent, failed = process_jobs(conn, group)
+                stats['sent'] += sent
+                stats['failed'] += failed
+                stats['threads'] += 1
+            except Exception as e:
+                # Задания вернутся в очередь после окончания аренды
+                conn.rollback()
+                log(f"[Push] Jobs {[job['id'] for job in group]} error: {e}")
+            stats['jobs'] += len(group)
+    return stats
+
+def listen(dsn):
+    '''Отдельное соединение в autocommit, подписанное на NOTIFY push_outbox (шлёт backend/messages после коммита)'''
+    listen_conn = psycopg2.connect(dsn)
+    listen_conn.autocommit = True
+    listen_conn.cursor().execute("LISTEN push_outbox")
+    return listen_conn
+
+def seconds_until_next_job(conn):
+    '''Сколько ждать ближайшее отложенное задание (конец окна сводки, повтор); None — очередь пуста'''
+    cur = conn.cursor()
+    cur.execute("SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - NOW()) FROM push_outbox")
+    seconds = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return None if seconds is None else float(seconds)
+
+def serve(conn, listen_conn, deadline):
+    '''Разбирает очередь до deadline, а не до первого пустого чтения: опустев, ждёт NOTIFY
+    push_outbox и сразу отправляет новые задания, а отложенные (сводка треда, повтор) — к их сроку'''
+    stats = {'jobs': 0, 'threads': 0, 'sent': 0, 'failed': 0}
+    while True:
+        for key, value in drain(conn, deadline).items():
+            stats[key] += value
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return stats
+        timeout = min(POLL_SECONDS, remaining)
+        next_job = seconds_until_next_job(conn)
+        if next_job is not None:
+            # Просыпаемся к концу окна сводки, а не к следующему опросу
+            timeout = min(timeout, max(next_job, MIN_WAIT_SECONDS))
+        if select.select([listen_conn], [], [], timeout) != ([], [], []):
+            listen_conn.poll()
+            listen_conn.notifies.clear()
+
+def run_forever():
+    '''Локальный/долгоживущий режим: serve() без ограничения по времени'''
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    listen_conn = listen(os.environ['DATABASE_URL'])
+    log("[Push] Worker started")
+    while True:
+        stats = serve(conn, listen_conn, time.monotonic() + DRAIN_SECONDS)
+        if stats['jobs']:
+            log(f"[Push] Drained: {stats}")
+
+def handler(event: dict, context) -> dict:
+    '''Воркер доставки push-уведомлений из очереди push_outbox (запускается по таймеру раз в минуту
+    и слушает очередь DRAIN_SECONDS, поэтому новые задания уходят сразу, а не к следующему запуску)'''
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    method = event.get('httpMethod')
+    # Очередь разбирают только таймер (без httpMethod) и GET — остальное не трогает push_outbox
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': {**headers, 'Access-Control-Allow-Methods': 'GET, OPTIONS'}, 'body': ''}
+    if method not in (None, 'GET'):
+        return {'statusCode': 405, 'headers': headers, 'body': json.dumps({'error': 'Method not allowed'})}
+
+    # Подписка до первого чтения очереди: задание, закоммиченное между ними, не потеряется
+    listen_conn = listen(os.environ['DATABASE_URL'])
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        stats = serve(conn, listen_conn, time.monotonic() + DRAIN_SECONDS)
+    finally:
+        conn.close()
+        listen_conn.close()
+    log(f"[Push] Drained: {stats}")
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps(stats)
+    }
+
+if __name__ == '__main__':
+    run_forever()
@@ -0,0 +1,159 @@
+'''Локальная заглушка push-сервиса для проверки воркера без FCM/Apple/Mozilla.
+
+Запуск: python stand_in_push.py [порт]
+
+Печатает VAPID-ключ и готовые подписки (endpoint, p256dh, auth) — их нужно
+вставить в push_subscriptions и запустить воркер:
+
+    PUSH_ENDPOINT_PREFIX=http:// VAPID_PRIVATE_KEY=<ключ> DATABASE_URL=... python index.py
+
+Ответ зависит от пути endpoint:
+    /push/<id>   — 201 Created
+    /gone/<id>   — 410 Gone (воркер удаляет подписку)
+    /flaky/<id>  — 503 на первые FLAKY_FAILURES запросов, затем 201 (воркер повторяет с задержкой)
+
+Сервер считает и запросы, и TCP-соединения. Проверка, что воркер переиспользует
+keep-alive соединения и VAPID-токены (база не нужна):
+
+    python stand_in_push.py --check-reuse
+'''
+import base64
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+FLAKY_FAILURES = 2
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def make_vapid_key():
+    '''Приватный VAPID-ключ в формате переменной VAPID_PRIVATE_KEY (raw, base64url)'''
+    key = ec.generate_private_key(ec.SECP256R1())
+    return b64url(key.private_numbers().private_value.to_bytes(32, 'big'))
+
+
+def make_subscription(base_url, path):
+    '''Подписка с настоящими ключами браузера, чтобы pywebpush мог зашифровать payload'''
+    key = ec.generate_private_key(ec.SECP256R1())
+    public = key.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return {'endpoint': f"{base_url}{path}", 'p256dh': b64url(public), 'auth': b64url(b'stand-in-auth-16')}
+
+
+class StandInPushServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, StandInPushHandler)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.connections = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def record(self, path):
+        with self.lock:
+            self.requests[path] += 1
+            return self.requests[path]
+
+
+class StandInPushHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Один экземпляр обработчика на TCP-соединение: keep-alive запросы идут через него же
+        super().setup()
+        self.server.record_connection()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        seen = self.server.record(self.path)
+
+        if self.path.startswith('/gone/'):
+            status = 410
+        elif self.path.startswith('/flaky/') and seen <= FLAKY_FAILURES:
+            status = 503
+        else:
+            status = 201
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, fmt, *args):
+        sys.stderr.write(f"[stand-in] {self.command} {self.path} -> {args[1] if len(args) > 1 else ''}\n")
+
+
+def start(port=0):
+    '''Запуск в фоновом потоке (port=0 — любой свободный), возвращает сервер'''
+    server = StandInPushServer(('127.0.0.1', port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_connection_reuse(pushes=30):
+    '''Отправляет pushes уведомлений через send_push воркера и проверяет, что хватило одного
+    соединения на поток и одной подписи VAPID на push-сервис'''
+    import os
+    import index
+    from py_vapid import Vapid
+
+    # Считаем сами подписи JWT, а не записи кэша: пересчёт на каждого получателя
+    # перезаписывал бы ту же запись и не был бы виден по её числу
+    signatures = []
+    original_sign = Vapid.sign
+
+    def counting_sign(self, claims, *args, **kwargs):
+        signatures.append(claims.get('aud'))
+        return original_sign(self, claims, *args, **kwargs)
+
+    Vapid.sign = counting_sign
+    index._vapid_headers.clear()
+
+    server = start()
+    os.environ.setdefault('VAPID_PRIVATE_KEY', make_vapid_key())
+    sub = make_subscription(server.base_url, '/push/reuse')
+    targets = [{**sub, 'user_id': f"user-{i}", 'mention': False} for i in range(pushes)]
+    job = {'message_id': 'reuse-check', 'chat_id': 'chat', 'topic_id': None, 'sender_name': 'Проверка', 'text': 'keep-alive'}
+    payload = index.build_payload(index.make_digest([job], False))
+
+    try:
+        with index.ThreadPoolExecutor(max_workers=index.SEND_WORKERS) as executor:
+            results = list(executor.map(lambda t: index.send_push(t, payload), targets))
+    finally:
+        Vapid.sign = original_sign
+        server.shutdown()
+
+    ok = sum(1 for status, _ in results if status == 'ok')
+    print(f"pushes: {pushes}, delivered: {ok}, connections: {server.connections} (limit {index.SEND_WORKERS}), "
+          f"VAPID tokens signed: {len(signatures)}")
+    assert ok == pushes, results
+    assert server.connections <= index.SEND_WORKERS, 'keep-alive connections are not reused'
+    assert signatures == [server.base_url], f"VAPID JWT signed {len(signatures)} times for {pushes} pushes"
+
+
+if __name__ == '__main__':
+    if '--check-reuse' in sys.argv:
+        check_connection_reuse()
+        sys.exit(0)
+    server = StandInPushServer(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 8089))
+    print(f"VAPID_PRIVATE_KEY={make_vapid_key()}")
+    for path in ('/push/1', '/gone/1', '/flaky/1'):
+        sub = make_subscription(server.base_url, path)
+        print(f"INSERT INTO push_subscriptions (user_id, endpoint, p256dh, auth, updated_at) "
+              f"VALUES ('<user_id>', '{sub['endpoint']}', '{sub['p256dh']}', '{sub['auth']}', NOW());")
+    print(f"Listening on {server.base_url}")
+    server.serve_forever()
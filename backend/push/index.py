@@ -4,6 +4,13 @@ import psycopg2
 from psycopg2.extras import RealDictCursor
 # v3
 
+def bump_recipients_version(cur, user_id):
+    '''Подписки пользователя изменились — push-worker перечитает получателей его чатов'''
+    cur.execute(
+        "UPDATE chats SET recipients_version = recipients_version + 1 WHERE id IN (SELECT chat_id FROM chat_participants WHERE user_id = %s)",
+        (user_id,)
+    )
+
 def handler(event: dict, context) -> dict:
     '''API для управления push-подписками и отправки уведомлений'''
     method = event.get('httpMethod', 'GET')
@@ -62,7 +69,8 @@ def handler(event: dict, context) -> dict:
                     'body': json.dumps({'error': 'Missing fields: user_id, endpoint, p256dh, auth'})
                 }
 
-            cur.execute("DELETE FROM push_subscriptions WHERE endpoint = %s", (endpoint,))
+            cur.execute("DELETE FROM push_subscriptions WHERE endpoint = %s RETURNING user_id", (endpoint,))
+            previous_owners = {r['user_id'] for r in cur.fetchall()} - {user_id}
 
             is_apple = 'apple' in endpoint.lower()
             if is_apple:
@@ -72,6 +80,8 @@ def handler(event: dict, context) -> dict:
                 INSERT INTO push_subscriptions (user_id, endpoint, p256dh, auth, updated_at)
                 VALUES (%s, %s, %s, %s, NOW())
             """, (user_id, endpoint, p256dh, auth))
+            for uid in previous_owners | {user_id}:
+                bump_recipients_version(cur, uid)
             conn.commit()
             cur.close()
             conn.close()
@@ -94,6 +104,7 @@ def handler(event: dict, context) -> dict:
                 }
 
             cur.execute("DELETE FROM push_subscriptions WHERE user_id = %s AND endpoint = %s", (user_id, endpoint))
+            bump_recipients_version(cur, user_id)
             conn.commit()
             cur.close()
             conn.close()
@@ -2,6 +2,7 @@ import json
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from serializer import RowEncoder, dumps, LIST
 # v4
 
 def normalize_phone(phone_str):
@@ -10,6 +11,16 @@ def normalize_phone(phone_str):
         normalized = '7' + normalized[1:]
     return normalized
 
+def bump_thread_versions(cur, threads):
+    '''Версии чатов и топиков изменённых сообщений — как bump_thread_version в backend/messages,
+    но одним UPDATE на таблицу: по ним GET /messages перестаёт отвечать 304'''
+    chat_ids = list({chat_id for chat_id, _ in threads})
+    topic_ids = list({topic_id for _, topic_id in threads if topic_id})
+    if chat_ids:
+        cur.execute("UPDATE chats SET version = version + 1, change_xid = txid_current() WHERE id = ANY(%s)", (chat_ids,))
+    if topic_ids:
+        cur.execute("UPDATE topics SET version = version + 1 WHERE id = ANY(%s)", (topic_ids,))
+
 def format_user(user_dict):
     d = dict(user_dict)
     result = {}
@@ -26,6 +37,10 @@ def format_user(user_dict):
             result[k] = v
     return result
 
+# Те же правила, что и в format_user, для кортежного курсора
+USER_COLUMN_KINDS = {'available_slots': LIST, 'education_docs': LIST}
+USER_COLUMN_NAMES = {'available_slots': 'availableSlots', 'education_docs': 'educationDocs', 'lesson_forms': 'lessonForms'}
+
 def handler(event: dict, context) -> dict:
     '''API для управления пользователями и группами'''
     method = event.get('httpMethod', 'GET')
@@ -51,11 +66,14 @@ def handler(event: dict, context) -> dict:
 
             if user_id:
                 # Получить данные конкретного пользователя
-                cur.execute("""
+                rows_cur = conn.cursor()
+                rows_cur.execute("""
                     SELECT id, name, phone, role, password, avatar, available_slots, education_docs, lesson_forms
                     FROM users WHERE id = %s
                 """, (user_id,))
-                user = cur.fetchone()
+                user = rows_cur.fetchone()
+                encoder = RowEncoder(rows_cur.description, USER_COLUMN_KINDS, USER_COLUMN_NAMES)
+                rows_cur.close()
 
                 if not user:
                     return {
@@ -67,20 +85,23 @@ def handler(event: dict, context) -> dict:
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'user': format_user(user)}, default=str)
+                    'body': dumps({'user': encoder.encode_row(user)})
                 }
             else:
                 # Получить всех пользователей
-                cur.execute("""
+                rows_cur = conn.cursor()
+                rows_cur.execute("""
                     SELECT id, name, phone, role, password, avatar, available_slots, education_docs, lesson_forms
                     FROM users ORDER BY name
                 """)
-                users = cur.fetchall()
+                users = rows_cur.fetchall()
+                encoder = RowEncoder(rows_cur.description, USER_COLUMN_KINDS, USER_COLUMN_NAMES)
+                rows_cur.close()
 
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'users': [format_user(u) for u in users]}, default=str)
+                    'body': dumps({'users': encoder.encode_rows(users)})
                 }
 
         elif method == 'POST':
@@ -216,6 +237,16 @@ def handler(event: dict, context) -> dict:
             cur.execute(query, values)
             
             user = cur.fetchone()
+
+            if user and 'name' in data:
+                # Сводки реакций хранят имена — обновляем их у сообщений с реакциями пользователя
+                cur.execute("""
+                    UPDATE messages SET reactions_summary = build_reactions_summary(id), change_xid = txid_current()
+                    WHERE id IN (SELECT message_id FROM reactions WHERE user_id = %s)
+                    RETURNING chat_id, topic_id
+                """, (user_id,))
+                bump_thread_versions(cur, [(r['chat_id'], r['topic_id']) for r in cur.fetchall()])
+
             conn.commit()
 
             if not user:
@@ -244,6 +275,11 @@ def handler(event: dict, context) -> dict:
 
             cur.execute("DELETE FROM users WHERE id = %s RETURNING id", (user_id,))
             deleted = cur.fetchone()
+            cur.execute("DELETE FROM unread_counters WHERE user_id = %s", (user_id,))
+            cur.execute(
+                "UPDATE chats SET recipients_version = recipients_version + 1 WHERE id IN (SELECT chat_id FROM chat_participants WHERE user_id = %s)",
+                (user_id,)
+            )
             conn.commit()
 
             if not deleted:
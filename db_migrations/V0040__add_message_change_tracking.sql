@@ -0,0 +1,20 @@
+-- Delta-синхронизация сообщений: xid транзакции последнего изменения
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_xid BIGINT;
+UPDATE messages SET change_xid = 0 WHERE change_xid IS NULL;
+ALTER TABLE messages ALTER COLUMN change_xid SET DEFAULT txid_current();
+
+CREATE INDEX IF NOT EXISTS idx_messages_topic_change ON messages(topic_id, change_xid) WHERE topic_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_chat_change ON messages(chat_id, change_xid);
+
+-- Надгробия удалённых сообщений, чтобы клиенты убирали их из ленты
+CREATE TABLE IF NOT EXISTS message_tombstones (
+    message_id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    topic_id TEXT,
+    deleted_xid BIGINT NOT NULL DEFAULT txid_current(),
+    deleted_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_message_tombstones_topic ON message_tombstones(topic_id, deleted_xid) WHERE topic_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_message_tombstones_chat ON message_tombstones(chat_id, deleted_xid);
+CREATE INDEX IF NOT EXISTS idx_message_tombstones_deleted_at ON message_tombstones(deleted_at);
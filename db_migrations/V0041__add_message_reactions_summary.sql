@@ -0,0 +1,22 @@
+-- Материализованная сводка реакций: пересчитывается при переключении реакции
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS reactions_summary JSONB;
+
+UPDATE messages m
+SET reactions_summary = s.summary
+FROM (
+    SELECT rg.message_id,
+           jsonb_agg(jsonb_build_object(
+               'emoji', rg.emoji, 'count', rg.cnt, 'users', rg.user_names, 'userIds', rg.user_ids
+           ) ORDER BY rg.first_at) as summary
+    FROM (
+        SELECT r.message_id, r.emoji, COUNT(*) as cnt,
+               ARRAY_AGG(u.name ORDER BY r.created_at) as user_names,
+               ARRAY_AGG(r.user_id ORDER BY r.created_at) as user_ids,
+               MIN(r.created_at) as first_at
+        FROM reactions r
+        LEFT JOIN users u ON u.id = r.user_id
+        GROUP BY r.message_id, r.emoji
+    ) rg
+    GROUP BY rg.message_id
+) s
+WHERE m.id = s.message_id;
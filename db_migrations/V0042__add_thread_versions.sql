@@ -0,0 +1,6 @@
+-- Версии чатов и топиков для ETag / 304 Not Modified
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+-- Версия прочтений пользователя: меняет счётчики непрочитанного только в его списке чатов
+ALTER TABLE users ADD COLUMN IF NOT EXISTS list_version BIGINT NOT NULL DEFAULT 0;
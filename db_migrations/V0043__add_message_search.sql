@@ -0,0 +1,5 @@
+-- Полнотекстовый поиск по сообщениям: tsvector (русская конфигурация) + GIN-индекс
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('russian', COALESCE(text, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_tsv);
@@ -0,0 +1,16 @@
+-- Индекс файлов и фото чата: вложения несут chat_id/topic_id своего сообщения,
+-- а created_at совпадает со временем сообщения
+ALTER TABLE attachments ADD COLUMN IF NOT EXISTS chat_id TEXT;
+ALTER TABLE attachments ADD COLUMN IF NOT EXISTS topic_id TEXT;
+
+UPDATE attachments a
+SET chat_id = m.chat_id, topic_id = m.topic_id, created_at = m.created_at
+FROM messages m
+WHERE m.id = a.message_id;
+
+-- file_url не включается: в старых вложениях там лежат data:-URL, слишком большие для индекса
+CREATE INDEX IF NOT EXISTS idx_attachments_chat_created
+    ON attachments(chat_id, created_at DESC, id DESC) INCLUDE (type, message_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_topic_created
+    ON attachments(topic_id, created_at DESC, id DESC) INCLUDE (type, message_id)
+    WHERE topic_id IS NOT NULL;
@@ -0,0 +1,19 @@
+-- Очередь push-уведомлений: строка пишется в одной транзакции с сообщением,
+-- доставкой занимается backend/push-worker
+CREATE TABLE IF NOT EXISTS push_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    topic_id TEXT,
+    sender_id TEXT NOT NULL,
+    sender_name TEXT,
+    text TEXT,
+    -- NULL — получатели ещё не выбраны; иначе [{endpoint, mention}] для повторной отправки
+    retry_targets JSONB,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_push_outbox_next_attempt ON push_outbox(next_attempt_at);
@@ -0,0 +1,5 @@
+-- Версия набора получателей push чата: меняется вместе с участниками, ведущими педагогами,
+-- подписками и ролями/именами участников; по ней push-worker сбрасывает кэш получателей
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS recipients_version INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_push_subscriptions_user ON push_subscriptions(user_id);
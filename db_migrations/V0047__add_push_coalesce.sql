@@ -0,0 +1,8 @@
+-- Окно объединения push-уведомлений по треду: время последней отправки в чат/топик.
+-- Сообщения, пришедшие в течение окна, отправляются одним уведомлением по его окончании.
+CREATE TABLE IF NOT EXISTS push_coalesce (
+    chat_id TEXT NOT NULL,
+    topic_key TEXT NOT NULL DEFAULT '',
+    last_push_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (chat_id, topic_key)
+);
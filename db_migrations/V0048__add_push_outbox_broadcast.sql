@@ -0,0 +1,3 @@
+-- Рассылка в несколько групп — одно задание в очереди: [{messageId, chatId, topicId}],
+-- воркер отправляет каждой подписке одно уведомление, даже если получатель состоит в нескольких группах
+ALTER TABLE push_outbox ADD COLUMN IF NOT EXISTS broadcast JSONB;
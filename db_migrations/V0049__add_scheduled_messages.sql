@@ -0,0 +1,27 @@
+-- Отложенные сообщения хранятся на сервере, а не в localStorage вкладки.
+-- Отправляет их dispatch_scheduled в backend/messages: строки забираются
+-- FOR UPDATE SKIP LOCKED, поэтому несколько диспетчеров не отправят одно сообщение дважды
+CREATE TABLE IF NOT EXISTS scheduled_messages (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    topic_id TEXT,
+    sender_id TEXT NOT NULL,
+    sender_name TEXT NOT NULL,
+    text TEXT,
+    -- [{type, fileUrl, fileName, fileSize}] — файлы загружаются в S3 при постановке в очередь
+    attachments JSONB,
+    reply_to_id TEXT,
+    reply_to_sender TEXT,
+    reply_to_text TEXT,
+    scheduled_at TIMESTAMP NOT NULL,
+    -- pending -> sent | cancelled | failed
+    status TEXT NOT NULL DEFAULT 'pending',
+    last_error TEXT,
+    sent_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_scheduled_messages_due
+    ON scheduled_messages(scheduled_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_scheduled_messages_sender
+    ON scheduled_messages(sender_id, scheduled_at) WHERE status = 'pending';
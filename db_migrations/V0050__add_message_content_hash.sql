@@ -0,0 +1,3 @@
+-- Хэш содержимого сообщения: повтор POST с тем же id и тем же содержимым
+-- возвращает сохранённый результат без загрузок в S3, перезаписи вложений и повторных push
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_hash TEXT;
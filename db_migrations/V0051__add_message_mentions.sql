@@ -0,0 +1,38 @@
+-- Упоминания разбираются один раз при записи сообщения: @[Имя] или @[Имя (роль)] — пользователь,
+-- @[админ] — все админы. Имя ищется среди участников чата. Счётчик непрочитанных упоминаний и push по упоминанию — поиск по индексу
+-- вместо LIKE по тексту всех сообщений
+CREATE TABLE IF NOT EXISTS message_mentions (
+    message_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    topic_id TEXT,
+    user_id TEXT,
+    role TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    CHECK ((user_id IS NULL) <> (role IS NULL))
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_message_mentions_user
+    ON message_mentions(user_id, message_id) WHERE user_id IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_message_mentions_role
+    ON message_mentions(role, message_id) WHERE role IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_message_mentions_message ON message_mentions(message_id);
+
+-- Упоминания в уже отправленных сообщениях
+WITH labels AS (
+    SELECT m.id, m.chat_id, m.topic_id,
+           regexp_replace((regexp_matches(m.text, '@\[([^]]+)\]', 'g'))[1], ' \([^()]*\)$', '') AS label
+    FROM messages m
+    WHERE m.text LIKE '%@[%'
+)
+INSERT INTO message_mentions (message_id, chat_id, topic_id, user_id)
+SELECT DISTINCT l.id, l.chat_id, l.topic_id, u.id
+FROM labels l
+JOIN chat_participants cp ON cp.chat_id = l.chat_id
+JOIN users u ON u.id = cp.user_id AND u.name = l.label
+ON CONFLICT DO NOTHING;
+
+INSERT INTO message_mentions (message_id, chat_id, topic_id, role)
+SELECT m.id, m.chat_id, m.topic_id, 'admin'
+FROM messages m
+WHERE m.text LIKE '%@[админ%'
+ON CONFLICT DO NOTHING;
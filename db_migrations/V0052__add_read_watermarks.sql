@@ -0,0 +1,31 @@
+-- Прочтение хранится одной отметкой на пользователя и тред (чат или топик) вместо строки
+-- message_status на каждое сообщение. Непрочитанные — сообщения треда новее (last_read_at, last_read_id);
+-- пока отметки нет, отметкой служит chat_participants.joined_at.
+-- topic_key = '' — сообщения чата без топика
+CREATE TABLE IF NOT EXISTS read_watermarks (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    topic_key TEXT NOT NULL DEFAULT '',
+    last_read_at TIMESTAMP NOT NULL,
+    last_read_id TEXT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, chat_id, topic_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_read_watermarks_chat ON read_watermarks(chat_id);
+
+-- Счётчик непрочитанного — диапазон этого индекса выше отметки
+CREATE INDEX IF NOT EXISTS idx_messages_thread_created
+    ON messages(chat_id, (COALESCE(topic_id, '')), created_at, id);
+
+-- Перенос: отметка — самое позднее прочитанное сообщение треда
+INSERT INTO read_watermarks (user_id, chat_id, topic_key, last_read_at, last_read_id)
+SELECT DISTINCT ON (ms.user_id, m.chat_id, COALESCE(m.topic_id, ''))
+       ms.user_id, m.chat_id, COALESCE(m.topic_id, ''), m.created_at, m.id
+FROM message_status ms
+JOIN messages m ON m.id = ms.message_id
+WHERE ms.status = 'read' AND m.created_at IS NOT NULL
+ORDER BY ms.user_id, m.chat_id, COALESCE(m.topic_id, ''), m.created_at DESC, m.id DESC
+ON CONFLICT (user_id, chat_id, topic_key) DO NOTHING;
+
+-- message_status больше не пишется и не читается; таблица остаётся до выкладки всех функций
@@ -0,0 +1,34 @@
+-- Счётчики непрочитанного на пользователя и тред: messages увеличивает их при вставке
+-- (по тем же правилам видимости топиков, что и список чатов), отметка прочтения обнуляет,
+-- смена участников пересобирает. Список чатов читает готовые числа.
+-- topic_key = '' — сообщения чата без топика
+CREATE TABLE IF NOT EXISTS unread_counters (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    topic_key TEXT NOT NULL DEFAULT '',
+    unread INTEGER NOT NULL DEFAULT 0,
+    unread_mentions INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, chat_id, topic_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_unread_counters_chat ON unread_counters(chat_id);
+
+-- Начальные значения — по отметкам прочтения
+INSERT INTO unread_counters (user_id, chat_id, topic_key, unread, unread_mentions)
+SELECT cp.user_id, cp.chat_id, COALESCE(m.topic_id, ''), COUNT(*),
+       COUNT(*) FILTER (WHERE EXISTS (
+           SELECT 1 FROM message_mentions mm
+           WHERE mm.message_id = m.id AND (mm.user_id = cp.user_id OR mm.role = u.role)
+       ))
+FROM chat_participants cp
+LEFT JOIN users u ON u.id = cp.user_id
+JOIN messages m ON m.chat_id = cp.chat_id AND m.sender_id != cp.user_id
+LEFT JOIN read_watermarks w
+    ON w.user_id = cp.user_id AND w.chat_id = cp.chat_id AND w.topic_key = COALESCE(m.topic_id, '')
+WHERE (m.created_at, m.id) > (COALESCE(w.last_read_at, cp.joined_at, '-infinity'::timestamp), COALESCE(w.last_read_id, ''))
+  AND NOT (u.role = 'teacher' AND m.topic_id LIKE '%-admin-contact')
+  AND NOT (u.role = 'student' AND m.topic_id IS NOT NULL AND NOT m.topic_id LIKE ANY(ARRAY[
+      '%-important', '%-zoom', '%-homework', '%-reports', '%-cancellation'
+  ]))
+GROUP BY cp.user_id, cp.chat_id, COALESCE(m.topic_id, '')
+ON CONFLICT (user_id, chat_id, topic_key) DO NOTHING;
@@ -0,0 +1,25 @@
+-- Delta-синхронизация списка чатов (GET /chats?since=...): xid транзакции последнего
+-- изменения чата (метаданные, участники, заключения, топики, последнее сообщение)
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS change_xid BIGINT;
+UPDATE chats SET change_xid = 0 WHERE change_xid IS NULL;
+ALTER TABLE chats ALTER COLUMN change_xid SET DEFAULT txid_current();
+
+-- ...и последнего изменения счётчиков непрочитанного пользователя
+ALTER TABLE unread_counters ADD COLUMN IF NOT EXISTS change_xid BIGINT;
+UPDATE unread_counters SET change_xid = 0 WHERE change_xid IS NULL;
+ALTER TABLE unread_counters ALTER COLUMN change_xid SET DEFAULT txid_current();
+
+CREATE INDEX IF NOT EXISTS idx_unread_counters_user_change ON unread_counters(user_id, change_xid);
+
+-- Надгробия членства: пользователь удалён из чата или чат удалён целиком,
+-- клиент убирает такие чаты из своего списка
+CREATE TABLE IF NOT EXISTS chat_membership_tombstones (
+    chat_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    removed_xid BIGINT NOT NULL DEFAULT txid_current(),
+    removed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (chat_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_membership_tombstones_user ON chat_membership_tombstones(user_id, removed_xid);
+CREATE INDEX IF NOT EXISTS idx_chat_membership_tombstones_removed_at ON chat_membership_tombstones(removed_at);
@@ -0,0 +1,30 @@
+-- Сводка топика: последнее сообщение и число сообщений. Ведёт backend/messages
+-- при вставке, правке и удалении, список чатов читает готовые значения
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS last_msg_id TEXT;
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS last_msg_text TEXT;
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS last_msg_sender TEXT;
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS last_msg_at TIMESTAMP;
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0;
+
+-- Заполнить текущими данными
+UPDATE topics t
+SET last_msg_id = m.id,
+    last_msg_text = COALESCE(NULLIF(m.text, ''), CASE WHEN EXISTS (
+        SELECT 1 FROM attachments a WHERE a.message_id = m.id
+    ) THEN '[Изображение]' ELSE '' END),
+    last_msg_sender = m.sender_name,
+    last_msg_at = m.created_at
+FROM (
+    SELECT DISTINCT ON (topic_id) topic_id, id, text, sender_name, created_at
+    FROM messages
+    WHERE topic_id IS NOT NULL
+    ORDER BY topic_id, created_at DESC, id DESC
+) m
+WHERE t.id = m.topic_id;
+
+UPDATE topics t
+SET message_count = c.cnt
+FROM (
+    SELECT topic_id, COUNT(*) as cnt FROM messages WHERE topic_id IS NOT NULL GROUP BY topic_id
+) c
+WHERE t.id = c.topic_id;
@@ -0,0 +1,46 @@
+-- Вид топика вместо разбора суффикса id при каждой проверке видимости.
+-- topic_kind() — единственное место, где вид выводится из id: при создании топика
+-- и при заполнении старых данных; дальше все проверки идут по равенству
+CREATE OR REPLACE FUNCTION topic_kind(topic_id TEXT) RETURNS TEXT AS $$
+    SELECT CASE
+        WHEN topic_id IS NULL THEN NULL
+        WHEN topic_id LIKE '%-admin-contact' THEN 'admin-contact'
+        WHEN topic_id LIKE '%-important' THEN 'important'
+        WHEN topic_id LIKE '%-zoom' THEN 'zoom'
+        WHEN topic_id LIKE '%-homework' THEN 'homework'
+        WHEN topic_id LIKE '%-reports' THEN 'reports'
+        WHEN topic_id LIKE '%-cancellation' THEN 'cancellation'
+        WHEN topic_id LIKE '%-payment' THEN 'payment'
+        ELSE 'other'
+    END
+$$ LANGUAGE SQL IMMUTABLE;
+
+ALTER TABLE topics ADD COLUMN IF NOT EXISTS kind TEXT;
+UPDATE topics SET kind = topic_kind(id) WHERE kind IS NULL;
+ALTER TABLE topics ALTER COLUMN kind SET DEFAULT 'other';
+ALTER TABLE topics ALTER COLUMN kind SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_topics_chat_kind ON topics(chat_id, kind);
+
+-- Правила видимости: роли, которым не видны топики этого вида (остальным видны все).
+-- Те же правила, что раньше были суффиксами в backend/chats, backend/messages и push-worker
+CREATE TABLE IF NOT EXISTS topic_hidden_roles (
+    kind TEXT NOT NULL,
+    role TEXT NOT NULL,
+    PRIMARY KEY (kind, role)
+);
+
+INSERT INTO topic_hidden_roles (kind, role) VALUES
+    ('admin-contact', 'teacher'),
+    ('admin-contact', 'student'),
+    ('payment', 'student'),
+    ('other', 'student')
+ON CONFLICT DO NOTHING;
+
+-- Вид топика копируется в сообщение при записи: счётчики, поиск и push проверяют
+-- видимость без обращения к topics. NULL — сообщение чата без топика, видно всем
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS topic_kind TEXT;
+UPDATE messages SET topic_kind = topic_kind(topic_id) WHERE topic_id IS NOT NULL AND topic_kind IS NULL;
+
+ALTER TABLE push_outbox ADD COLUMN IF NOT EXISTS topic_kind TEXT;
+UPDATE push_outbox SET topic_kind = topic_kind(topic_id) WHERE topic_id IS NOT NULL AND topic_kind IS NULL;
@@ -0,0 +1,9 @@
+-- Сообщение в топике без вида (строки топика не было при записи) проходило все проверки
+-- видимости как сообщение без топика. Вид выводится из id, а NULL остаётся только у чата без топика
+UPDATE messages SET topic_kind = topic_kind(topic_id) WHERE topic_id IS NOT NULL AND topic_kind IS NULL;
+UPDATE push_outbox SET topic_kind = topic_kind(topic_id) WHERE topic_id IS NOT NULL AND topic_kind IS NULL;
+
+ALTER TABLE messages ADD CONSTRAINT messages_topic_kind_required
+    CHECK (topic_id IS NULL OR topic_kind IS NOT NULL);
+ALTER TABLE push_outbox ADD CONSTRAINT push_outbox_topic_kind_required
+    CHECK (topic_id IS NULL OR topic_kind IS NOT NULL);
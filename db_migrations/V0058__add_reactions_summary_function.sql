@@ -0,0 +1,17 @@
+-- Сводка реакций сообщения — одно определение для backend/messages (переключение реакции)
+-- и backend/users (переименование: сводки хранят имена), как topic_kind() для вида топика
+CREATE OR REPLACE FUNCTION build_reactions_summary(p_message_id TEXT) RETURNS JSONB AS $$
+    SELECT jsonb_agg(jsonb_build_object(
+        'emoji', rg.emoji, 'count', rg.cnt, 'users', rg.user_names, 'userIds', rg.user_ids
+    ) ORDER BY rg.first_at)
+    FROM (
+        SELECT r.emoji, COUNT(*) as cnt,
+               ARRAY_AGG(u.name ORDER BY r.created_at) as user_names,
+               ARRAY_AGG(r.user_id ORDER BY r.created_at) as user_ids,
+               MIN(r.created_at) as first_at
+        FROM reactions r
+        LEFT JOIN users u ON u.id = r.user_id
+        WHERE r.message_id = p_message_id
+        GROUP BY r.emoji
+    ) rg
+$$ LANGUAGE SQL STABLE;
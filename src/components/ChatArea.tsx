@@ -1,4 +1,4 @@
-import { useState, useEffect, useRef, useCallback } from 'react';
+import { useState, useEffect, useLayoutEffect, useRef, useCallback } from 'react';
 import { Button } from '@/components/ui/button';
 import Icon from '@/components/ui/icon';
 import { MessageBubble } from './MessageBubble';
@@ -77,6 +77,7 @@ type ChatAreaProps = {
   allUsers?: { id: string; role: string }[];
   scrollToMessageId?: string | null;
   onScrollComplete?: () => void;
+  onLoadOlder?: () => Promise<boolean>;
   onCancelScheduledMessage?: (messageId: string) => void;
   muteVersion?: number;
   messagesLoading?: boolean;
@@ -121,7 +122,7 @@ const canDeleteMessage = (message: Message, currentUserId?: string, currentUserR
   return false;
 };
 
-export const ChatArea = ({ messages, onReaction, chatName, isGroup, topics, selectedTopic, onTopicSelect, typingUsers, userRole, onOpenChatInfo, chatId, participantsCount, onMobileBack, userId, onLogout, onOpenProfile, onOpenSettings, onOpenUsers, onAddStudent, onAddParent, onAddTeacher, onCreateGroup, onAddAdmin, onReply, onForward, onDeleteMessage, allUsers, scrollToMessageId, onScrollComplete, onCancelScheduledMessage, muteVersion, messagesLoading, onRetryMessage }: ChatAreaProps) => {
+export const ChatArea = ({ messages, onReaction, chatName, isGroup, topics, selectedTopic, onTopicSelect, typingUsers, userRole, onOpenChatInfo, chatId, participantsCount, onMobileBack, userId, onLogout, onOpenProfile, onOpenSettings, onOpenUsers, onAddStudent, onAddParent, onAddTeacher, onCreateGroup, onAddAdmin, onReply, onForward, onDeleteMessage, allUsers, scrollToMessageId, onScrollComplete, onLoadOlder, onCancelScheduledMessage, muteVersion, messagesLoading, onRetryMessage }: ChatAreaProps) => {
   const scrollTargetRef = useRef<HTMLDivElement>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const containerRef = useRef<HTMLDivElement>(null);
@@ -159,15 +160,32 @@ export const ChatArea = ({ messages, onReaction, chatName, isGroup, topics, sele
     messagesEndRef.current?.scrollIntoView({ behavior: smooth ? 'smooth' : 'instant' });
   }, []);
 
+  // Высота ленты до догрузки истории — чтобы после вставки старых сообщений сохранить позицию
+  const olderLoadHeightRef = useRef<number | null>(null);
+  const firstMessageId = messages[0]?.id;
+
   useEffect(() => {
     const el = containerRef.current;
     if (!el) return;
     const onScroll = () => {
       setShowScrollDown(!checkIfNearBottom());
+      if (onLoadOlder && el.scrollTop < 200 && olderLoadHeightRef.current === null) {
+        olderLoadHeightRef.current = el.scrollHeight;
+        onLoadOlder().then(loaded => {
+          if (!loaded) olderLoadHeightRef.current = null;
+        });
+      }
     };
     el.addEventListener('scroll', onScroll, { passive: true });
     return () => el.removeEventListener('scroll', onScroll);
-  }, [checkIfNearBottom]);
+  }, [checkIfNearBottom, onLoadOlder]);
+
+  useLayoutEffect(() => {
+    const el = containerRef.current;
+    if (!el || olderLoadHeightRef.current === null) return;
+    el.scrollTop += el.scrollHeight - olderLoadHeightRef.current;
+    olderLoadHeightRef.current = null;
+  }, [firstMessageId]);
 
   useEffect(() => {
     if (scrollToMessageId && scrollTargetRef.current) {
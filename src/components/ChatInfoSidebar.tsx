@@ -5,6 +5,7 @@ import Icon from '@/components/ui/icon';
 import { SidebarMembersSection } from '@/components/sidebar/SidebarMembersSection';
 import { SidebarScheduleSection } from '@/components/sidebar/SidebarScheduleSection';
 import { SidebarActions } from '@/components/sidebar/SidebarActions';
+import { SidebarMediaSection } from '@/components/sidebar/SidebarMediaSection';
 
 type User = {
   id: string;
@@ -58,9 +59,11 @@ type ChatInfoSidebarProps = {
   partnerSlots?: { name: string; slots: string[] };
   partnerLessonForms?: { name: string; lessonForms?: 'individual' | 'group' | 'both' };
   isPrivateTeacherChat?: boolean;
+  chatId?: string;
+  userId?: string;
 };
 
-export const ChatInfoSidebar = ({ isOpen, onClose, chatInfo, userRole, onDeleteGroup, isTeachersGroup = false, allTeachers = [], allAdmins = [], allStudents = [], allParents = [], participantIds = [], leadTeacherIds = [], leadAdminId, onUpdateLeadTeachers, onUpdateLeadAdmin, onUpdateParticipants, onUpdateSchedule, onAddConclusion, onUpdateConclusion, onDeleteConclusion, chatName, onUpdateName, isArchived, onArchive, partnerSlots, partnerLessonForms, isPrivateTeacherChat = false }: ChatInfoSidebarProps) => {
+export const ChatInfoSidebar = ({ isOpen, onClose, chatInfo, userRole, onDeleteGroup, isTeachersGroup = false, allTeachers = [], allAdmins = [], allStudents = [], allParents = [], participantIds = [], leadTeacherIds = [], leadAdminId, onUpdateLeadTeachers, onUpdateLeadAdmin, onUpdateParticipants, onUpdateSchedule, onAddConclusion, onUpdateConclusion, onDeleteConclusion, chatName, onUpdateName, isArchived, onArchive, partnerSlots, partnerLessonForms, isPrivateTeacherChat = false, chatId, userId }: ChatInfoSidebarProps) => {
   const [isEditingName, setIsEditingName] = useState(false);
   const [editName, setEditName] = useState('');
 
@@ -211,6 +214,8 @@ export const ChatInfoSidebar = ({ isOpen, onClose, chatInfo, userRole, onDeleteG
                 onDeleteConclusion={onDeleteConclusion}
               />
 
+              {chatId && userId && <SidebarMediaSection chatId={chatId} userId={userId} />}
+
               <SidebarActions
                 isAdmin={isAdmin}
                 isTeachersGroup={isTeachersGroup}
@@ -119,6 +119,8 @@ const ChatInfoPanel = ({
         onClose={onCloseChatInfo}
         userRole={userRole}
         isTeachersGroup={currentChat?.id === 'teachers-group'}
+        chatId={selectedChat || undefined}
+        userId={userId || undefined}
         chatInfo={{
           students: allUsers.filter(u => u.role === 'student' && chatParticipants.includes(u.id)),
           parents: allUsers.filter(u => u.role === 'parent' && chatParticipants.includes(u.id)),
@@ -56,6 +56,7 @@ type ChatMainAreaProps = {
   onForward: (msg: Message) => void;
   onDeleteMessage: (messageId: string) => void;
   onScrollComplete: () => void;
+  onLoadOlder?: () => Promise<boolean>;
   onCancelScheduledMessage: (messageId: string) => void;
   onRetryMessage?: (message: Message) => void;
   onMessageChange: (text: string) => void;
@@ -104,6 +105,7 @@ const ChatMainArea = ({
   onForward,
   onDeleteMessage,
   onScrollComplete,
+  onLoadOlder,
   onCancelScheduledMessage,
   onRetryMessage,
   onMessageChange,
@@ -147,6 +149,7 @@ const ChatMainArea = ({
           allUsers={allUsers}
           scrollToMessageId={scrollToMessageId}
           onScrollComplete={onScrollComplete}
+          onLoadOlder={onLoadOlder}
           onCancelScheduledMessage={onCancelScheduledMessage}
           onRetryMessage={onRetryMessage}
           muteVersion={muteVersion}
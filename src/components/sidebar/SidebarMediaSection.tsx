@@ -0,0 +1,90 @@
+import { useCallback, useEffect, useState } from 'react';
+import { Button } from '@/components/ui/button';
+import Icon from '@/components/ui/icon';
+import { ChatMediaItem, getChatMedia } from '@/services/api';
+
+type SidebarMediaSectionProps = {
+  chatId: string;
+  userId: string;
+};
+
+type MediaTab = 'image' | 'file';
+
+export const SidebarMediaSection = ({ chatId, userId }: SidebarMediaSectionProps) => {
+  const [tab, setTab] = useState<MediaTab>('image');
+  const [items, setItems] = useState<ChatMediaItem[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [isLoading, setIsLoading] = useState(false);
+
+  const loadPage = useCallback(async (before?: string) => {
+    setIsLoading(true);
+    try {
+      const page = await getChatMedia(userId, chatId, undefined, { type: tab, before });
+      setItems(prev => (before ? [...prev, ...page.items] : page.items));
+      setNextCursor(page.nextCursor);
+    } catch (error) {
+      console.error('Failed to load chat media:', error);
+    } finally {
+      setIsLoading(false);
+    }
+  }, [userId, chatId, tab]);
+
+  useEffect(() => {
+    setItems([]);
+    setNextCursor(null);
+    loadPage();
+  }, [loadPage]);
+
+  const visibleItems = items.filter(item => item.file_url);
+
+  return (
+    <div>
+      <div className="flex items-center justify-between mb-3">
+        <h4 className="font-medium text-sm text-muted-foreground flex items-center gap-2">
+          <Icon name="Paperclip" size={16} />
+          Файлы и фото
+        </h4>
+        <div className="flex gap-1">
+          <Button variant={tab === 'image' ? 'secondary' : 'ghost'} size="sm" className="h-7 text-xs" onClick={() => setTab('image')}>
+            Фото
+          </Button>
+          <Button variant={tab === 'file' ? 'secondary' : 'ghost'} size="sm" className="h-7 text-xs" onClick={() => setTab('file')}>
+            Файлы
+          </Button>
+        </div>
+      </div>
+
+      {visibleItems.length === 0 && !isLoading && (
+        <p className="text-sm text-muted-foreground">{tab === 'image' ? 'Нет фото' : 'Нет файлов'}</p>
+      )}
+
+      {tab === 'image' ? (
+        <div className="grid grid-cols-3 gap-1.5">
+          {visibleItems.map(item => (
+            <a key={item.id} href={item.file_url!} target="_blank" rel="noopener noreferrer" className="block aspect-square rounded-md overflow-hidden bg-accent">
+              <img src={item.file_url!} alt={item.file_name || ''} loading="lazy" className="w-full h-full object-cover" />
+            </a>
+          ))}
+        </div>
+      ) : (
+        <div className="space-y-1.5">
+          {visibleItems.map(item => (
+            <a key={item.id} href={item.file_url!} target="_blank" rel="noopener noreferrer" className="flex items-center gap-2 p-2 rounded-lg bg-accent/50 hover:bg-accent text-sm">
+              <Icon name="FileText" size={16} className="flex-shrink-0 text-muted-foreground" />
+              <span className="truncate flex-1">{item.file_name || 'Файл'}</span>
+              {item.file_size && <span className="text-xs text-muted-foreground flex-shrink-0">{item.file_size}</span>}
+            </a>
+          ))}
+        </div>
+      )}
+
+      {nextCursor && (
+        <Button variant="ghost" size="sm" className="w-full mt-2 text-xs" disabled={isLoading} onClick={() => loadPage(nextCursor)}>
+          {isLoading ? 'Загрузка...' : 'Показать ещё'}
+        </Button>
+      )}
+    </div>
+  );
+};
+
+export default SidebarMediaSection;
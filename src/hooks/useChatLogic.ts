@@ -4,7 +4,7 @@ import { initialGroupTopics, initialChatMessages } from '@/data/mockChatData';
 import { teacherAccounts } from '@/data/teacherAccounts';
 import { testAccounts } from '@/data/testAccounts';
 import { wsService } from '@/services/websocket';
-import { getUsers, getChats, getMessages, createChat, updateChat, deleteChat, markAsRead, sendMessage as apiSendMessage, toggleReaction, addConclusion, updateConclusion, deleteConclusion, deleteMessage as apiDeleteMessage, sendTyping, stopTyping, getTypingUsers, uploadFile } from '@/services/api';
+import { getUsers, getChats, getMessages, getMessagesPage, getMessagesDelta, createChat, updateChat, deleteChat, markAsRead, sendMessage as apiSendMessage, broadcastMessage as apiBroadcastMessage, scheduleMessage as apiScheduleMessage, getScheduledMessages, cancelScheduledMessage as apiCancelScheduledMessage, dispatchScheduledMessages, toggleReaction, addConclusion, updateConclusion, deleteConclusion, deleteMessage as apiDeleteMessage, sendTyping, stopTyping, getTypingUsers, uploadFile } from '@/services/api';
 import type { Message as ApiMessage } from '@/services/api';
 import { checkAndPlaySound, requestNotificationPermission, resetNotificationState, updateAppBadge, updateDocumentTitle, ensurePushSubscription, playNotificationSound, markSoundPlayed } from '@/utils/notificationSound';
 import { applyAdminDefaults, applyNonLeadDefaults, getChatSettings, syncMutedSettingsToSW, initNotificationSettingsForUser, shouldPlaySound } from '@/utils/notificationSettings';
@@ -43,13 +43,36 @@ const mapApiMessages = (msgs: ApiMessage[], currentUserId?: string): Message[] =
     } : undefined,
   }));
 
+const mergeApiMessage = (ex: Message | undefined, msg: Message): Message => {
+  if (ex && ex.isOwn) {
+    const resolvedStatus = ex.status === 'sending' ? 'delivered' : ex.status;
+    return { ...msg, timestamp: ex.timestamp, date: ex.date, isOwn: true, status: resolvedStatus };
+  }
+  const merged_msg = { ...ex, ...msg };
+  if (!merged_msg.attachments && ex?.attachments) merged_msg.attachments = ex.attachments;
+  return merged_msg;
+};
+
+const sortByDate = (arr: Message[]): Message[] => {
+  arr.sort((a, b) => {
+    const da = a.date ? new Date(a.date).getTime() : 0;
+    const db = b.date ? new Date(b.date).getTime() : 0;
+    return da - db;
+  });
+  return arr;
+};
+
 const mergeMessages = (existing: Message[], fromApi: Message[]): Message[] => {
   const apiIds = new Set(fromApi.map(m => m.id));
+  // API отдаёт только последнюю страницу — всё, что старше её начала, догружено прокруткой вверх
+  const pageStart = fromApi.length > 0 && fromApi[0].date ? new Date(fromApi[0].date).getTime() : -Infinity;
   const merged = new Map<string, Message>();
   existing.forEach(msg => {
     // Keep: sending, error, scheduled, or already confirmed by API
     // Also keep 'delivered' own messages that haven't appeared in API yet (race condition)
-    if (msg.status === 'sending' || msg.status === 'error' || msg.scheduledAt || apiIds.has(msg.id) || (msg.isOwn && msg.status === 'delivered')) {
+    // Also keep older history outside the fetched page
+    const isOlderHistory = !!msg.date && new Date(msg.date).getTime() < pageStart;
+    if (msg.status === 'sending' || msg.status === 'error' || msg.scheduledAt || apiIds.has(msg.id) || (msg.isOwn && msg.status === 'delivered') || isOlderHistory) {
       merged.set(msg.id, msg);
     }
   });
@@ -58,22 +81,29 @@ const mergeMessages = (existing: Message[], fromApi: Message[]): Message[] => {
     if (ex && ex.scheduledAt) {
       return;
     }
-    if (ex && ex.isOwn) {
-      const resolvedStatus = ex.status === 'sending' ? 'delivered' : ex.status;
-      merged.set(msg.id, { ...msg, timestamp: ex.timestamp, date: ex.date, isOwn: true, status: resolvedStatus });
-    } else {
-      const merged_msg = { ...ex, ...msg };
-      if (!merged_msg.attachments && ex?.attachments) merged_msg.attachments = ex.attachments;
-      merged.set(msg.id, merged_msg);
-    }
+    merged.set(msg.id, mergeApiMessage(ex, msg));
   });
-  const arr = Array.from(merged.values());
-  arr.sort((a, b) => {
-    const da = a.date ? new Date(a.date).getTime() : 0;
-    const db = b.date ? new Date(b.date).getTime() : 0;
-    return da - db;
+  return sortByDate(Array.from(merged.values()));
+};
+
+// Delta-ответ содержит только изменённые сообщения и id удалённых — остальное не трогаем
+const applyMessagesDelta = (existing: Message[], changed: Message[], deletedIds: string[]): Message[] => {
+  const deleted = new Set(deletedIds);
+  const merged = new Map<string, Message>();
+  existing.forEach(msg => {
+    if (!deleted.has(msg.id)) merged.set(msg.id, msg);
   });
-  return arr;
+  changed.forEach(msg => {
+    const ex = merged.get(msg.id);
+    if (ex && ex.scheduledAt) return;
+    merged.set(msg.id, mergeApiMessage(ex, msg));
+  });
+  return sortByDate(Array.from(merged.values()));
+};
+
+const prependOlderMessages = (existing: Message[], older: Message[]): Message[] => {
+  const ids = new Set(existing.map(m => m.id));
+  return [...older.filter(m => !ids.has(m.id)), ...existing];
 };
 
 type User = {
@@ -336,17 +366,17 @@ export const useChatLogic = () => {
     scheduledAt: string;
     timerId?: ReturnType<typeof setTimeout>;
   };
-  const [scheduledMessages, setScheduledMessages] = useState<ScheduledMessage[]>(() => {
-    const stored = localStorage.getItem('scheduledMessages');
-    if (stored) {
-      try { return JSON.parse(stored); } catch { /* ignore */ }
-    }
-    return [];
-  });
+  // Источник истины — таблица scheduled_messages на сервере, здесь только таймеры открытой вкладки
+  const [scheduledMessages, setScheduledMessages] = useState<ScheduledMessage[]>([]);
   const executedScheduledIds = useRef<Set<string>>(new Set());
   const activeSendsRef = useRef(0);
   const [isSending, setIsSending] = useState(false);
   const pendingPayloads = useRef<Map<string, { targetId: string; payload: Parameters<typeof apiSendMessage>[0] }>>(new Map());
+  // Курсоры для догрузки истории: targetId -> prevCursor (null — история загружена целиком)
+  const olderCursorsRef = useRef<Record<string, string | null>>({});
+  const loadingOlderRef = useRef(false);
+  // Токены delta-синхронизации: targetId -> sinceToken последнего опроса
+  const sinceTokensRef = useRef<Record<string, string>>({});
 
   const sendWithRetry = (msgId: string, targetId: string, payload: Parameters<typeof apiSendMessage>[0], attempt = 0) => {
     if (attempt === 0) pendingPayloads.current.set(msgId, { targetId, payload });
@@ -516,10 +546,16 @@ export const useChatLogic = () => {
           id: t.id as string,
           name: t.name as string,
           icon: t.icon as string,
-          lastMessage: '',
-          timestamp: '',
+          // Сводка топика приходит со списком чатов — сообщения топика для превью не запрашиваются
+          lastMessage: (t.last_message || '') as string,
+          timestamp: t.last_msg_at
+            ? parseServerDate(t.last_msg_at as string).toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' })
+            : '',
           unread: (t.unread || 0) as number,
           unreadMentions: (t.unread_mentions || 0) as number,
+          lastSender: (t.last_sender || undefined) as string | undefined,
+          lastMessageAt: (t.last_msg_at || undefined) as string | undefined,
+          messageCount: (t.message_count || 0) as number,
         }));
       }
       return { mappedChats, mappedTopics };
@@ -786,8 +822,33 @@ export const useChatLogic = () => {
 
     const pollMessages = () => {
       if (!firstLoad && (document.hidden || activeSendsRef.current > 0)) return;
-      getMessages(chatId, topicId || undefined).then(msgs => {
-        const mapped = mapApiMessages(msgs, userId);
+      const sinceToken = firstLoad ? undefined : sinceTokensRef.current[targetId];
+      if (sinceToken) {
+        getMessagesDelta(chatId, topicId || undefined, sinceToken).then(delta => {
+          if (delta.reset) {
+            delete sinceTokensRef.current[targetId];
+            return;
+          }
+          sinceTokensRef.current[targetId] = delta.sinceToken;
+          if (delta.messages.length === 0 && delta.deleted.length === 0) return;
+          const mapped = mapApiMessages(delta.messages, userId);
+          setChatMessages(prev => {
+            const old = prev[targetId] || [];
+            const merged = applyMessagesDelta(old, mapped, delta.deleted);
+            if (merged.length > old.length) {
+              markAsRead(userId, chatId, topicId || undefined).catch(() => {});
+            }
+            return { ...prev, [targetId]: merged };
+          });
+        }).catch(() => {});
+        return;
+      }
+      getMessagesPage(chatId, topicId || undefined).then(page => {
+        const mapped = mapApiMessages(page.messages, userId);
+        sinceTokensRef.current[targetId] = page.sinceToken;
+        if (firstLoad) {
+          olderCursorsRef.current[targetId] = page.hasMore ? page.prevCursor : null;
+        }
         setChatMessages(prev => {
           const old = prev[targetId] || [];
           const merged = mergeMessages(old, mapped);
@@ -1198,119 +1259,196 @@ export const useChatLogic = () => {
     const senderAvatar = allUsers.find(u => u.id === userId)?.avatar || defaultAvatars[userRole || ''];
     const timestamp = now.toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' });
 
-    groupIds.forEach((groupId) => {
-      const topicId = `${groupId}-${topicSuffix}`;
-      const messageId = `${Date.now()}-${Math.random().toString(36).slice(2, 8)}-${groupId}`;
+    const broadcastId = `${Date.now()}-${Math.random().toString(36).slice(2, 8)}`;
+    const targets = groupIds.map(groupId => ({
+      groupId,
+      topicId: `${groupId}-${topicSuffix}`,
+      messageId: `${broadcastId}-${groupId}`,
+    }));
 
-      const newMsg: Message = {
-        id: messageId,
-        text,
-        sender: senderName,
-        senderId: userId,
-        senderRole: userRole || undefined,
-        senderAvatar,
-        timestamp,
-        date: nowISO,
-        isOwn: true,
-        status: 'sending',
-      };
+    const setBroadcastStatus = (status: 'delivered' | 'error') => {
+      setChatMessages(prev => {
+        const next = { ...prev };
+        targets.forEach(({ topicId, messageId }) => {
+          next[topicId] = (next[topicId] || []).map(msg =>
+            msg.id === messageId ? { ...msg, status } : msg
+          );
+        });
+        return next;
+      });
+    };
 
-      setChatMessages(prev => ({
-        ...prev,
-        [topicId]: [...(prev[topicId] || []), newMsg],
-      }));
+    setChatMessages(prev => {
+      const next = { ...prev };
+      targets.forEach(({ topicId, messageId }) => {
+        const newMsg: Message = {
+          id: messageId,
+          text,
+          sender: senderName,
+          senderId: userId,
+          senderRole: userRole || undefined,
+          senderAvatar,
+          timestamp,
+          date: nowISO,
+          isOwn: true,
+          status: 'sending',
+        };
+        next[topicId] = [...(next[topicId] || []), newMsg];
+      });
+      return next;
+    });
 
-      setChats(prev => prev.map(chat =>
-        chat.id === groupId
-          ? { ...chat, lastMessage: `${senderName}: ${text.slice(0, 40)}${text.length > 40 ? '...' : ''}`, timestamp }
-          : chat
-      ));
+    setChats(prev => prev.map(chat =>
+      groupIds.includes(chat.id)
+        ? { ...chat, lastMessage: `${senderName}: ${text.slice(0, 40)}${text.length > 40 ? '...' : ''}`, timestamp }
+        : chat
+    ));
 
-      const payload = {
-        id: messageId,
-        chatId: groupId,
-        topicId,
-        senderId: userId,
-        senderName: userName,
-        text,
-        createdAt: nowISO,
-        attachments: [],
-      };
+    // Одна транзакция на сервере вместо запроса на каждую группу; id сообщений
+    // производные от broadcastId, поэтому повтор после таймаута не создаёт дублей
+    const payload = {
+      broadcastId,
+      groupIds,
+      topicSuffix,
+      senderId: userId,
+      senderName: userName,
+      text,
+      createdAt: nowISO,
+    };
 
-      sendWithRetry(messageId, topicId, payload);
-    });
+    const attemptBroadcast = (attempt: number) => {
+      activeSendsRef.current++;
+      if (attempt === 0) setIsSending(true);
+      const controller = new AbortController();
+      const timeout = setTimeout(() => controller.abort(), 30000);
+
+      apiBroadcastMessage(payload, controller.signal).then(() => {
+        clearTimeout(timeout);
+        setBroadcastStatus('delivered');
+      }).catch(() => {
+        clearTimeout(timeout);
+        if (attempt < 2) {
+          setTimeout(() => attemptBroadcast(attempt + 1), 1000 * (attempt + 1));
+          return;
+        }
+        setBroadcastStatus('error');
+      }).finally(() => {
+        activeSendsRef.current = Math.max(0, activeSendsRef.current - 1);
+        if (activeSendsRef.current === 0) setIsSending(false);
+      });
+    };
+
+    attemptBroadcast(0);
   };
 
+  // В момент отправки вкладка просит сервер разослать наступившие сообщения; если вкладка
+  // закрыта, их отправит диспетчер по таймеру (см. README). Повторная отправка исключена на сервере.
+  // До подтверждения сообщение остаётся в статусе 'sending': доставленным его делает ответ
+  // диспетчера или серверная копия из опроса, ошибкой — failed в ответе или сбой запроса.
   const executeScheduledMessage = (scheduled: ScheduledMessage) => {
     if (executedScheduledIds.current.has(scheduled.id)) return;
     executedScheduledIds.current.add(scheduled.id);
 
-    const msg = {
-      ...scheduled.message,
-      timestamp: new Date().toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' }),
-      date: new Date().toISOString(),
-      status: 'sending' as const,
-      scheduledAt: undefined,
-    };
-
-    setChatMessages(prev => {
-      const existing = prev[scheduled.targetId] || [];
-      const found = existing.some(m => m.id === scheduled.id);
-      return {
-        ...prev,
-        [scheduled.targetId]: found
-          ? existing.map(m => m.id === scheduled.id ? msg : m)
-          : [...existing, msg]
+    const updateStatus = (status: 'sending' | 'delivered' | 'error') => {
+      const msg = {
+        ...scheduled.message,
+        timestamp: new Date().toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' }),
+        date: new Date().toISOString(),
+        status,
+        scheduledAt: undefined,
       };
-    });
-
-    const senderName = msg.sender;
-    const msgPreview = msg.text ? (msg.text.length > 40 ? msg.text.slice(0, 40) + '...' : msg.text) : 'Вложение';
-    const now = new Date().toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' });
+      setChatMessages(prev => {
+        const existing = prev[scheduled.targetId] || [];
+        const current = existing.find(m => m.id === scheduled.id);
+        // Опрос уже принёс серверную копию — она точнее локальной
+        if (current && current.status !== 'sending' && current.scheduledAt === undefined) return prev;
+        return {
+          ...prev,
+          [scheduled.targetId]: current
+            ? existing.map(m => m.id === scheduled.id ? msg : m)
+            : [...existing, msg]
+        };
+      });
+      return msg;
+    };
 
-    setChats(prev => prev.map(chat =>
-      chat.id === scheduled.chatId
-        ? { ...chat, lastMessage: `${senderName}: ${msgPreview}`, timestamp: now }
-        : chat
-    ));
+    updateStatus('sending');
+    setScheduledMessages(prev => prev.filter(s => s.id !== scheduled.id));
+
+    const attemptDispatch = (attempt: number) => {
+      dispatchScheduledMessages().then(result => {
+        if (result.sentIds.includes(scheduled.id)) {
+          const msg = updateStatus('delivered');
+          const msgPreview = msg.text ? (msg.text.length > 40 ? msg.text.slice(0, 40) + '...' : msg.text) : 'Вложение';
+          setChats(prev => prev.map(chat =>
+            chat.id === scheduled.chatId
+              ? { ...chat, lastMessage: `${msg.sender}: ${msgPreview}`, timestamp: msg.timestamp }
+              : chat
+          ));
+          wsService.notifyNewMessage(scheduled.id, scheduled.chatId, scheduled.topicId);
+          return;
+        }
+        if (result.failedIds.includes(scheduled.id)) {
+          updateStatus('error');
+          return;
+        }
+        // Не наступило по часам сервера или уже отправлено другим вызовом — повторяем,
+        // а дальше сообщение заменит серверная копия из опроса
+        if (attempt < 2) {
+          setTimeout(() => attemptDispatch(attempt + 1), 10000);
+        }
+      }).catch(() => {
+        if (attempt < 2) {
+          setTimeout(() => attemptDispatch(attempt + 1), 1000 * (attempt + 1));
+          return;
+        }
+        updateStatus('error');
+      });
+    };
 
-    setScheduledMessages(prev => {
-      const updated = prev.filter(s => s.id !== scheduled.id);
-      localStorage.setItem('scheduledMessages', JSON.stringify(updated));
-      return updated;
-    });
+    attemptDispatch(0);
+  };
 
-    apiSendMessage({
-      id: scheduled.id,
-      chatId: scheduled.chatId,
-      topicId: scheduled.topicId,
-      senderId: userId,
-      senderName: userName,
-      text: msg.text,
-      createdAt: new Date().toISOString(),
-      attachments: msg.attachments?.map(att => ({
-        type: att.type,
-        fileUrl: att.fileUrl,
-        fileName: att.fileName,
-        fileSize: att.fileSize,
-      })),
-    }).then(() => {
-      wsService.notifyNewMessage(scheduled.id, scheduled.chatId, scheduled.topicId);
-      setChatMessages(prev => ({
-        ...prev,
-        [scheduled.targetId]: (prev[scheduled.targetId] || []).map(m =>
-          m.id === scheduled.id ? { ...m, status: 'sent' } : m
-        )
-      }));
-    }).catch(() => {
-      setChatMessages(prev => ({
-        ...prev,
-        [scheduled.targetId]: (prev[scheduled.targetId] || []).map(m =>
-          m.id === scheduled.id ? { ...m, status: 'sent' } : m
-        )
+  // Отложенные сообщения, созданные в другой вкладке или на другом устройстве
+  useEffect(() => {
+    if (!isAuthenticated || !userId) return;
+    getScheduledMessages(userId).then(records => {
+      const defaultAvatar = allUsers.find(u => u.id === userId)?.avatar;
+      const loaded: ScheduledMessage[] = records.map(r => ({
+        id: r.id,
+        chatId: r.chat_id,
+        topicId: r.topic_id || undefined,
+        targetId: r.topic_id || r.chat_id,
+        scheduledAt: r.scheduled_at,
+        message: {
+          id: r.id,
+          text: r.text || undefined,
+          sender: r.sender_name,
+          senderId: r.sender_id,
+          senderRole: userRole || undefined,
+          senderAvatar: defaultAvatar,
+          timestamp: new Date(r.scheduled_at).toLocaleTimeString('ru-RU', { hour: '2-digit', minute: '2-digit' }),
+          date: r.scheduled_at,
+          isOwn: true,
+          attachments: r.attachments || undefined,
+          status: 'sending',
+          replyTo: r.reply_to_id ? { id: r.reply_to_id, sender: r.reply_to_sender || '', text: r.reply_to_text || '' } : undefined,
+          scheduledAt: r.scheduled_at,
+        },
       }));
-    });
-  };
+      setScheduledMessages(loaded);
+      setChatMessages(prev => {
+        const next = { ...prev };
+        loaded.forEach(scheduled => {
+          const existing = next[scheduled.targetId] || [];
+          if (!existing.some(m => m.id === scheduled.id)) {
+            next[scheduled.targetId] = [...existing, scheduled.message];
+          }
+        });
+        return next;
+      });
+    }).catch(() => { /* список подтянется при следующем входе */ });
+  }, [isAuthenticated, userId]);
 
   useEffect(() => {
     const timers: ReturnType<typeof setTimeout>[] = [];
@@ -1365,17 +1503,42 @@ export const useChatLogic = () => {
       scheduledAt: scheduledDate.toISOString(),
     };
 
-    setScheduledMessages(prev => {
-      const updated = [...prev, scheduled];
-      localStorage.setItem('scheduledMessages', JSON.stringify(updated));
-      return updated;
-    });
+    setScheduledMessages(prev => [...prev, scheduled]);
 
     setChatMessages(prev => ({
       ...prev,
       [targetId]: [...(prev[targetId] || []), msg]
     }));
 
+    apiScheduleMessage({
+      id: messageId,
+      chatId: scheduled.chatId,
+      topicId: scheduled.topicId,
+      senderId: userId,
+      senderName: userName,
+      text: msg.text,
+      scheduledAt: scheduled.scheduledAt,
+      attachments: msg.attachments?.map(att => ({
+        type: att.type,
+        fileUrl: att.fileUrl,
+        fileName: att.fileName,
+        fileSize: att.fileSize,
+      })),
+      replyToId: msg.replyTo?.id,
+      replyToSender: msg.replyTo?.sender,
+      replyToText: msg.replyTo?.text,
+    }).catch(() => {
+      // Сервер не принял сообщение — таймер вкладки его не отправит, показываем ошибку
+      executedScheduledIds.current.add(messageId);
+      setScheduledMessages(prev => prev.filter(s => s.id !== messageId));
+      setChatMessages(prev => ({
+        ...prev,
+        [targetId]: (prev[targetId] || []).map(m =>
+          m.id === messageId ? { ...m, status: 'error', scheduledAt: undefined } : m
+        )
+      }));
+    });
+
     messageTextRef.current = '';
     setAttachments([]);
     setReplyTo(null);
@@ -1385,11 +1548,9 @@ export const useChatLogic = () => {
 
   const handleCancelScheduledMessage = (messageId: string) => {
     executedScheduledIds.current.delete(messageId);
-    setScheduledMessages(prev => {
-      const updated = prev.filter(s => s.id !== messageId);
-      localStorage.setItem('scheduledMessages', JSON.stringify(updated));
-      return updated;
-    });
+    setScheduledMessages(prev => prev.filter(s => s.id !== messageId));
+    // Если сервер уже успел отправить сообщение, оно вернётся со следующим опросом
+    apiCancelScheduledMessage(userId, messageId);
 
     setChatMessages(prev => {
       const newMessages: Record<string, Message[]> = {};
@@ -1723,6 +1884,32 @@ export const useChatLogic = () => {
     setSelectedTopic(null);
   };
 
+  const handleLoadOlderMessages = async (): Promise<boolean> => {
+    const chatId = selectedChatRef.current;
+    const topicId = selectedTopicRef.current;
+    if (!chatId || !userId || loadingOlderRef.current) return false;
+    const targetId = topicId || chatId;
+    const cursor = olderCursorsRef.current[targetId];
+    if (!cursor) return false;
+
+    loadingOlderRef.current = true;
+    try {
+      const page = await getMessagesPage(chatId, topicId || undefined, { before: cursor });
+      olderCursorsRef.current[targetId] = page.hasMore ? page.prevCursor : null;
+      const older = mapApiMessages(page.messages, userId);
+      setChatMessages(prev => ({
+        ...prev,
+        [targetId]: prependOlderMessages(prev[targetId] || [], older)
+      }));
+      return older.length > 0;
+    } catch (err) {
+      console.error('Failed to load older messages:', err);
+      return false;
+    } finally {
+      loadingOlderRef.current = false;
+    }
+  };
+
   const handleReaction = (messageId: string, emoji: string) => {
     if (!selectedChat || !userId) return;
     const targetId = selectedTopic || selectedChat;
@@ -2369,6 +2556,7 @@ export const useChatLogic = () => {
     handleOpenUsers,
     handleBackToChat,
     handleReaction,
+    handleLoadOlderMessages,
     handleDeleteMessage,
     handleRetryMessage,
     handleAddStudent,
@@ -65,6 +65,7 @@ const Index = () => {
     handleOpenUsers,
     handleBackToChat,
     handleReaction,
+    handleLoadOlderMessages,
     handleDeleteMessage,
     handleAddStudent,
     handleAddParent,
@@ -265,6 +266,7 @@ const Index = () => {
             onForward={(msg) => setForwardMessage(msg)}
             onDeleteMessage={handleDeleteMessage}
             onScrollComplete={() => setScrollToMessageId(null)}
+            onLoadOlder={handleLoadOlderMessages}
             onCancelScheduledMessage={handleCancelScheduledMessage}
             onRetryMessage={handleRetryMessage}
             onMessageChange={handleTyping}
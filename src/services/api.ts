@@ -35,6 +35,7 @@ export type Chat = {
   timestamp?: string;
   unread?: number;
   participants?: string[];
+  last_msg_at?: string | null;
 };
 
 export type Message = {
@@ -53,6 +54,7 @@ export type Message = {
     emoji: string;
     count: number;
     users: string[];
+    userIds?: string[];
   }>;
   reply_to_id?: string;
   reply_to_sender?: string;
@@ -145,17 +147,68 @@ export async function deleteUser(userId: string): Promise<void> {
   }
 }
 
+// ETag последних ответов для условных запросов: сервер отвечает 304, если ничего не изменилось
+const etagCache = new Map<string, { etag: string }>();
+
 // Чаты
-export async function getChats(userId: string): Promise<{ chats: Chat[]; topics: Record<string, unknown[]> }> {
-  const response = await fetch(API_URLS.chats, {
-    headers: { 'X-User-Id': userId },
-  });
+type ChatList = { chats: Chat[]; topics: Record<string, unknown[]> };
+
+type ChatListDelta = ChatList & {
+  removed?: string[];
+  reset?: boolean;
+  sinceToken: string;
+};
+
+// Последний полный список чатов и токен delta-синхронизации для каждого пользователя
+const chatListState = new Map<string, { list: ChatList; sinceToken: string }>();
+
+function mergeChatList(list: ChatList, delta: ChatListDelta): ChatList {
+  const gone = new Set([...(delta.removed || []), ...delta.chats.map(c => c.id)]);
+  const chats = [...list.chats.filter(c => !gone.has(c.id)), ...delta.chats];
+  // Порядок как на сервере: закреплённые сверху, затем по последнему сообщению
+  chats.sort((a, b) =>
+    Number(!!b.is_pinned) - Number(!!a.is_pinned) || (b.last_msg_at || '').localeCompare(a.last_msg_at || '')
+  );
+
+  const topics = { ...list.topics };
+  for (const id of gone) delete topics[id];
+  Object.assign(topics, delta.topics);
+  return { chats, topics };
+}
+
+export async function getChats(userId: string): Promise<ChatList> {
+  const cacheKey = `chats:${userId}`;
+  const cached = etagCache.get(cacheKey);
+  const state = chatListState.get(userId);
+  const headers: Record<string, string> = { 'X-User-Id': userId };
+  if (cached && state) headers['If-None-Match'] = cached.etag;
+
+  // Есть полный список — просим только изменившиеся чаты
+  const url = new URL(API_URLS.chats);
+  if (state) url.searchParams.append('since', state.sinceToken);
+
+  const response = await fetch(url.toString(), { headers });
+
+  if (response.status === 304 && state) {
+    return state.list;
+  }
 
   if (!response.ok) {
     throw new Error('Failed to fetch chats');
   }
 
-  return await response.json();
+  const data: ChatListDelta = await response.json();
+  if (state && data.reset) {
+    chatListState.delete(userId);
+    etagCache.delete(cacheKey);
+    return getChats(userId);
+  }
+
+  const list = state ? mergeChatList(state.list, data) : { chats: data.chats, topics: data.topics };
+  chatListState.set(userId, { list, sinceToken: data.sinceToken });
+  const etag = response.headers.get('ETag');
+  if (etag) etagCache.set(cacheKey, { etag });
+  return list;
 }
 
 export async function createChat(chat: {
@@ -242,12 +295,30 @@ export async function deleteChat(chatId: string): Promise<void> {
 }
 
 // Сообщения
-export async function getMessages(chatId: string, topicId?: string): Promise<Message[]> {
+export type MessagesPage = {
+  messages: Message[];
+  prevCursor: string | null;
+  nextCursor: string | null;
+  hasMore: boolean;
+  sinceToken: string;
+};
+
+export type MessagesDelta = {
+  messages: Message[];
+  deleted: string[];
+  sinceToken: string;
+  reset?: boolean;
+};
+
+export async function getMessagesPage(chatId: string, topicId?: string, options: { before?: string; after?: string; limit?: number } = {}): Promise<MessagesPage> {
   const url = new URL(API_URLS.messages);
   url.searchParams.append('chatId', chatId);
   if (topicId) {
     url.searchParams.append('topicId', topicId);
   }
+  if (options.before) url.searchParams.append('before', options.before);
+  if (options.after) url.searchParams.append('after', options.after);
+  if (options.limit) url.searchParams.append('limit', String(options.limit));
 
   const response = await fetch(url.toString());
 
@@ -255,8 +326,146 @@ export async function getMessages(chatId: string, topicId?: string): Promise<Mes
     throw new Error('Failed to fetch messages');
   }
 
-  const data = await response.json();
-  return data.messages;
+  // ETag — версия треда; следующий delta-опрос отправит её в If-None-Match
+  const etag = response.headers.get('ETag');
+  if (etag) etagCache.set(`messages:${chatId}:${topicId || ''}`, { etag });
+  return await response.json();
+}
+
+export async function getMessagesDelta(chatId: string, topicId: string | undefined, since: string): Promise<MessagesDelta> {
+  const url = new URL(API_URLS.messages);
+  url.searchParams.append('chatId', chatId);
+  if (topicId) {
+    url.searchParams.append('topicId', topicId);
+  }
+  url.searchParams.append('since', since);
+
+  const cacheKey = `messages:${chatId}:${topicId || ''}`;
+  const cached = etagCache.get(cacheKey);
+  const response = await fetch(url.toString(), {
+    headers: cached ? { 'If-None-Match': cached.etag } : {},
+  });
+
+  if (response.status === 304) {
+    return { messages: [], deleted: [], sinceToken: since };
+  }
+
+  if (!response.ok) {
+    throw new Error('Failed to fetch messages');
+  }
+
+  const etag = response.headers.get('ETag');
+  if (etag) etagCache.set(cacheKey, { etag });
+  return await response.json();
+}
+
+export async function getMessages(chatId: string, topicId?: string): Promise<Message[]> {
+  const page = await getMessagesPage(chatId, topicId);
+  return page.messages;
+}
+
+export type ChatMediaItem = {
+  id: string;
+  message_id: string;
+  type: 'image' | 'file';
+  file_url: string | null;
+  file_name: string | null;
+  file_size: string | null;
+  created_at: string;
+  topic_id: string | null;
+  sender_id: string;
+  sender_name: string;
+};
+
+// Файлы и фото чата/топика, новые сверху
+export async function getChatMedia(userId: string, chatId: string, topicId?: string, options: { type?: 'image' | 'file'; before?: string; limit?: number } = {}): Promise<{ items: ChatMediaItem[]; nextCursor: string | null }> {
+  const url = new URL(API_URLS.messages);
+  url.searchParams.append('chatId', chatId);
+  if (topicId) {
+    url.searchParams.append('topicId', topicId);
+  }
+  url.searchParams.append('view', 'media');
+  if (options.type) url.searchParams.append('type', options.type);
+  if (options.before) url.searchParams.append('before', options.before);
+  if (options.limit) url.searchParams.append('limit', String(options.limit));
+
+  const response = await fetch(url.toString(), {
+    headers: { 'X-User-Id': userId },
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to fetch chat media');
+  }
+
+  return await response.json();
+}
+
+export type SearchResult = {
+  id: string;
+  chat_id: string;
+  topic_id: string | null;
+  chat_name: string;
+  topic_name: string | null;
+  sender_id: string;
+  sender_name: string;
+  created_at: string;
+  snippet: string;
+  rank: number;
+};
+
+// Поиск по сообщениям. В snippet совпадения обёрнуты в <mark>, остальной текст экранирован
+export async function searchMessages(userId: string, query: string, options: { chatId?: string; topicId?: string; cursor?: string; limit?: number } = {}): Promise<{ results: SearchResult[]; nextCursor: string | null }> {
+  const url = new URL(API_URLS.messages);
+  url.searchParams.append('q', query);
+  if (options.chatId) url.searchParams.append('chatId', options.chatId);
+  if (options.topicId) url.searchParams.append('topicId', options.topicId);
+  if (options.cursor) url.searchParams.append('cursor', options.cursor);
+  if (options.limit) url.searchParams.append('limit', String(options.limit));
+
+  const response = await fetch(url.toString(), {
+    headers: { 'X-User-Id': userId },
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to search messages');
+  }
+
+  return await response.json();
+}
+
+// Выгрузка истории чата/топика (только для админов): сервер отдаёт её частями,
+// курсор следующей части приходит в заголовке X-Export-Cursor
+export async function exportChatHistory(userId: string, chatId: string, topicId?: string, format: 'ndjson' | 'csv' = 'ndjson'): Promise<Blob> {
+  const parts: string[] = [];
+  let after: string | null = null;
+
+  do {
+    const url = new URL(API_URLS.messages);
+    url.searchParams.append('chatId', chatId);
+    if (topicId) {
+      url.searchParams.append('topicId', topicId);
+    }
+    url.searchParams.append('export', format);
+    if (after) url.searchParams.append('after', after);
+
+    const response = await fetch(url.toString(), {
+      headers: { 'X-User-Id': userId },
+    });
+
+    if (!response.ok) {
+      throw new Error('Failed to export messages');
+    }
+
+    let text = await response.text();
+    if (format === 'csv' && parts.length > 0) {
+      // Заголовок CSV повторяется в каждой части — оставляем только первый
+      text = text.slice(text.indexOf('\n') + 1);
+    }
+    parts.push(text);
+    after = response.headers.get('X-Export-Cursor');
+  } while (after);
+
+  return new Blob(parts, { type: format === 'csv' ? 'text/csv;charset=utf-8' : 'application/x-ndjson' });
 }
 
 export async function toggleReaction(userId: string, messageId: string, emoji: string): Promise<void> {
@@ -323,6 +532,129 @@ export async function sendMessage(message: {
   return data.message;
 }
 
+// Рассылка одного сообщения в одноимённую тему нескольких групп одним запросом.
+// id сообщений на сервере — `${broadcastId}-${groupId}`, поэтому повтор запроса не создаёт дублей.
+export async function broadcastMessage(broadcast: {
+  broadcastId: string;
+  groupIds: string[];
+  topicSuffix: string;
+  senderId: string;
+  senderName: string;
+  text: string;
+  createdAt?: string;
+}, signal?: AbortSignal): Promise<Array<{ id: string; chatId: string; topicId: string; createdAt: string }>> {
+  const response = await fetch(API_URLS.messages, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: 'broadcast', ...broadcast }),
+    signal,
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to broadcast message');
+  }
+
+  const data = await response.json();
+  return data.messages;
+}
+
+// Отложенные сообщения хранятся на сервере и отправляются диспетчером, даже если вкладка закрыта
+export type ScheduledMessageRecord = {
+  id: string;
+  chat_id: string;
+  topic_id: string | null;
+  sender_id: string;
+  sender_name: string;
+  text: string | null;
+  attachments: Array<{ type: 'image' | 'file'; fileUrl?: string; fileName?: string; fileSize?: string }> | null;
+  reply_to_id: string | null;
+  reply_to_sender: string | null;
+  reply_to_text: string | null;
+  scheduled_at: string;
+  created_at: string;
+};
+
+export async function scheduleMessage(message: {
+  id: string;
+  chatId: string;
+  topicId?: string;
+  senderId: string;
+  senderName: string;
+  text?: string;
+  scheduledAt: string;
+  attachments?: Array<{
+    type: 'image' | 'file';
+    fileUrl?: string;
+    fileName?: string;
+    fileSize?: string;
+  }>;
+  replyToId?: string;
+  replyToSender?: string;
+  replyToText?: string;
+}): Promise<{ id: string; scheduledAt: string }> {
+  const response = await fetch(API_URLS.messages, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: 'schedule', ...message }),
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to schedule message');
+  }
+
+  const data = await response.json();
+  return data.scheduled;
+}
+
+export async function getScheduledMessages(userId: string): Promise<ScheduledMessageRecord[]> {
+  const url = new URL(API_URLS.messages);
+  url.searchParams.append('view', 'scheduled');
+
+  const response = await fetch(url.toString(), {
+    headers: { 'X-User-Id': userId },
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to fetch scheduled messages');
+  }
+
+  const data = await response.json();
+  return data.scheduled || [];
+}
+
+// false — сообщение уже отправлено или отменено раньше
+export async function cancelScheduledMessage(userId: string, id: string): Promise<boolean> {
+  const response = await fetch(API_URLS.messages, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', 'X-User-Id': userId },
+    body: JSON.stringify({ action: 'cancel_scheduled', id }),
+  });
+  return response.ok;
+}
+
+export interface DispatchScheduledResult {
+  sent: number;
+  failed: number;
+  batches: number;
+  sentIds: string[];
+  failedIds: string[];
+}
+
+// Просит сервер отправить наступившие отложенные сообщения; параллельные вызовы безопасны
+export async function dispatchScheduledMessages(): Promise<DispatchScheduledResult> {
+  const response = await fetch(API_URLS.messages, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: 'dispatch_scheduled' }),
+  });
+
+  if (!response.ok) {
+    throw new Error('Failed to dispatch scheduled messages');
+  }
+
+  return response.json();
+}
+
 // Typing indicator
 export async function sendTyping(userId: string, chatId: string, topicId: string | undefined, userName: string): Promise<void> {
   try {
@@ -101,6 +101,9 @@ export type Topic = {
   timestamp: string;
   unread: number;
   unreadMentions?: number;
+  lastSender?: string;
+  lastMessageAt?: string;
+  messageCount?: number;
 };
 
 export type GroupTopics = {